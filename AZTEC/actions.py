@@ -1,9 +1,9 @@
+import os
 import re
 import sys
 import time
 
-from AZTEC import cfgutil, utilities
-from AZTEC.db_utils import Query
+from AZTEC import cfgutil, cleaner, ipsw, settings, timing, utilities, workflow
 from AZTEC.device import create_or_update_record, report_end_time
 
 
@@ -23,39 +23,80 @@ def has_not_booted(device):
 
     device_logger = utilities.log_setup(log_name=device["ECID"])
 
-    def sleep_return(sleep_time, result):
-        """Sleeps the returns a value.
-
-        Args:
-            sleep_time (int): Number of seconds to sleep
-            result (any): Any value
-
-        Returns:
-            any: Any value
-        """
-
-        time.sleep(sleep_time)
-        return result
-
-
     if device["bootedState"] == "Recovery":
         device_logger.warning("\u26A0 Device is currently booted to Recovery Mode (DFU)...")
-        return sleep_return(0, False)
+        return False
 
     elif device["bootedState"] == "Restore":
         device_logger.info("\u26A0 Device is currently being restored...")
-        return sleep_return(10, True)
+        return True
 
     elif device["bootedState"] == "Booted":
         device_logger.debug("Device has booted...")
-        return sleep_return(0, False)
+        return False
+
+    device_logger.info("\u23F3 Waiting for device to boot...")
+    device_logger.info("Current state is:  {}".format(device["bootedState"]))
+    return True
+
+
+def wait_until(device, is_ready, description, timeout, confirmations=1, environment=None):
+    """Polls a device until it is ready, backing off between polls, or until the deadline passes.
+
+    Args:
+        device (dict):  Object of device's information from the database
+        is_ready (function):  Returns whether a device record is ready
+        description (str):  What is being waited on, for the log
+        timeout (float):  Maximum number of seconds to wait
+        confirmations (int, optional):  Number of consecutive polls the device
+            must be ready for.  Defaults to 1
+        environment (dict, optional):  The cfgutil environment variables for the event
+
+    Returns:
+        dict:  The device's latest record from the database
+    """
+
+    device_logger = utilities.log_setup(log_name=device["ECID"])
+
+    started = time.monotonic()
+    deadline = started + timeout
+    delay = settings.READY_POLL_MIN
+    ready = 1 if is_ready(device) else 0
+
+    while ready < confirmations:
+
+        if time.monotonic() + delay > deadline:
+            device_logger.warning("\u26A0 Gave up waiting for {} after {:.0f} seconds".format(
+                description, time.monotonic() - started))
+            break
+
+        time.sleep(delay)
+        delay = min(delay * 1.5, settings.READY_POLL_MAX)
+
+        device = create_or_update_record(device["ECID"], environment=environment)
+        ready = ready + 1 if is_ready(device) else 0
+
+    device_logger.info("\u23F1 Waited {:.1f} seconds for {}".format(
+        time.monotonic() - started, description))
 
-    elif device["bootedState"] != "Booted":
-        device_logger.info("\u23F3 Waiting for device to boot...")
-        device_logger.info("Current state is:  {}".format(device["bootedState"]))
-        return sleep_return(5, True)
+    return device
 
-    return sleep_return(10, True)
+
+def wait_for_boot(device, environment=None):
+    """Waits for a device to boot (or to finish restoring).
+
+    Args:
+        device (dict):  Object of device's information from the database
+        environment (dict, optional):  The cfgutil environment variables for the event
+
+    Returns:
+        dict:  The device's latest record from the database
+    """
+
+    timing.enter(device["ECID"], "boot_wait")
+
+    return wait_until(device, lambda device: not has_not_booted(device), 
+        "the device to boot", settings.BOOT_TIMEOUT, environment=environment)
 
 
 def erase_device(device):
@@ -70,25 +111,25 @@ def erase_device(device):
     # Erase Device
     device_logger.info("\u2620 To proceed, the device will be erased!")
     device_logger.info(
-        "\u26A0\u26A0\u26A0 *** You have five seconds to remove the device before it is wiped! *** \u26A0\u26A0\u26A0")
+        "\u26A0\u26A0\u26A0 *** You have {:g} seconds to remove the device before it is wiped! *** \u26A0\u26A0\u26A0".format(
+            settings.ERASE_WARNING))
 
     # Update status in the database
-    with Query() as run:
-        run.execute('UPDATE devices SET status = ? WHERE ECID = ?', 
-            ("erase_warning", device["ECID"]))
+    workflow.transition(device["ECID"], "erase_warning", "erase")
 
-    time.sleep(5)
+    timing.enter(device["ECID"], "erase_warning")
+
+    time.sleep(settings.ERASE_WARNING)
     device_logger.info("\U0001F4A3 Erasing device...")
+    timing.enter(device["ECID"], "erase")
 
-    results_erase, json_data = cfgutil.execute(device["ECID"], "erase")
+    results_erase, json_data = cfgutil.execute(device["ECID"], "erase", device["deviceType"])
 
     # Verify success
     if results_erase["success"]:
 
         # Update status in the database
-        with Query() as run:
-            run.execute('UPDATE devices SET status = ? WHERE ECID = ?', 
-                ("erasing", device["ECID"]))
+        workflow.transition(device["ECID"], "erasing", "erase")
 
     elif re.match( "cfgutil: error: no devices found", results_erase["stderr"]):
 # Probably will never run again...
@@ -100,31 +141,43 @@ def erase_device(device):
                 results_erase["exitcode"], results_erase["stderr"]))
 
 
-def prepare_device(device):
+def prepare_device(device, environment=None):
     """Prepares the provided device.
 
+    A device that was just erased is only prepared once it is ready; if it is not
+    ready by settings.PREPARE_READY_TIMEOUT, it is tried again later instead.
+
     Args:
        device (dict):  Object of device's information from the database
+       environment (dict, optional):  The cfgutil environment variables for the event
     """
 
     device_logger = utilities.log_setup(log_name=device["ECID"])
 
     if device["status"] == "erased":
         device_logger.info("\u23F3 Waiting for device to finish booting...")
+        timing.enter(device["ECID"], "prepare_wait")
 
-# Still needed?
-        # Sleep while the device erases and starts back up
-        time.sleep(70)
+        # cfgutil may report a device as booted before it has _actually_ finished
+        # booting, so wait until it has been ready on consecutive polls
+        is_ready = lambda device: device["bootedState"] == "Booted" and device["activationState"] == "Unactivated"
+        device = wait_until(device, is_ready, "the device to be ready to prepare", 
+            settings.PREPARE_READY_TIMEOUT, confirmations=2, environment=environment)
+
+        if not is_ready(device):
+
+            # Preparing a device that is not ready fails, try again once its backoff has passed
+            workflow.retry(device["ECID"], "not ready to prepare", "erased")
+            sys.exit(1)
 
     device_logger.info("\u2699 Preparing")
+    timing.enter(device["ECID"], "prepare")
 
     # Update status in the database
-    with Query() as run:
-        run.execute('UPDATE devices SET status = ? WHERE ECID = ?', 
-            ("preparing", device["ECID"]))
+    workflow.transition(device["ECID"], "preparing", "prepare")
 
     results_prepare, json_data = cfgutil.execute(
-        device["ECID"], "prepare --dep --language en --locale en_US")
+        device["ECID"], "prepare --dep --language en --locale en_US", device["deviceType"])
 
     # Verify success
     if results_prepare["success"]:
@@ -133,30 +186,58 @@ def prepare_device(device):
         report_end_time(device)
 
 
-def restore_device(device):
+def restore_device(device, environment=None):
     """Erases and updates the provided device object.
 
     Args:
         device (dict):  Object of device's information from the database
+        environment (dict, optional):  The cfgutil environment variables for the event
     """
 
     device_logger = utilities.log_setup(log_name=device["ECID"])
+    requested_time = time.monotonic()
+
+    # Get the firmware from the local library, so that it is only downloaded once for all devices
+    ipsw_path, downloaded = ipsw.stage(device["deviceType"])
+
+    if ipsw_path:
+        command = "restore --ipsw '{}'".format(ipsw_path)
+
+        if not downloaded:
+            device_logger.info("\U0001F4BE Using firmware from the local library, saved downloading {}".format(
+                utilities.HumanBytes.format(os.path.getsize(ipsw_path))))
+
+    else:
+        # Let cfgutil download the firmware itself
+        command = "restore"
 
     # Erase Device
     device_logger.info("\u2620 To proceed, the device will be erased!")
     device_logger.info(
-        "\u26A0\u26A0\u26A0 *** You have five seconds to remove the device before it is wiped! *** \u26A0\u26A0\u26A0")
+        "\u26A0\u26A0\u26A0 *** You have {:g} seconds to remove the device before it is wiped! *** \u26A0\u26A0\u26A0".format(
+            settings.ERASE_WARNING))
 
     # Update status in the database
-    with Query() as run:
-        run.execute('UPDATE devices SET status = ? WHERE ECID = ?', 
-            ("erase_warning", device["ECID"]))
+    workflow.transition(device["ECID"], "erase_warning", "restore")
+
+    timing.enter(device["ECID"], "erase_warning")
 
-    time.sleep(5)
+    time.sleep(settings.ERASE_WARNING)
 
     # Update device using Restore, which will also erase it
     device_logger.info("\U0001F4A3 Erasing and updating device...")
-    results_restore, json_data = cfgutil.execute(device["ECID"], "restore")
+    device_logger.debug("Restore started {:.1f} seconds after it was requested".format(
+        time.monotonic() - requested_time))
+    timing.enter(device["ECID"], "restore")
+
+    # Keep the firmware cfgutil extracts only for as long as a restore may be using it
+    restore = cleaner.begin_restore(device["ECID"])
+
+    try:
+        results_restore, json_data = cfgutil.execute(device["ECID"], command, device["deviceType"])
+
+    finally:
+        cleaner.end_restore(restore)
 
     # Verify success
     if not results_restore["success"]:
@@ -175,8 +256,7 @@ def restore_device(device):
 
         else:
 
-            while has_not_booted(device):
-                device = create_or_update_record(device["ECID"])
+            device = wait_for_boot(device, environment=environment)
 
             # # Erase device
             # erase_device(device)
@@ -189,9 +269,7 @@ def restore_device(device):
     else:
 
         # Update status in the database
-        with Query() as run:
-            results = run.execute('UPDATE devices SET status = ? WHERE ECID = ?', 
-                ("erased", device["ECID"]))
+        workflow.transition(device["ECID"], "erased", "restore")
 
         # Prepare Device
-        prepare_device(device)
+        prepare_device(dict(device, status="erased"), environment=environment)
@@ -0,0 +1,65 @@
+import json
+import logging
+import os
+import socketserver
+import threading
+
+from AZTEC import settings, utilities
+
+
+class RecordHandler(socketserver.StreamRequestHandler):
+    """Reads the log records a hook process sends, one JSON object per line, and
+    hands them to this process' log writer in the order they were sent.
+    """
+
+    def handle(self):
+        """Runs when a hook process connects to the aggregator."""
+
+        for line in self.rfile:
+
+            try:
+                record = logging.makeLogRecord(json.loads(line.decode("utf-8")))
+
+            except ValueError:
+                continue
+
+            utilities.log_setup(log_name=record.name).handle(record)
+
+
+class LogAggregator(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """A server that collects the log records of every hook process so that
+    `main.py` is the only process writing to the console and log files.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=None):
+
+        self.socket_path = socket_path or settings.LOG_SOCKET
+
+        # Remove a socket left behind by a previous run
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        super().__init__(self.socket_path, RecordHandler)
+
+
+    def start(self):
+        """Starts accepting log records in a background thread."""
+
+        # This process writes its own records (and those it receives) to the log files
+        utilities.log_aggregator_running = True
+        utilities.log_setup()
+
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+
+    def stop(self):
+        """Stops accepting log records and removes the socket."""
+
+        self.shutdown()
+        self.server_close()
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
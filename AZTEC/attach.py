@@ -1,25 +1,88 @@
 import os
+import time
 
-from distutils.util import strtobool
-from pkg_resources import parse_version
-
-from AZTEC import utilities
-from AZTEC.actions import erase_device, has_not_booted, prepare_device, restore_device
+from AZTEC import limiter, settings, utilities, workflow
+from AZTEC.actions import erase_device, prepare_device, restore_device, wait_for_boot
 from AZTEC.device import create_or_update_record, firmware_check, report_end_time
 
 
-def main():
-    """Handles the attach logic; called from cfgutil --on-attach."""
+def provision(device, environment=None):
+    """Updates (restores) the device if its firmware is out of date, otherwise erases it."""
+
+    # Get the latest firmware this device model supports
+    latest_firmware = firmware_check(device["deviceType"])
+
+    # Check if the current firmware is older than the latest
+    if ( latest_firmware and 
+        utilities.version_key(device["firmwareVersion"]) < utilities.version_key(latest_firmware) ):
+        # Restore the device
+        restore_device(device, environment=environment)
+
+    else:
+        # Firmware is the latest, so simply erase the device
+        erase_device(device)
+
+
+def wait(device):
+
+    device_logger = utilities.log_setup(log_name=device["ECID"])
+    device_logger.info("\u23F3 Device is still being restored, it will be checked again when it reboots")
+
+
+def unplug(device):
+
+    device_logger = utilities.log_setup(log_name=device["ECID"])
+    device_logger.info(
+        "\U0001F7E2 [UNPLUG] MDM configuration likely initiated a reboot, it is safe to unplug.")
+
+
+def quarantine(device):
+
+    device_logger = utilities.log_setup(log_name=device["ECID"])
+    device_logger.error(
+        "\U0001F6A7 [QUARANTINE] Device failed to provision {} times (last:  {}) and is quarantined, "
+        "unplug it to free the port.".format(device["failures"], device["last_failure"]))
+
+
+# The functions that carry out each action of workflow.TRANSITIONS
+ACTIONS = {
+    "provision": provision,
+    "erase": erase_device,
+    "prepare": prepare_device,
+    "complete": report_end_time,
+    "unplug": unplug,
+    "wait": wait,
+    "quarantine": quarantine
+}
+
+# The actions that poll the device, so are given the event's cfgutil environment
+POLLING_ACTIONS = { "provision", "prepare" }
+
+
+def main(environment=None):
+    """Handles the attach logic; called from cfgutil --on-attach.
+
+    Args:
+        environment (dict, optional):  The cfgutil environment variables for the event.
+            Defaults to os.environ
+    """
+
+    environment = environment or os.environ
 
     main_logger = utilities.log_setup()
 
     # Monitor available disk space
-    total, used, free = utilities.get_disk_usage("/")
-    main_logger.debug("Monitoring Available Disk Space:  {}".format(free))
+    total, used, free = utilities.get_disk_usage("/", human=False)
+    main_logger.debug("Monitoring Available Disk Space:  {}".format(utilities.HumanBytes.format(free)))
+
+    if free < settings.DISK_FREE_RESERVE:
+        # Free up space now rather than waiting on the background clean up job
+        main_logger.warning("\U0001F4BE Available disk space is low, cleaning up temporary files...")
+        limiter.reclaim_disk_space()
 
     # Get the sessions' device ECID (this will be our primary unique 
     # identifier for this device during for subsequent sessions )
-    session_ECID = os.getenv('ECID')
+    session_ECID = environment.get('ECID')
 
     if not session_ECID:
 
@@ -34,66 +97,54 @@ def main():
         # If a device was successfully detected
         device_logger.info("[ATTACH WORKFLOW]")
 
-        device = create_or_update_record(session_ECID)
+        device = create_or_update_record(session_ECID, environment=environment)
 
-        while has_not_booted(device):
-            device = create_or_update_record(device["ECID"])
+        if device["status"] == "quarantined":
+            quarantine(device)
+            return
 
-        if device["status"] in { "new", "error" }:
+        # A device that failed is only tried again once its backoff has passed
+        if device["retry_after"]:
 
-            # Get the latest firmware this device model supports
-            latest_firmware = firmware_check(device["deviceType"])
+            if device["retry_after"] > time.time():
+                device_logger.info("\u23F3 Device will be tried again in {:g} seconds".format(
+                    round(device["retry_after"] - time.time())))
+                return
 
-            # Check if the current firmware is older than the latest
-            if parse_version(device["firmwareVersion"]) < parse_version(str(latest_firmware)):
-                # Restore the device
-                restore_device(device)
+            workflow.take_due([ session_ECID ])
 
-            else:
-                # Firmware is the latest, so simply erase the device
-                erase_device(device)
+        device = wait_for_boot(device, environment=environment)
 
-        else:
-            # Device has already started the provisioning process
-
-            # Set the device States
-            activation_state = device["activationState"]
-            supervision_state = strtobool(device["isSupervised"])
-
-            # Check device's current state
-            if activation_state == "Unactivated":
-                # Prepare Device
-                prepare_device(device)
-
-            elif ( activation_state == "Activated" and supervision_state == True ):
+        # Look up what to do with the device, resuming from its last valid status if needed
+        action, status = workflow.resume(device)
 
-                if device["status"] == "check":
-                    # Add the end time to the database
-                    report_end_time(device)
+        if status != device["status"]:
+            device_logger.info("\u21A9 Resuming from the `{}` status".format(status))
+            workflow.transition(session_ECID, status, "resumed")
+            device = dict(device, status=status)
 
-                elif device["status"] == "done":
-                    device_logger.info(
-                        "\U0001F7E2 [UNPLUG] MDM configuration likely initiated a reboot, it is safe to unplug.")
+        if not action:
 
-                else:
+            # Unknown device state
+            device_logger.warning("\u26A0 Unknown device state")
+            device_logger.warning("\u26A0 Current device status:  {}".format(device["status"]))
+            action = "erase"
 
-                    # Unknown device state
-                    device_logger.warning("\u26A0 Unknown device state")
+        # Erasing a device again counts against its retry budget, it is provisioned 
+        # (erased) once its backoff has passed
+        if action == "erase":
+            workflow.retry(session_ECID, "erase from `{}`".format(device["status"]))
+            return
 
-                    # Erase the device
-                    erase_device(device)
+        device_logger.debug("Device is `{}` ({}, supervised:  {}, {}), next action:  {}".format(
+            device["status"], device["activationState"], device["isSupervised"], 
+            device["bootedState"], action))
 
-            else:
+        if action in POLLING_ACTIONS:
+            ACTIONS[action](device, environment=environment)
 
-                # if device["status"] != "new":
-        # ^^^ Maybe check against a [ list of known device states] ?
-
-                # Unknown device state
-                device_logger.warning("\u26A0 Unknown device state")
-                device_logger.warning("\u26A0 Current device status:  {}".format(device["status"]))
-
-                # Erase the device
-                erase_device(device)
+        else:
+            ACTIONS[action](device)
 
 
 if __name__ == "__main__":
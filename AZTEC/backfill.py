@@ -0,0 +1,359 @@
+"""Back-fills the timing tables from the logs of earlier runs.
+
+The `logs_<timestamp>` directories left by `utilities.log_backup` are read line
+by line, the stages of each device are rebuilt from the markers AZTEC logs
+(attach, erase, restore, prepare, done, ...) and are bulk inserted into the
+`stage_timings` and `completions` tables, and the throughput rollups.  Devices
+that were not provisioned by the end of the logs are kept as open stages.  Each
+log file is only imported once.
+
+Usage:  python3 -m AZTEC.backfill [--database devices.db] LOG_DIRECTORY [LOG_DIRECTORY ...]
+"""
+
+import argparse
+import os
+import time
+
+from AZTEC import rollups
+from AZTEC.db_utils import Query, migrate
+
+
+# Messages that move a device on to a stage, as logged by the attach workflow
+MARKERS = (
+    ( "To proceed, the device will be erased!", "erase_warning" ),
+    ( "Erasing and updating device...", "restore" ),
+    ( "Erasing device...", "erase" ),
+    ( "Waiting for device to finish booting...", "prepare_wait" ),
+    ( "Waiting for a free erase slot...", "erase_queued" ),
+    ( "Waiting for a free prepare slot...", "prepare_queued" ),
+    ( "Waiting for a free restore slot...", "restore_queued" ),
+    ( "Preparing", "prepare" )
+)
+
+
+class Backfill():
+    """Rebuilds the timelines of the devices in a set of log files.
+
+    Only the devices that are still being worked on are kept in memory; a stage
+    is queued to be inserted as soon as the next one starts, so memory does not
+    grow with the size of the logs.
+    """
+
+    def __init__(self, run, batch_size=10000):
+
+        self.run = run
+        self.batch_size = batch_size
+        self.timelines = {}
+        self.stages = []
+        self.statistics = { "files": 0, "lines": 0, "stages": 0, "completions": 0, "incomplete": 0 }
+
+        # Back-filled devices have no report, so they are given negative IDs that
+        # cannot collide with those of the devices table
+        self.next_id = min( 0, run.execute("SELECT MIN(id) FROM completions").fetchone()[0] or 0 ) - 1
+
+        self.minute = None
+        self.epoch = None
+
+
+    def get_time(self, asctime):
+        """Converts a log line's `asctime` to epoch time.
+
+        Args:
+            asctime (str):  e.g. "2022-01-07 15:05:50,939"
+
+        Returns:
+            float:  Epoch time
+        """
+
+        # Lines are in order, so only a new minute has to be converted
+        if asctime[:16] != self.minute:
+            self.minute = asctime[:16]
+            self.epoch = time.mktime( ( int(asctime[0:4]), int(asctime[5:7]), int(asctime[8:10]),
+                int(asctime[11:13]), int(asctime[14:16]), 0, 0, 0, -1 ) )
+
+        return self.epoch + int(asctime[17:19]) + int(asctime[20:23]) / 1000
+
+
+    def enter(self, ECID, stage, when):
+        """Moves a device on to a stage, finishing the stage it was in.
+
+        Args:
+            ECID (str):  ECID of a device
+            stage (str):  The stage, e.g. "erase"
+            when (float):  Epoch time of the log line
+        """
+
+        timeline = self.timelines.setdefault(ECID, { "stage": None, "started": None, "start_time": when })
+        self.finish_stage(ECID, when)
+        timeline["stage"] = stage
+        timeline["started"] = when
+
+
+    def finish_stage(self, ECID, when):
+        """Queues a device's current stage to be inserted.
+
+        Args:
+            ECID (str):  ECID of a device
+            when (float):  Epoch time of the log line, or None to leave the stage open
+        """
+
+        timeline = self.timelines[ECID]
+
+        if timeline["stage"]:
+
+            # There is no monotonic clock for past runs, the wall clock is used instead
+            self.stages.append( ( ECID, timeline["stage"], timeline["started"], timeline["started"],
+                when, when - timeline["started"] if when is not None else None ) )
+            timeline["stage"] = None
+
+            if len(self.stages) >= self.batch_size:
+                self.flush()
+
+
+    def complete(self, ECID, when):
+        """Records a device that was provisioned.
+
+        Args:
+            ECID (str):  ECID of a device
+            when (float):  Epoch time of the log line
+        """
+
+        timeline = self.timelines.get(ECID)
+
+        if not timeline:
+            return
+
+        self.finish_stage(ECID, when)
+
+        completion = {
+            "id": self.next_id,
+            "ECID": ECID,
+            "SerialNumber": None,
+            "deviceType": None,
+            "firmwareVersion": None,
+            "start_time": timeline["start_time"],
+            "end_time": when,
+            "duration": when - timeline["start_time"]
+        }
+
+        self.run.execute(
+            """INSERT INTO completions
+            ( id, ECID, SerialNumber, deviceType, firmwareVersion, start_time, end_time, duration )
+            VALUES (:id, :ECID, :SerialNumber, :deviceType, :firmwareVersion, :start_time, :end_time, :duration)""",
+            completion )
+        rollups.add_to_rollups(self.run, completion)
+
+        self.next_id -= 1
+        self.statistics["completions"] += 1
+
+        # The device starts over if it is provisioned again
+        del self.timelines[ECID]
+
+
+    def parse_line(self, line, skip):
+        """Updates the timelines from a log line.
+
+        Args:
+            line (str):  A line in the `asctime | [LEVEL] | name - message` format
+            skip (set):  Names of the devices whose lines are to be ignored
+        """
+
+        parts = line.split(" | ", 2)
+
+        # Skip the continuation lines of multi-line messages
+        if len(parts) != 3:
+            return
+
+        asctime, level, record = parts
+        ECID, _, message = record.partition(" - ")
+
+        if ECID == "main" or ECID in skip:
+            return
+
+        message = message.rstrip()
+
+        if message.endswith("[ATTACH WORKFLOW]"):
+            # Every attach starts by waiting for the device to boot
+            self.enter(ECID, "boot_wait", self.get_time(asctime))
+
+        elif message.endswith("[DETACH WORKFLOW]"):
+
+            # Whatever the device was doing ended when it was detached
+            if ECID in self.timelines:
+                self.finish_stage(ECID, self.get_time(asctime))
+
+        elif message.endswith("Erased device!"):
+
+            # The device is rebooting until it attaches again
+            if ECID in self.timelines:
+                self.enter(ECID, "reboot", self.get_time(asctime))
+
+        elif message.endswith("Device removed from queue"):
+            # The device is done with, it starts over if it is attached again
+            self.timelines.pop(ECID, None)
+
+        elif message.endswith("Adding device to queue..."):
+            when = self.get_time(asctime)
+            self.timelines.setdefault(ECID, { "stage": None, "started": None, "start_time": when })
+            self.timelines[ECID]["start_time"] = when
+
+        elif message.endswith("Device has been provisioned, it can be unplugged!"):
+            self.complete(ECID, self.get_time(asctime))
+
+        elif message.startswith("Waited ") and message.endswith(" slot"):
+
+            # The operation started once it got its slot
+            operation = message.split()[-2]
+            timeline = self.timelines.get(ECID)
+
+            if timeline and timeline["stage"] == "{}_queued".format(operation):
+                self.enter(ECID, operation, self.get_time(asctime))
+
+        else:
+
+            for marker, stage in MARKERS:
+
+                if message.endswith(marker):
+                    self.enter(ECID, stage, self.get_time(asctime))
+                    break
+
+
+    def parse_file(self, path, skip=frozenset()):
+        """Streams a log file into the timelines.
+
+        Args:
+            path (str):  The log file
+            skip (set, optional):  Names of the devices whose lines are to be ignored
+        """
+
+        with open(path, "r", encoding="utf-8", errors="replace") as log_file:
+
+            for line in log_file:
+                self.statistics["lines"] += 1
+                self.parse_line(line, skip)
+
+        self.statistics["files"] += 1
+
+
+    def finish(self):
+        """Inserts the stages of the devices that were not provisioned by the end of
+        the logs, leaving the stage each device was last in open.
+        """
+
+        for ECID in list(self.timelines):
+
+            if self.timelines[ECID]["stage"]:
+                self.finish_stage(ECID, None)
+                self.statistics["incomplete"] += 1
+
+        self.timelines = {}
+        self.flush()
+
+
+    def flush(self):
+        """Inserts the queued stages."""
+
+        self.run.executemany(
+            """INSERT INTO stage_timings
+            ( ECID, stage, started, started_monotonic, finished_monotonic, duration, backfilled )
+            VALUES (?, ?, ?, ?, ?, ?, 1)""", self.stages )
+
+        self.statistics["stages"] += len(self.stages)
+        self.stages = []
+
+
+def get_log_directories(path):
+    """Finds the log directories in a path.
+
+    Args:
+        path (str):  A log directory, or a directory of them
+
+    Returns:
+        list:  The log directories, oldest first
+    """
+
+    if any( name.endswith(".log") for name in os.listdir(path) ):
+        return [ path ]
+
+    return sorted( os.path.join(path, name) for name in os.listdir(path)
+        if os.path.isdir(os.path.join(path, name)) )
+
+
+def import_directory(directory, database="devices.db"):
+    """Back-fills the timing tables from one log directory.
+
+    Devices that have their own log file are read from it, as it also has their
+    DEBUG lines; the others are read from main.log.
+
+    Args:
+        directory (str):  The log directory
+        database (str, optional):  The database file
+
+    Returns:
+        dict:  Number of files and lines read, and stages and completions inserted
+    """
+
+    names = sorted( name for name in os.listdir(directory) if name.endswith(".log") )
+    devices = { name[:-len(".log")] for name in names if name != "main.log" }
+
+    with Query(database=database) as run:
+
+        run.execute("BEGIN IMMEDIATE")
+
+        imported = { row["path"] for row in run.execute("SELECT path FROM backfilled_logs").fetchall() }
+        backfill = Backfill(run)
+
+        for name in names:
+
+            path = os.path.abspath(os.path.join(directory, name))
+
+            if path in imported:
+                continue
+
+            if name == "main.log":
+                backfill.parse_file(path, skip=devices)
+
+            else:
+                backfill.parse_file(path)
+
+            run.execute("INSERT INTO backfilled_logs ( path, imported ) VALUES (?, ?)", (path, time.time()))
+
+        backfill.finish()
+
+    return backfill.statistics
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Back-fill the timing tables from the logs of earlier runs.")
+    parser.add_argument("--database", "-d", default="devices.db",
+        help="Specify the database file to back-fill.")
+    parser.add_argument("paths", nargs="+", metavar="LOG_DIRECTORY",
+        help="A logs_<timestamp> directory, or a directory of them.")
+    args = parser.parse_args()
+
+    migrate(args.database)
+    started = time.monotonic()
+    totals = { "files": 0, "lines": 0, "stages": 0, "completions": 0, "incomplete": 0 }
+
+    for path in args.paths:
+
+        for directory in get_log_directories(path):
+
+            statistics = import_directory(directory, args.database)
+
+            for key, value in statistics.items():
+                totals[key] += value
+
+            print("{}:  {} files, {} lines, {} stages, {} devices provisioned, {} not finished".format(
+                directory, statistics["files"], statistics["lines"], statistics["stages"],
+                statistics["completions"], statistics["incomplete"]))
+
+    print("Back-filled {} files ({} lines) in {:.1f} seconds:  {} stages, {} devices provisioned, "
+        "{} not finished".format(totals["files"], totals["lines"], time.monotonic() - started, 
+        totals["stages"], totals["completions"], totals["incomplete"]))
+
+
+if __name__ == "__main__":
+    main()
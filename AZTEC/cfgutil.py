@@ -1,203 +1,336 @@
-import datetime
-import os
 import re
-import shutil
-import stat
 import sys
+import threading
+import time
 
-from AZTEC import actions, utilities
+from AZTEC import limiter, settings, utilities, workflow
 from AZTEC.db_utils import Query
 
 
-def execute(ECID, command):
+def get_timeout(operation, model=None):
+    """Gets how long a cfgutil operation may run for, for a device model.
+
+    Args:
+        operation (str):  The operation, e.g. "restore"
+        model (str, optional):  The device's model, e.g. "iPad7,5"
+
+    Returns:
+        float:  Seconds, or None if the operation has no timeout
+    """
+
+    return settings.MODEL_COMMAND_TIMEOUTS.get(operation, {}).get(model, 
+        settings.COMMAND_TIMEOUTS.get(operation))
+
+
+def handle_timeout(ECID, operation, timeout):
+    """Marks a device whose cfgutil command was stopped for hanging to be retried, and stops its workflow.
+
+    Args:
+        ECID (str): ECID of a device
+        operation (str):  The operation that timed out, e.g. "restore"
+        timeout (float):  The seconds it was given
+    """
+
+    device_logger = utilities.log_setup(log_name=ECID)
+    device_logger.error(
+        "\U0001F6D1 `cfgutil {}` did not finish within {:g} seconds and was stopped".format(operation, timeout))
+
+    with Query() as run:
+
+        # Record which port it happened on, a flaky hub or cable shows up as a port with many timeouts
+        run.execute(
+            """INSERT INTO command_timeouts ( ECID, locationID, operation, timeout, occurred ) 
+            VALUES (?, ( SELECT locationID FROM devices WHERE ECID = ? ), ?, ?, ?)""", 
+            (ECID, ECID, operation, timeout, time.time()))
+
+    # A timeout counts against the device's retry budget
+    workflow.retry(ECID, "{} timed out".format(operation))
+
+    sys.exit(1)
+
+
+def execute(ECID, command, model=None):
     """Helper function for the cfgutil binary.
 
     Args:
         ECID (str): ECID of a device
         command (str): the switch (and optional values) to execute
+        model (str, optional):  The device's model, for its timeout
 
     Returns:
         results (dict):  Dict of values from utilities.execute_process
         json_data (dict):  Dict object parsed from the utilities.execute_process["stdout"] key
     """
 
-    device_logger = utilities.log_setup(log_name=ECID)
+    operation = command.split()[0]
+    timeout = get_timeout(operation, model)
 
-    results = utilities.execute_process("cfgutil --ecid {} --format JSON {}".format(ECID, command))
+    # Only main.py starts the executor, so the hook processes do not pay to import asyncio
+    executor = sys.modules.get("AZTEC.executor")
 
-    if re.match( "cfgutil: error: no devices found", results["stderr"] ):
-        sys.exit(1)
+    # Errors marked "retry" are given one more attempt
+    for attempt in range(2):
 
-    # Verify success
-    # if not results["success"]:
-    #     device_logger.error(
-    #         "Return Code:  {}\nstdout:  {}\nstderr:  {}".format(
-    #             results["exitcode"], results["stdout"], results["stderr"]))
+        # Limit how many of each operation (e.g. restore) run at once across the host
+        with limiter.slot(operation, ECID):
 
-    # Load the JSON into an Object
-    json_data = utilities.parse_json(results["stdout"])
-    # device_logger.debug("cfgutil > execute > json_data:  {}".format(json_data))
-    check_for_errors(ECID, json_data)
+            if executor and executor.is_running():
 
-    try:
-        return results, json_data["Output"][ECID]
-    except:
-        return results, json_data
+                # Stream the output from main.py's event loop, to follow the command's progress
+                try:
+                    results = executor.executor.execute(
+                        "cfgutil --ecid {} --format JSON {}".format(ECID, command), ECID, timeout)
 
+                except executor.CancelledError:
+                    utilities.log_setup(log_name=ECID).warning(
+                        "\u26A0 `cfgutil {}` was cancelled".format(operation))
+                    sys.exit(1)
 
-def check_for_errors(ECID, json_data):
-    """Checks the output from a `cfgutil --format JSON` command against known error codes.
-    If an error was present for the provided ECID, an appropriate action is taken.
+            else:
+                results = utilities.execute_process(
+                    "cfgutil --ecid {} --format JSON {}".format(ECID, command), timeout)
 
-    Args:
-        ECID (str): ECID of a device
-        json_data (dict): json dict to parse
-    """
+        # The slot has been released, whether or not the command hung
+        if results["timed_out"]:
+            handle_timeout(ECID, operation, timeout)
 
-    device_logger = utilities.log_setup(log_name=ECID)
+        if re.match( "cfgutil: error: no devices found", results["stderr"] ):
+            sys.exit(1)
 
-    # Get the device's details
-    with Query() as run:
-        device = run.execute('SELECT * FROM devices WHERE ECID = ?', 
-            (ECID,)).fetchone()
+        # Load the JSON into an Object
+        json_data = utilities.parse_json(results["stdout"])
 
-    # try:
+        if check_for_errors(ECID, json_data, operation).action != "retry":
+            break
 
-    if isinstance(json_data, dict):
+    try:
+        return results, json_data["Output"][ECID]
+    except:
+        return results, json_data
 
-        if (
-            "AffectedDevices" in json_data.keys() and 
-            ECID in json_data["AffectedDevices"]
-        ):
 
-            if json_data["Code"] == 401:
-                device_logger.error(
-                    "\u26A0\U0001F6D1\u26A0 Mac is out of date!\n\tError Message:  {}".format(
-                        json_data["Message"]))
-                sys.exit(1)
+# Known cfgutil errors and the action taken for each, checked in order.  An error is
+# matched on where it was reported ("AffectedDevices" when the command failed for
+# the device, "Errors" when the command's output has an error for the device) and,
+# optionally, on its code, message and the operation, e.g. "get".  The last entry for
+# each source matches any error.  The actions are:
+#   erase:  erase the device and try again, once its backoff has passed, unless it has
+#       failed settings.RETRY_LIMIT times, then it is quarantined
+#   check:  mark the device to be checked again on its next attach and exit
+#   abort:  exit, the device cannot be provisioned on this Mac
+#   retry:  run the command once more
+#   None:  only log the error
+ERRORS = (
+    {
+        "name": "mac_out_of_date",
+        "source": "AffectedDevices",
+        "codes": { 401 },
+        "action": "abort",
+        "level": "error",
+        "log": "\u26A0\U0001F6D1\u26A0 Mac is out of date!\n\tError Message:  {message}"
+    },
+    {
+        # Error Code:  33001 / 607?
+        "name": "configuration_unavailable",
+        "source": "AffectedDevices",
+        "codes": { 33001 },
+        "action": "erase",
+        "level": "error",
+        "log": "\u26A0 Failed to prepare device, trying again.\n\tError:  {message}"
+    },
+    {
+        "name": "not_activated",
+        "source": "AffectedDevices",
+        "message": "The device is not activated.",
+        "action": "erase",
+        "level": "error",
+        "log": "\U0001F6D1 Unable to prepare device.\n\tError:  {message}"
+    },
+    {
+        "name": "already_prepared",
+        "source": "AffectedDevices",
+        "message": "The device is already prepared and must be erased to change settings.",
+        "action": "erase",
+        "level": "warning",
+        "log": "Device was already prepared, erasing it..."
+    },
+    {
+        # Unknown error, erase and try again
+        "name": "unaccounted_failure",
+        "source": "AffectedDevices",
+        "action": "erase",
+        "level": "error",
+        "log": "\U0001F6D1 Unaccounted for failure.\n\tError was:  {error}"
+    },
+    {
+        "name": "pairing_failed",
+        "source": "Errors",
+        "codes": { -402653030 },
+        "action": "erase",
+        "level": "warning",
+        "log": "\u26A0 Unable to pair with device, erasing..."
+    },
+    {
+        # Device may have successfully Prepared, but was unable to capture that accurately
+        "name": "state_unknown",
+        "source": "Errors",
+        "codes": { -402653052, 603 },
+        "action": "check",
+        "level": "warning",
+        "log": "\u26A0 Unable to determine device state, it will be reevaluated on next attach"
+    },
+    {
+        # Only `get` is safe to run again; rerunning an erase, prepare or restore could
+        # take minutes or wipe the device again
+        "name": "unaccounted_device_error",
+        "source": "Errors",
+        "operations": { "get" },
+        "action": "retry",
+        "level": "warning",
+        "log": "\u26A0 Unaccounted for device error, trying again.\n\tError was:  {error}"
+    },
+    {
+        "name": "ignored_device_error",
+        "source": "Errors",
+        "action": None,
+        "level": "warning",
+        "log": "\u26A0 Unaccounted for device error.\n\tError was:  {error}"
+    }
+)
+
+# Number of times each error (by name) was seen in this process
+statistics = {}
+statistics_lock = threading.Lock()
+
+
+class Result():
+    """The outcome of checking a cfgutil command's output for a device's errors.
+
+    Attributes:
+        ECID (str):  ECID of the device
+        rule (dict):  The entry of ERRORS the error matched, or None if there was no error
+        error (dict):  The error as cfgutil reported it
+    """
 
-            # Error Code:  33001 / 607?
-            elif json_data["Code"] == 33001:
-                # Message: "The configuration is not available."
+    def __init__(self, ECID, rule=None, error=None):
+        self.ECID = ECID
+        self.rule = rule
+        self.error = error or {}
 
-                device_logger.error(
-                    "\u26A0 Failed to prepare device, trying again.\n\tError:  {}".format(
-                    json_data["Message"]))
+    @property
+    def ok(self):
+        return self.rule is None
 
-                # Erase device
-                actions.erase_device(device)
+    @property
+    def name(self):
+        return self.rule["name"] if self.rule else None
 
-            # Error Code:  ?
-            elif json_data["Message"] == "The device is not activated.":
+    @property
+    def action(self):
+        return self.rule["action"] if self.rule else None
 
-                device_logger.error(
-                    "\U0001F6D1 Unable to prepare device.\n\tError:  {}".format(
-                    json_data["Message"]))
+    @property
+    def code(self):
+        return self.error.get("Code")
 
-                # Erase device
-                actions.erase_device(device)
+    @property
+    def message(self):
+        return self.error.get("Message")
 
-            # Error Code:  ?
-            elif ( json_data["Message"] == 
-                "The device is already prepared and must be erased to change settings." ):
+    def __repr__(self):
+        return "Result(ECID={!r}, name={!r}, code={!r})".format(self.ECID, self.name, self.code)
 
-                # If the device was already prepared, erase it
-                device_logger.warning("Device was already prepared, erasing it...")
 
-                # Erase device
-                actions.erase_device(device)
+def classify(ECID, json_data, operation=None):
+    """Finds the device's error, if any, in the output of a `cfgutil --format JSON` command.
 
-            else:
+    This only looks at the output, so a successful command costs no database access.
 
-                # Unknown error, erase and try again
-                device_logger.error(
-                    "\U0001F6D1 Unaccounted for failure.\n\tError was:  {}".format(json_data))
+    Args:
+        ECID (str): ECID of a device
+        json_data (dict): json dict to parse
+        operation (str, optional):  The command's operation, e.g. "get"
 
-                # Erase device
-                actions.erase_device(device)
+    Returns:
+        Result:  The device's error and the entry of ERRORS it matched
+    """
 
-        elif (
-            utilities.keys_exists(json_data, "Output", "Errors", ECID) and 
-            bool(json_data["Output"]["Errors"][ECID])
-        ):
+    if not isinstance(json_data, dict):
+        return Result(ECID)
 
-            json_data = json_data["Output"]["Errors"]
+    if ECID in ( json_data.get("AffectedDevices") or () ):
+        source, error = "AffectedDevices", json_data
 
-            if json_data[ECID]["Code"] == -402653030:
-                device_logger.warning("\u26A0 Unable to pair with device, erasing...")
+    elif ( utilities.keys_exists(json_data, "Output", "Errors", ECID) and 
+        bool(json_data["Output"]["Errors"][ECID]) ):
+        source, error = "Errors", json_data["Output"]["Errors"][ECID]
 
-                # Erase device
-                actions.erase_device(device)
+    else:
+        return Result(ECID)
 
-                # or:
-                # device_logger.info(
-                #     "Policy prevents device from pairing with this computer, no futher information can be gathered!")
+    # The last entry for each source matches any error
+    rule = next( rule for rule in ERRORS if
+        rule["source"] == source and 
+        ( "codes" not in rule or error.get("Code") in rule["codes"] ) and 
+        ( "message" not in rule or error.get("Message") == rule["message"] ) and 
+        ( "operations" not in rule or operation in rule["operations"] ) )
 
-                # Add the end time to the database
-                # device.report_end_time(device)
+    return Result(ECID, rule, error)
 
-            # Error Code 603 / -402653052
-            elif json_data[ECID]["Code"] in { -402653052, 603 }:
 
-                # Device may have successfully Prepared, but was unable to capture that accurately
-                device_logger.warning(
-                    "\u26A0 Unable to determine device state, it will be reevaluated on next attach")
+def get_statistics():
+    """Returns a copy of this process' error counters.
 
-                # Update status in the database
-                with Query() as run:
-                    run.execute('UPDATE devices SET status = ? WHERE ECID = ?', 
-                        ("check", ECID))
+    Returns:
+        dict:  Name of each error -> number of times it was seen
+    """
+
+    with statistics_lock:
+        return dict(statistics)
 
-                sys.exit(0)
 
-    # except:
-    #     device_logger.debug("check_for_errors > json_data:  {}".format(json_data))
-    #     device_logger.error("Failed to parse the json_data for errors!\nError was:\n{}\n\nExiting".format(traceback.format_exc()))
-    #     sys.exit(1)
+def check_for_errors(ECID, json_data, operation=None):
+    """Checks the output from a `cfgutil --format JSON` command against known error codes.
+    If an error was present for the provided ECID, an appropriate action is taken.
 
+    Args:
+        ECID (str): ECID of a device
+        json_data (dict): json dict to parse
+        operation (str, optional):  The command's operation, e.g. "get"
 
-def clean_configurator_temp_dir():
-    """Find the Apple Configurator temporary directory where files are
-    temporarily extracted and deletes the subdirectories that have not been accessed
-    in more than thirty minutes.  This directory can become bloated and is not
-    automatically cleaned up by the cfgutil process.
+    Returns:
+        Result:  The device's error, if any
     """
 
-    main_logger = utilities.log_setup()
+    result = classify(ECID, json_data, operation)
 
-    # Get the time stamp thirty minutes in the past.
-    reference_time = (datetime.datetime.now() - datetime.timedelta(seconds=1800)).timestamp()
+    if result.ok:
+        return result
 
-    # Walk the directory provided for recipes
-    for root, folders, files in os.walk("/private/var/folders"):
+    with statistics_lock:
+        statistics[result.name] = statistics.get(result.name, 0) + 1
 
-        # Loop through the folders to find the desired folder
-        for folder in folders:
+    if result.rule.get("log"):
+        device_logger = utilities.log_setup(log_name=ECID)
+        getattr(device_logger, result.rule["level"])(result.rule["log"].format(
+            code=result.code, message=result.message, error=result.error))
 
-            # Find the specific folder
-            if re.search('com.apple.configurator.xpc.DeviceService', folder):
+    if result.action == "abort":
+        sys.exit(1)
 
-                os.chmod(os.path.join(root, folder), stat.S_IRWXU | stat.S_IRGRP | stat.S_IWGRP)
+    elif result.action == "erase":
 
-                # Loop through the folders to find the desired folder
-                for sub_folder in os.scandir(os.path.join(root, folder)):
+        # The device is provisioned (erased) again once its backoff has passed, which 
+        # counts against its retry budget
+        workflow.retry(ECID, result.name)
 
-                    # Confirm item is a folder and check the name
-                    if sub_folder.is_dir() and sub_folder.name == "TemporaryItems":
+        sys.exit(1)
 
-                        # Change permissions so that the group can read the folder
-                        os.chmod(sub_folder.path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IWGRP)
+    elif result.action == "check":
 
-                        # Loop through the sub folders
-                        for sub_sub_folder in os.scandir(sub_folder.path):
+        # Update status in the database
+        workflow.transition(ECID, "check", result.name)
 
-                            # Again, confirm item is a folder and check it's last access time
-                            if ( sub_sub_folder.is_dir() and 
-                                os.path.getatime(sub_sub_folder) < reference_time and 
-                                utilities.is_string_GUID(sub_sub_folder.name) 
-                            ):
+        sys.exit(0)
 
-                                # Delete the directory:
-                                main_logger.info("Deleting temporary directory:  {}".format(
-                                    sub_sub_folder.name))
-                                shutil.rmtree(sub_sub_folder.path)
+    return result
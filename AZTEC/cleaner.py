@@ -0,0 +1,465 @@
+import datetime
+import os
+import shutil
+import stat
+import threading
+import time
+
+from AZTEC import settings, utilities
+from AZTEC.db_utils import Query
+
+
+# The Configurator temporary directory sits at <scan root>/<xx>/<random>/<C|T>/<DeviceService>
+SCAN_DEPTH = 4
+DEVICE_SERVICE = "com.apple.configurator.xpc.DeviceService"
+
+# Seconds the TemporaryItems directories found by a scan are used for before scanning
+# again, so that those of new users or sessions are found
+RESCAN_INTERVAL = 300
+
+# TemporaryItems directories found by earlier scans
+known_locations = []
+known_locations_lock = threading.Lock()
+last_scan = None
+
+# Directories deleted in the background and the bytes reclaimed, in this process
+statistics = { "removed": 0, "reclaimed": 0 }
+statistics_lock = threading.Lock()
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the worker pool that deletes directories, creating it on first use.
+
+    Returns:
+        ThreadPoolExecutor:  The worker pool
+    """
+
+    global executor
+
+    # Imported here as it is only needed once there is something to delete
+    import concurrent.futures
+
+    with executor_lock:
+
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=settings.CLEANUP_WORKERS, thread_name_prefix="AZTEC-cleaner")
+
+    return executor
+
+
+def scan(root, depth=SCAN_DEPTH):
+    """Finds the Configurator TemporaryItems directories below the root, without
+    descending further than the DeviceService directory can be.
+
+    Args:
+        root (str):  The directory to scan
+        depth (int, optional):  Number of levels below the root to look
+
+    Returns:
+        list:  Paths to the TemporaryItems directories
+    """
+
+    locations = []
+
+    try:
+        entries = list(os.scandir(root))
+
+    except OSError:
+        return locations
+
+    for entry in entries:
+
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+
+        if DEVICE_SERVICE in entry.name:
+
+            os.chmod(entry.path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IWGRP)
+            temporary_items = os.path.join(entry.path, "TemporaryItems")
+
+            if os.path.isdir(temporary_items):
+
+                # Change permissions so that the group can read the folder
+                os.chmod(temporary_items, stat.S_IRWXU | stat.S_IRGRP | stat.S_IWGRP)
+                locations.append(temporary_items)
+
+        elif depth > 1:
+            locations.extend(scan(entry.path, depth - 1))
+
+    return locations
+
+
+def get_locations():
+    """Returns the TemporaryItems directories, only scanning for them again every
+    RESCAN_INTERVAL seconds, or when none of the previously found directories exist anymore.
+
+    Returns:
+        list:  Paths to the TemporaryItems directories
+    """
+
+    global last_scan
+
+    with known_locations_lock:
+
+        locations = [ location for location in known_locations if os.path.isdir(location) ]
+
+        if not locations or time.monotonic() - last_scan > RESCAN_INTERVAL:
+            locations = scan(settings.CONFIGURATOR_SCAN_ROOT)
+            last_scan = time.monotonic()
+
+        known_locations[:] = locations
+
+        return list(locations)
+
+
+def directory_size(path):
+    """Gets the total size of the files in a directory tree.
+
+    Args:
+        path (str):  The directory
+
+    Returns:
+        int:  Size in bytes
+    """
+
+    size = 0
+
+    for root, folders, files in os.walk(path):
+
+        for file in files:
+
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+
+            except OSError:
+                pass
+
+    return size
+
+
+def remove(path):
+    """Deletes a directory tree.
+
+    Args:
+        path (str):  The directory to delete
+
+    Returns:
+        int:  Number of bytes reclaimed
+    """
+
+    size = directory_size(path)
+    shutil.rmtree(path, ignore_errors=True)
+
+    return size
+
+
+def delete(path):
+    """Deletes a directory tree on the worker pool, without waiting for it.
+
+    Args:
+        path (str):  The directory to delete
+
+    Returns:
+        concurrent.futures.Future:  The number of bytes reclaimed
+    """
+
+    deletion = get_executor().submit(remove, path)
+    deletion.add_done_callback(lambda deletion: deleted(path, deletion))
+
+    return deletion
+
+
+def deleted(path, deletion):
+    """Counts and logs a directory once the worker pool has deleted it.
+
+    Args:
+        path (str):  The directory
+        deletion (concurrent.futures.Future):  The deletion
+    """
+
+    if deletion.cancelled() or deletion.exception():
+        return
+
+    with statistics_lock:
+        statistics["removed"] += 1
+        statistics["reclaimed"] += deletion.result()
+
+    main_logger = utilities.log_setup()
+    main_logger.info("\U0001F9F9 Removed temporary directory {}, reclaimed {}".format(
+        os.path.basename(path), utilities.HumanBytes.format(deletion.result())))
+
+
+def summarize(deletions, started):
+    """Logs how many directories a clean up pass removed and the bytes it reclaimed,
+    once the last of its deletions has finished.
+
+    Args:
+        deletions (list):  The pass' deletions, which run in the background
+        started (float):  `time.monotonic()` value of when the pass started
+    """
+
+    summary = { "pending": len(deletions), "removed": 0, "reclaimed": 0 }
+    summary_lock = threading.Lock()
+
+    def finished(deletion):
+
+        with summary_lock:
+
+            summary["pending"] -= 1
+
+            if not deletion.cancelled() and not deletion.exception():
+                summary["removed"] += 1
+                summary["reclaimed"] += deletion.result()
+
+            if summary["pending"]:
+                return
+
+        main_logger = utilities.log_setup()
+        main_logger.info("\U0001F9F9 Clean up pass removed {} temporary directories, reclaimed {} "
+            "in {:.1f}s".format(summary["removed"], utilities.HumanBytes.format(summary["reclaimed"]), 
+            time.monotonic() - started))
+
+    for deletion in deletions:
+        deletion.add_done_callback(finished)
+
+
+def get_statistics():
+    """Returns the number of directories deleted in the background and the bytes reclaimed.
+
+    Returns:
+        dict:  This process' deletion statistics
+    """
+
+    with statistics_lock:
+        return dict(statistics)
+
+
+def get_extractions():
+    """Lists the firmware extraction directories in the TemporaryItems directories.
+
+    Returns:
+        set:  Paths to the extraction directories
+    """
+
+    extractions = set()
+
+    for location in get_locations():
+
+        for sub_folder in os.scandir(location):
+
+            if sub_folder.is_dir() and utilities.is_string_GUID(sub_folder.name):
+                extractions.add(sub_folder.path)
+
+    return extractions
+
+
+def record_usage(extractions):
+    """Records how much space the extraction directories are using.
+
+    Args:
+        extractions (set):  Paths to the extraction directories
+
+    Returns:
+        int:  Size in bytes
+    """
+
+    usage = sum( directory_size(path) for path in extractions )
+
+    with Query() as run:
+        run.execute("INSERT INTO temp_dir_usage ( measured, bytes ) VALUES (?, ?)",
+            (time.time(), usage))
+
+    return usage
+
+
+def get_peak_usage(since):
+    """Gets the most space the extraction directories were seen using.
+
+    Args:
+        since (float):  Epoch time to start from, e.g. when `main.py` was started
+
+    Returns:
+        int:  Size in bytes
+    """
+
+    with Query() as run:
+        return run.execute("SELECT MAX(bytes) FROM temp_dir_usage WHERE measured >= ?",
+            (since,)).fetchone()[0] or 0
+
+
+def finish_abandoned(run):
+    """Finishes the restores of processes that exited without finishing them.
+
+    Args:
+        run (Cursor):  A cursor within an open transaction
+    """
+
+    for row in run.execute("SELECT id, pid FROM restores WHERE finished IS NULL").fetchall():
+
+        if not utilities.is_process_running(row["pid"]):
+            run.execute("UPDATE restores SET finished = ? WHERE id = ?", (time.time(), row["id"]))
+
+
+def begin_restore(ECID):
+    """Registers a restore so that the firmware extraction directories that appear
+    while it runs are kept until it has finished.
+
+    Args:
+        ECID (str):  ECID of the device being restored
+
+    Returns:
+        dict:  The restore's ID and the extraction directories that existed before it started
+    """
+
+    snapshot = get_extractions()
+
+    with Query() as run:
+
+        run.execute("BEGIN IMMEDIATE")
+        restore = run.execute("INSERT INTO restores ( ECID, pid, started ) VALUES (?, ?, ?)",
+            (ECID, os.getpid(), time.time())).lastrowid
+
+        # Kept for the clean up job, which must not delete what the restore creates
+        run.executemany("INSERT INTO restore_snapshots ( restore, path ) VALUES (?, ?)",
+            [ (restore, path) for path in snapshot ])
+
+    return { "id": restore, "snapshot": snapshot }
+
+
+def end_restore(restore):
+    """Releases a restore's extraction directories and deletes those that no
+    other restore is still using.
+
+    Every directory that appeared since the restore started is referenced by each
+    restore that is still running, as any one of them may have created it; so a
+    directory is only deleted once the last of them has finished.  Directories
+    that are never released, e.g. if AZTEC is killed, are left to the thirty
+    minute sweep in `clean_configurator_temp_dir`.
+
+    Args:
+        restore (dict):  The restore returned by `begin_restore`
+
+    Returns:
+        list:  The deletions, which run in the background
+    """
+
+    main_logger = utilities.log_setup()
+    extractions = get_extractions()
+    created = extractions - restore["snapshot"]
+
+    with Query() as run:
+
+        run.execute("BEGIN IMMEDIATE")
+
+        finish_abandoned(run)
+
+        running = [ row["id"] for row in run.execute(
+            "SELECT id FROM restores WHERE finished IS NULL").fetchall() ]
+        tracked = { row["path"] for row in run.execute(
+            "SELECT DISTINCT path FROM extraction_references").fetchall() }
+
+        run.executemany("INSERT INTO extraction_references ( path, restore ) VALUES (?, ?)",
+            [ (path, user) for path in created - tracked for user in running ])
+
+        run.execute("UPDATE restores SET finished = ? WHERE id = ?", (time.time(), restore["id"]))
+
+        # Release the references of every finished restore
+        released = { row["path"] for row in run.execute(
+            """SELECT path FROM extraction_references WHERE restore IN
+            ( SELECT id FROM restores WHERE finished IS NOT NULL )""").fetchall() }
+        run.execute(
+            "DELETE FROM extraction_references WHERE restore IN ( SELECT id FROM restores WHERE finished IS NOT NULL )")
+        run.execute(
+            "DELETE FROM restore_snapshots WHERE restore IN ( SELECT id FROM restores WHERE finished IS NOT NULL )")
+        in_use = { row["path"] for row in run.execute(
+            "SELECT DISTINCT path FROM extraction_references").fetchall() }
+
+    # Measure before deleting, as this is when the most space is being used
+    record_usage(extractions)
+
+    deletions = [ delete(path) for path in released - in_use if os.path.isdir(path) ]
+
+    if deletions:
+        main_logger.info("\U0001F9F9 Removing {} firmware extraction directories...".format(len(deletions)))
+
+    return deletions
+
+
+def clean_configurator_temp_dir():
+    """Find the Apple Configurator temporary directory where files are
+    temporarily extracted and deletes the subdirectories that have not been accessed
+    in more than thirty minutes.  This directory can become bloated and is not
+    automatically cleaned up by the cfgutil process.
+
+    Directories that appeared since a running restore started are never deleted, as
+    access times are not reliable (e.g. volumes mounted with relaxed atime).
+
+    The directories are deleted in the background; each is logged once it is gone,
+    and the pass' totals once the last of them is.
+
+    Returns:
+        dict:  Statistics of the pass; scan time, the deletions and the time taken
+    """
+
+    main_logger = utilities.log_setup()
+    started = time.monotonic()
+
+    # Get the time stamp thirty minutes in the past.
+    reference_time = (datetime.datetime.now() - datetime.timedelta(seconds=1800)).timestamp()
+
+    deletions = []
+    extractions = get_extractions()
+
+    # Directories a running restore may still be using are left for `end_restore`
+    with Query() as run:
+        run.execute("BEGIN IMMEDIATE")
+        finish_abandoned(run)
+        run.execute(
+            "DELETE FROM extraction_references WHERE restore IN ( SELECT id FROM restores WHERE finished IS NOT NULL )")
+        run.execute(
+            "DELETE FROM restore_snapshots WHERE restore IN ( SELECT id FROM restores WHERE finished IS NOT NULL )")
+        in_use = { row["path"] for row in run.execute(
+            "SELECT DISTINCT path FROM extraction_references").fetchall() }
+
+        oldest = run.execute("SELECT min(id) FROM restores WHERE finished IS NULL").fetchone()[0]
+
+        # Any directory that appeared since the oldest running restore started may be
+        # one a running restore is extracting to, however stale its access time
+        if oldest is not None:
+            snapshot = { row["path"] for row in run.execute(
+                "SELECT path FROM restore_snapshots WHERE restore = ?", (oldest,)).fetchall() }
+            in_use |= extractions - snapshot
+
+    scan_time = time.monotonic() - started
+
+    for path in sorted(extractions - in_use):
+
+        # Check it's last access time
+        if os.path.getatime(path) < reference_time:
+
+            # Delete the directory:
+            main_logger.info("Deleting temporary directory:  {}".format(os.path.basename(path)))
+            deletions.append(delete(path))
+
+    if extractions:
+        record_usage(extractions)
+
+    pass_statistics = {
+        "scan_time": scan_time,
+        "deletions": deletions,
+        "duration": time.monotonic() - started
+    }
+
+    if deletions:
+        main_logger.info("\U0001F9F9 Removing {} temporary directories... (scan {:.2f}s)".format(
+            len(deletions), scan_time))
+        summarize(deletions, started)
+
+    else:
+        main_logger.debug("No temporary directories to remove (scan {:.2f}s)".format(scan_time))
+
+    return pass_statistics
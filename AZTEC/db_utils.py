@@ -1,37 +1,390 @@
-import random
+import os
 import sqlite3
 import sys
+import threading
 import time
 
+from AZTEC import settings
+
+
+# Each thread (and process) keeps its connections open and reuses them
+connections = threading.local()
+
+# Counters to make database contention visible
+statistics = { "connections": 0, "statements": 0, "lock_waits": 0, "retries": 0 }
+statistics_lock = threading.Lock()
+
+
+def count(**counters):
+    """Increments the database statistics counters.
+
+    Args:
+        counters (int):  The amount to increment each counter by
+    """
+
+    with statistics_lock:
+
+        for counter, amount in counters.items():
+            statistics[counter] += amount
+
+
+def get_statistics():
+    """Returns a copy of this process' database statistics.
+
+    Returns:
+        dict:  Connections opened, statements executed, statements that had to wait
+            on a lock and the number of retries
+    """
+
+    with statistics_lock:
+        return dict(statistics)
+
+
+class Cursor(sqlite3.Cursor):
+    """A cursor that retries statements while the database is locked by another writer."""
+
+    timeout = 10
+
+    def execute(self, *args):
+        return self.retry(super().execute, *args)
+
+    def executemany(self, *args):
+        return self.retry(super().executemany, *args)
+
+    def retry(self, function, *args):
+        """Runs a statement, retrying with backoff while the database is locked.
+
+        SQLite itself waits up to `busy_timeout` for a lock; each time that runs
+        out, the wait is counted and the statement is retried until `timeout`.
+
+        A statement inside an open transaction is not retried:  if the transaction
+        is reading an older snapshot of the database, retrying cannot succeed, so
+        the error is raised for the caller to roll back and start the transaction
+        again.  Transactions that write should be started with `BEGIN IMMEDIATE`,
+        which is retried, so that their statements never wait on a lock.
+        """
+
+        deadline = time.monotonic() + self.timeout
+        delay = 0.05
+        retries = 0
+
+        count(statements=1)
+
+        while True:
+
+            try:
+                return function(*args)
+
+            except sqlite3.OperationalError as error:
+
+                if ( "locked" not in str(error) or self.connection.in_transaction or 
+                    time.monotonic() > deadline ):
+                    raise
+
+                count(lock_waits=int(retries == 0), retries=1)
+                retries += 1
+
+                time.sleep(delay)
+                delay = min(delay * 2, 1)
+
+
+def get_connection(database):
+    """Returns this thread's connection to the database, opening it if needed.
+
+    Args:
+        database (str):  The database file
+
+    Returns:
+        sqlite3.Connection:  A connection to the database
+    """
+
+    key = ( os.getpid(), os.path.abspath(database) )
+
+    if not hasattr(connections, "pool"):
+        connections.pool = {}
+
+    pool = connections.pool
+
+    if key not in pool:
+
+        db_connection = sqlite3.connect(database, timeout=settings.DATABASE_BUSY_TIMEOUT / 1000, 
+            cached_statements=256)
+        db_connection.isolation_level = None
+        db_connection.row_factory = sqlite3.Row
+
+        cursor = db_connection.cursor(factory=Cursor)
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+
+        pool[key] = db_connection
+        count(connections=1)
+
+    return pool[key]
+
 
 class Query():
-    """A Class that creates a Context Manager to interact with a sqlite database."""
+    """A Class that creates a Context Manager to interact with a sqlite database.
+
+    Connections are pooled per thread and the database runs in WAL mode, so
+    readers do not block the writer and statements are only retried when
+    another writer holds the lock for longer than the busy timeout.
+    """
 
     def __init__(self, database="devices.db", timeout=10):
         self.database = database
         self.timeout = timeout
 
     def __enter__(self):
-        """Opens a connection to the database"""
+        """Gets a connection to the database"""
 
-        self.db_connection = sqlite3.connect(self.database, timeout=self.timeout)
-        self.db_connection.isolation_level = None
-        self.db_connection.row_factory = sqlite3.Row
+        self.db_connection = get_connection(self.database)
 
-        # Check if there is a ongoing transaction
-        if self.db_connection.in_transaction:
-            print("Sleep")
-            time.sleep(random.uniform(1, 3))
+        cursor = self.db_connection.cursor(factory=Cursor)
+        cursor.timeout = self.timeout
 
-        return self.db_connection.cursor()
+        return cursor
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        """Commits and closing connection to the database"""
-        # Commit the transaction
-        self.db_connection.commit()
+        """Commits (or rolls back) an open transaction; the connection is kept for reuse"""
+
+        if self.db_connection.in_transaction:
+
+            if exc_type:
+                self.db_connection.rollback()
+
+            else:
+                self.db_connection.commit()
+
+
+# Each migration is a list of statements that upgrades the schema by one version.
+# The database's current version is tracked with `PRAGMA user_version`, so new
+# migrations must only ever be appended to this list.
+MIGRATIONS = [
+
+    # Version 1:  The original schema
+    [
+        """ CREATE TABLE IF NOT EXISTS devices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT,
+            ECID TEXT NOT NULL,
+            SerialNumber TEXT,
+            UDID TEXT,
+            deviceType TEXT,
+            buildVersion TEXT,
+            firmwareVersion TEXT,
+            locationID TEXT,
+            activationState TEXT,
+            bootedState TEXT,
+            isSupervised TEXT,
+            batteryCurrentCapacity INT,
+            batteryIsCharging TEXT
+        ); """,
+        """ CREATE TABLE IF NOT EXISTS report (
+            id INTEGER,
+            start_time INTEGER,
+            end_time INTEGER
+        ); """
+    ],
+
+    # Version 2:  Unique ECIDs and a keyed report table
+    [
+        # Remove duplicate records created by overlapping hooks, keeping the newest
+        "DELETE FROM devices WHERE id NOT IN ( SELECT MAX(id) FROM devices GROUP BY ECID )",
+        "CREATE UNIQUE INDEX IF NOT EXISTS devices_ECID ON devices ( ECID )",
+        """ CREATE TABLE report_keyed (
+            id INTEGER PRIMARY KEY,
+            start_time INTEGER,
+            end_time INTEGER
+        ); """,
+        """ INSERT INTO report_keyed ( id, start_time, end_time ) 
+            SELECT id, MIN(start_time), MAX(end_time) FROM report WHERE id IS NOT NULL GROUP BY id """,
+        "DROP TABLE report",
+        "ALTER TABLE report_keyed RENAME TO report"
+    ],
+
+    # Version 3:  Host-wide operation slots and their queue wait times
+    [
+        """ CREATE TABLE operation_slots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            operation TEXT NOT NULL,
+            ECID TEXT NOT NULL,
+            pid INTEGER NOT NULL,
+            enqueued REAL NOT NULL,
+            started REAL
+        ); """,
+        "CREATE INDEX operation_slots_operation ON operation_slots ( operation, started )",
+        """ CREATE TABLE operation_waits (
+            ECID TEXT NOT NULL,
+            operation TEXT NOT NULL,
+            enqueued REAL NOT NULL,
+            wait REAL NOT NULL
+        ); """
+    ],
+
+    # Version 4:  Firmware extraction directories referenced by each restore
+    [
+        """ CREATE TABLE restores (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ECID TEXT NOT NULL,
+            pid INTEGER NOT NULL,
+            started REAL NOT NULL,
+            finished REAL
+        ); """,
+        """ CREATE TABLE extraction_references (
+            path TEXT NOT NULL,
+            restore INTEGER NOT NULL,
+            PRIMARY KEY ( path, restore )
+        ); """,
+        """ CREATE TABLE temp_dir_usage (
+            measured REAL NOT NULL,
+            bytes INTEGER NOT NULL
+        ); """
+    ],
+
+    # Version 5:  How long each device spent in each stage of provisioning
+    [
+        """ CREATE TABLE stage_timings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ECID TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            started REAL NOT NULL,
+            started_monotonic REAL NOT NULL,
+            finished_monotonic REAL,
+            duration REAL
+        ); """,
+        "CREATE INDEX stage_timings_open ON stage_timings ( ECID ) WHERE duration IS NULL",
+        "CREATE INDEX stage_timings_stage ON stage_timings ( stage, duration )"
+    ],
+
+    # Version 6:  Completed devices and the throughput rollups built from them
+    [
+        """ CREATE TABLE completions (
+            id INTEGER PRIMARY KEY,
+            ECID TEXT NOT NULL,
+            SerialNumber TEXT,
+            deviceType TEXT,
+            firmwareVersion TEXT,
+            start_time REAL,
+            end_time REAL NOT NULL,
+            duration REAL NOT NULL
+        ); """,
+        """ CREATE TABLE rollup_totals (
+            dimension TEXT NOT NULL,
+            value TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            duration REAL NOT NULL,
+            PRIMARY KEY ( dimension, value )
+        ); """,
+        """ CREATE TABLE rollup_histograms (
+            dimension TEXT NOT NULL,
+            value TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY ( dimension, value, bucket )
+        ); """,
+        """ CREATE TABLE hourly_completions (
+            hour INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL
+        ); """,
+        # Keep the devices that have already been provisioned; their rollups are built on first use
+        """ INSERT INTO completions 
+            ( id, ECID, SerialNumber, deviceType, firmwareVersion, start_time, end_time, duration ) 
+            SELECT report.id, devices.ECID, devices.SerialNumber, devices.deviceType, 
+            devices.firmwareVersion, report.start_time, report.end_time, 
+            report.end_time - report.start_time 
+            FROM report JOIN devices ON devices.id = report.id 
+            WHERE report.end_time IS NOT NULL AND report.start_time IS NOT NULL """
+    ],
+
+    # Version 7:  Log files that have been back-filled into the timing tables
+    [
+        """ CREATE TABLE backfilled_logs (
+            path TEXT PRIMARY KEY,
+            imported REAL NOT NULL
+        ); """
+    ],
+
+    # Version 8:  Progress of each device's running cfgutil command
+    [
+        "ALTER TABLE devices ADD COLUMN progress REAL",
+        "ALTER TABLE devices ADD COLUMN progress_updated REAL"
+    ],
 
-        # Close the connection
-        self.db_connection.close()
+    # Version 9:  cfgutil commands that were stopped for running past their timeout
+    [
+        """ CREATE TABLE command_timeouts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ECID TEXT NOT NULL,
+            locationID TEXT,
+            operation TEXT NOT NULL,
+            timeout REAL NOT NULL,
+            occurred REAL NOT NULL
+        ); """,
+        "CREATE INDEX command_timeouts_locationID ON command_timeouts ( locationID )"
+    ],
+
+    # Version 10:  Every change of a device's status
+    [
+        """ CREATE TABLE state_transitions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ECID TEXT NOT NULL,
+            from_status TEXT,
+            to_status TEXT NOT NULL,
+            reason TEXT,
+            occurred REAL NOT NULL
+        ); """,
+        "CREATE INDEX state_transitions_ECID ON state_transitions ( ECID )"
+    ],
+
+    # Version 11:  Failed attempts to provision each device, for its retry budget
+    [
+        "ALTER TABLE devices ADD COLUMN failures INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE devices ADD COLUMN last_failure TEXT"
+    ],
+
+    # Version 12:  Stages back-filled from logs, whose open stages are never finished
+    [
+        "ALTER TABLE stage_timings ADD COLUMN backfilled INTEGER NOT NULL DEFAULT 0"
+    ],
+
+    # Version 13:  When a device that failed is due to be tried again
+    [
+        "ALTER TABLE devices ADD COLUMN retry_after REAL"
+    ],
+
+    # Version 14:  The extraction directories that existed when each restore started
+    [
+        """ CREATE TABLE restore_snapshots (
+            restore INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY ( restore, path )
+        ); """
+    ]
+
+]
+
+
+def migrate(database):
+    """
+    A helper function to create or upgrade a database's schema to the latest version.
+
+    Args:
+        database:  The name of the database file to migrate
+    """
+
+    with Query(database=database) as run:
+
+        run.execute("BEGIN IMMEDIATE")
+        version = run.execute("PRAGMA user_version").fetchone()[0]
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+
+            print("Upgrading the database to version {}...".format(number))
+
+            for statement in migration:
+                run.execute(statement)
+
+            run.execute("PRAGMA user_version = {}".format(number))
 
 
 def init_db(database):
@@ -44,57 +397,12 @@ def init_db(database):
 
     print("Initalizing the database...\n")
 
-    # Check if the tables exist
+    # Create the tables or upgrade them to the latest schema
+    migrate(database)
+
+    # Purge the devices table
     with Query(database=database) as run:
-        result_devices = run.execute( 
-            "SELECT count(name) FROM sqlite_master WHERE type='table' AND name='devices'" 
-                ).fetchone()
-        result_report = run.execute( 
-            "SELECT count(name) FROM sqlite_master WHERE type='table' AND name='report'" 
-                ).fetchone()
-
-    # 1 = exists
-    if result_devices[0] != 1:
-
-        devices_table = """ CREATE TABLE devices (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            status TEXT,
-                            ECID TEXT NOT NULL,
-                            SerialNumber TEXT,
-                            UDID TEXT,
-                            deviceType TEXT,
-                            buildVersion TEXT,
-                            firmwareVersion TEXT,
-                            locationID TEXT,
-                            activationState TEXT,
-                            bootedState TEXT,
-                            isSupervised TEXT,
-                            batteryCurrentCapacity INT,
-                            batteryIsCharging TEXT
-                        ); """
-
-        # Create the devices table
-        with Query() as run:
-            results = run.execute(devices_table)
-
-    else:
-
-        # Purge the devices table
-        with Query() as run:
-            run.execute( "DELETE FROM devices" )
-
-    # 1 = exists
-    if result_report[0] != 1:
-        
-        report_table = """ CREATE TABLE IF NOT EXISTS report (
-                            id INTEGER,
-                            start_time INTEGER,
-                            end_time INTEGER
-                        ); """
-
-        # Create the report table
-        with Query() as run:
-            results = run.execute(report_table)
+        run.execute( "DELETE FROM devices" )
 
 
 if __name__ == "__main__":
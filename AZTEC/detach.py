@@ -1,17 +1,25 @@
 import os
+import sys
 
-from AZTEC import utilities
+from AZTEC import timing, utilities, workflow
 from AZTEC.db_utils import Query
 
 
-def main():
-    """Handles the detach logic; called from cfgutil --on-detach."""
+def main(environment=None):
+    """Handles the detach logic; called from cfgutil --on-detach.
+
+    Args:
+        environment (dict, optional):  The cfgutil environment variables for the event.
+            Defaults to os.environ
+    """
+
+    environment = environment or os.environ
 
     main_logger = utilities.log_setup()
 
     # Get the sessions' device ECID (this will be our primary unique 
     # identifier for this device during for subsequent sessions )
-    session_ECID = os.getenv('ECID')
+    session_ECID = environment.get('ECID')
 
     if not session_ECID:
 
@@ -29,6 +37,15 @@ def main():
             device = run.execute('SELECT * FROM devices WHERE ECID = ?', 
                 (session_ECID,)).fetchone()
 
+        # A device reboots, so is detached, while it is being erased or restored;
+        # otherwise it was unplugged and its running commands are stopped
+        executor = sys.modules.get("AZTEC.executor")
+
+        if executor and device and device["status"] not in { "erase_warning", "erasing" }:
+
+            if executor.cancel(session_ECID):
+                device_logger.info("\u23F9 Stopped the device's running commands")
+
         # If a device was retrived
         if device:
 
@@ -38,9 +55,17 @@ def main():
                 device_logger.info("\U0001F4A5 Erased device!")
 
                 # Update status in the database
-                with Query() as run:
-                    results = run.execute('UPDATE devices SET status = ? WHERE ECID = ?', 
-                        ("erased", session_ECID))
+                workflow.transition(session_ECID, "erased", "detached")
+
+                # The device is rebooting until it attaches again
+                timing.enter(session_ECID, "reboot")
+
+            # Check device's current state
+            elif device['status'] == "quarantined":
+
+                # Keep its record, so it is not provisioned again if it is plugged back in
+                device_logger.info(
+                    "\U0001F6A7 Quarantined device unplugged, it will not be provisioned until it is released")
 
             # Check device's current state
             elif device['status'] == "done":
@@ -49,7 +74,9 @@ def main():
 
                 # Delete device's record in the devices table
                 with Query() as run:
+                    run.execute("BEGIN IMMEDIATE")
                     run.execute("DELETE FROM devices WHERE ECID = ?", (session_ECID,))
+                    workflow.record(run, session_ECID, "done", "removed", "detached")
 
                 device_logger.info("\U0001F44C Device removed from queue")
 
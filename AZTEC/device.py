@@ -1,21 +1,71 @@
 import os
-import plistlib
+import threading
 import time
 
-from pkg_resources import parse_version
-
-import requests
-
 from AZTEC import cfgutil
+from AZTEC import firmware
+from AZTEC import poller
+from AZTEC import rollups
+from AZTEC import timing
 from AZTEC import utilities
+from AZTEC import workflow
 from AZTEC.db_utils import Query
 
 
-def get_session_info(ECID):
+# Static properties of each device seen by this process, keyed by ECID
+static_properties = {}
+static_properties_lock = threading.Lock()
+
+
+def get_static_properties(ECID, environment):
+    """Gets the properties of a device that never change, e.g. its serial number.
+
+    They are taken from the cfgutil environment, the device's existing record,
+    or are cached from an earlier full `cfgutil get`, in that order.
+
+    Args:
+        ECID (str): ECID of a device
+        environment (dict): The cfgutil environment variables for the event
+
+    Returns:
+        dict:  The static properties that are known; may be incomplete
+    """
+
+    with static_properties_lock:
+        properties = dict(static_properties.get(ECID, {}))
+
+    properties.update( { key: environment[key] for key in poller.STATIC_PROPERTIES 
+        if key != "serialNumber" and environment.get(key) } )
+
+    if len(properties) < len(poller.STATIC_PROPERTIES):
+
+        with Query() as run:
+            device = run.execute('SELECT * FROM devices WHERE ECID = ?', (ECID,)).fetchone()
+
+        if device:
+
+            record = dict(device, serialNumber=device["SerialNumber"])
+
+            for key in poller.STATIC_PROPERTIES:
+
+                if not properties.get(key) and record[key]:
+                    properties[key] = record[key]
+
+    with static_properties_lock:
+        static_properties[ECID] = properties
+
+    return properties
+
+
+def get_session_info(ECID, environment=None):
     """Gets the provided ECID's current session info.
 
+    Only the properties that change are polled once the static properties are known.
+
     Args:
         ECID (str): ECID of a device
+        environment (dict, optional): The cfgutil environment variables for the event.
+            Defaults to os.environ
 
     Returns:  
         json_data (dict):  Dict object of the device's current status
@@ -24,12 +74,33 @@ def get_session_info(ECID):
     device_logger = utilities.log_setup(log_name=ECID)
     device_logger.debug("Getting session info...")
 
-    results_get_session_info, json_data = cfgutil.execute( ECID,
-        "get activationState bootedState isSupervised UDID serialNumber deviceType buildVersion \
-            firmwareVersion locationID batteryCurrentCapacity batteryIsCharging" )
+    static = get_static_properties(ECID, environment or os.environ)
+
+    if len(static) == len(poller.STATIC_PROPERTIES):
+
+        # Use the shared poller when running in the dispatcher
+        json_data = poller.get_properties(ECID)
+
+        if json_data:
+            return dict(static, **json_data)
+
+        properties = poller.VOLATILE_PROPERTIES
+
+    else:
+        properties = poller.STATIC_PROPERTIES + poller.VOLATILE_PROPERTIES
+
+    # Otherwise, or if the device reported an error, query (and handle errors for) just this device
+    results_get_session_info, json_data = cfgutil.execute( ECID, 
+        "get {}".format(" ".join(properties)) )
 
     # Verify success
     if results_get_session_info["success"]:
+
+        json_data = dict(json_data, **static)
+
+        with static_properties_lock:
+            static_properties[ECID] = { key: json_data[key] for key in poller.STATIC_PROPERTIES }
+
         return json_data
 
     # device_logger.error(
@@ -40,90 +111,98 @@ def get_session_info(ECID):
 
     # Try again
     time.sleep(5)
-    get_session_info(ECID)
+    return get_session_info(ECID, environment)
 
 
-def create_or_update_record(ECID, status=None):
+def create_or_update_record(ECID, status=None, environment=None):
     """Create or update a record in the database.
 
+    The record is only written when the device's status or properties have changed.
+
     Args:
         ECID (str): ECID of a device
         status (str): The "status" to label a device in the database
+        environment (dict, optional): The cfgutil environment variables for the event.
+            Defaults to os.environ
 
     Returns:
         device (dict): Dict object of the devices' record in the database
     """
 
     device_logger = utilities.log_setup(log_name=ECID)
-    session_info_full = get_session_info(ECID)
-
-    activationState = session_info_full["activationState"]
-    batteryCurrentCapacity = session_info_full["batteryCurrentCapacity"]
-    batteryIsCharging = "True" if session_info_full["batteryIsCharging"] else "False"
-    bootedState = session_info_full["bootedState"]
-    buildVersion = os.getenv("buildVersion") or session_info_full["buildVersion"]
-    deviceType = os.getenv("deviceType") or session_info_full["deviceType"]
-    firmwareVersion = os.getenv("firmwareVersion") or session_info_full["firmwareVersion"]
-    locationID = os.getenv("locationID") or session_info_full["locationID"]
-    isSupervised = "True" if session_info_full["isSupervised"] else "False"
-    serial_number = session_info_full["serialNumber"]
-    udid = os.getenv("UDID") or session_info_full["UDID"]
-
-    # Check if device has been added to database
+    session_info_full = get_session_info(ECID, environment)
+
+    record = {
+        "UDID": session_info_full["UDID"],
+        "SerialNumber": session_info_full["serialNumber"],
+        "deviceType": session_info_full["deviceType"],
+        "buildVersion": session_info_full["buildVersion"],
+        "firmwareVersion": session_info_full["firmwareVersion"],
+        "locationID": session_info_full["locationID"],
+        "activationState": session_info_full["activationState"],
+        "bootedState": session_info_full["bootedState"],
+        "isSupervised": "True" if session_info_full["isSupervised"] else "False",
+        "batteryCurrentCapacity": session_info_full["batteryCurrentCapacity"],
+        "batteryIsCharging": "True" if session_info_full["batteryIsCharging"] else "False"
+    }
+
+    # A status of "new" never overwrites the status of a device that is already in the queue
+    if status == "new":
+        status = None
+
+    # Check if anything has changed since the record was last written
     with Query() as run:
         device = run.execute('SELECT * FROM devices WHERE ECID = ?', 
             (ECID,)).fetchone()
 
-    if not device:
-        # Device is not in the queue, so needs to be erased.
-        device_logger.info("\u2795 Adding device to queue...")
+    if ( device and status in { None, device["status"] } and 
+        all( device[column] == value for column, value in record.items() ) ):
+        return device
 
-        with Query() as run:
-            # Add device to database
-            results = run.execute(
-                """INSERT INTO devices 
-                ( status, ECID, UDID, SerialNumber, deviceType, buildVersion, firmwareVersion, 
-                locationID, activationState, bootedState, isSupervised, batteryCurrentCapacity, 
-                batteryIsCharging ) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                ( "new", ECID, udid, serial_number, deviceType, buildVersion, firmwareVersion, 
-                locationID, activationState, bootedState, isSupervised, batteryCurrentCapacity, 
-                batteryIsCharging ) 
-            )
-
-            # Get current epoch time
-            currentTime = time.time()
-
-            # Update the report table
-            run.execute("INSERT INTO report (id, start_time) VALUES (?, ?)", 
-                (results.lastrowid, currentTime) )
+    with Query() as run:
 
-    else:
+        run.execute("BEGIN IMMEDIATE")
+
+        # Add the device to the database, or update it if it is already in the queue
+        device = run.execute(
+            """INSERT INTO devices 
+            ( status, ECID, UDID, SerialNumber, deviceType, buildVersion, firmwareVersion, 
+            locationID, activationState, bootedState, isSupervised, batteryCurrentCapacity, 
+            batteryIsCharging ) 
+            VALUES (COALESCE(:status, 'new'), :ECID, :UDID, :SerialNumber, :deviceType, 
+            :buildVersion, :firmwareVersion, :locationID, :activationState, :bootedState, 
+            :isSupervised, :batteryCurrentCapacity, :batteryIsCharging) 
+            ON CONFLICT (ECID) DO UPDATE SET 
+            status = COALESCE(:status, status), UDID = excluded.UDID, 
+            SerialNumber = excluded.SerialNumber, deviceType = excluded.deviceType, 
+            buildVersion = excluded.buildVersion, firmwareVersion = excluded.firmwareVersion, 
+            locationID = excluded.locationID, activationState = excluded.activationState, 
+            bootedState = excluded.bootedState, isSupervised = excluded.isSupervised, 
+            batteryCurrentCapacity = excluded.batteryCurrentCapacity, 
+            batteryIsCharging = excluded.batteryIsCharging 
+            RETURNING *""",
+            dict(record, status=status, ECID=ECID)
+        ).fetchone()
+
+        # Get current epoch time
+        currentTime = time.time()
+
+        # Start the report for a device that was just added to the queue
+        added = run.execute(
+            "INSERT INTO report (id, start_time) VALUES (?, ?) ON CONFLICT (id) DO NOTHING", 
+            (device["id"], currentTime) ).rowcount
+
+        if added:
+            workflow.record(run, ECID, None, device["status"], "attached")
+
+    if added:
+        # Device was not in the queue, so needs to be erased.
+        device_logger.info("\u2795 Adding device to queue...")
 
+    else:
         # Device is already in the queue.
         device_logger.info("\u2795 Updating queue...")
 
-        if not status or status == "new":
-            status = device["status"]
-
-        # Update status in the database
-        with Query() as run:
-            results = run.execute(
-                """UPDATE devices SET 
-                status = ?, UDID = ?, SerialNumber = ?, deviceType = ?, buildVersion = ?, 
-                firmwareVersion = ?, locationID = ?, activationState = ?, bootedState = ?, 
-                isSupervised = ?, batteryCurrentCapacity = ?, batteryIsCharging = ? 
-                WHERE ECID = ?""",
-                (status, udid, serial_number, deviceType, buildVersion, firmwareVersion, 
-                locationID, activationState, bootedState, isSupervised, batteryCurrentCapacity, 
-                batteryIsCharging, ECID)
-            )
-
-    # Get the device's details
-    with Query() as run:
-        device = run.execute('SELECT * FROM devices WHERE ECID = ?', 
-            (ECID,)).fetchone()
-
     return device
 
 
@@ -141,11 +220,16 @@ def report_end_time(device):
 
     # Update status and end time in the database
     with Query() as run:
-        run.execute('UPDATE devices SET status = ? WHERE ECID = ?', 
-            ("done", device["ECID"]))
+        run.execute("BEGIN IMMEDIATE")
+        workflow.transition(device["ECID"], "done", "complete", run)
         run.execute('UPDATE report SET end_time = ? WHERE id = ?', 
             (currentTime, device["id"]))
 
+        # Keep the device's details for reporting, as its record is deleted once it is unplugged
+        rollups.record_completion(run, device["ECID"], currentTime)
+
+    timing.finish(device["ECID"])
+
     # Successfully Prepared device
     device_logger.info("\U0001F7E2 [DONE] Device has been provisioned, it can be unplugged!")
 
@@ -153,6 +237,9 @@ def report_end_time(device):
 def firmware_check(model):
     """Gets the latest compatible firmware version of a iOS, iPadOS, or tvOS Device.
 
+    The lookup is done against the cached firmware catalog (see AZTEC.firmware),
+    which is only downloaded again once it has expired and changed.
+
     Args:
         model:  Device mode, e.g. "iPad6,11"
 
@@ -160,36 +247,10 @@ def firmware_check(model):
         stdout:  latest firmware version as str, e.g. "13.6" or None
     """
 
-    # Create a list to add compatible firmwares too
-    all_fw = []
-
-    # Look up current version results
-    # response = urllib.request.urlopen("http://phobos.apple.com/version").read()
-    # response = urllib.request.urlopen("http://ax.phobos.apple.com.edgesuite.net/WebObjects/MZStore.woa/wa/com.apple.jingle.appserver.client.MZITunesClientCheck/version/").read()
-    response = requests.get(
-        "http://ax.phobos.apple.com.edgesuite.net/WebObjects/MZStore.woa/wa/com.apple.jingle.appserver.client.MZITunesClientCheck/version/")
-    content = plistlib.loads(response.text.encode("utf-8"))
-
-    # Get the dict item that contains the info required
-    keys = content.get('MobileDeviceSoftwareVersionsByVersion')
-
-    # Loop through the items in this dict
-    for item in keys:
-
-        try:
-            # Try to find the supplied in this dict
-            firmware_version = keys.get(item).get('MobileDeviceSoftwareVersions').get('{}'.format(
-                model)).get("Unknown").get("Universal").get("Restore").get('ProductVersion')
-
-            # Add firmware to list if found
-            all_fw.append(firmware_version)
-
-        except:
-            pass
+    latest = firmware.latest_firmware(model)
 
-    if all_fw:
-        # Sort the firmware list so that the newest if item 0 and grab that
-        return sorted(all_fw, key=parse_version, reverse=True)[0]
+    if latest:
+        return latest["ProductVersion"]
 
     else:
         return None
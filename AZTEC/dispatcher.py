@@ -0,0 +1,221 @@
+import concurrent.futures
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from AZTEC import attach, detach, settings, utilities, workflow
+
+
+class EventHandler(socketserver.StreamRequestHandler):
+    """Reads a single attach/detach event sent by one of the shell hooks.
+
+    The protocol is line based:  the first line is the event name ("attach" or
+    "detach"), followed by one `KEY=value` line per cfgutil environment variable,
+    and the event is terminated by an empty line.
+    """
+
+    def handle(self):
+        """Runs when a hook connects to the dispatcher."""
+
+        received = time.monotonic()
+        event = self.rfile.readline().decode("utf-8").strip()
+        environment = {}
+
+        for line in self.rfile:
+
+            line = line.decode("utf-8").rstrip("\r\n")
+
+            if not line:
+                break
+
+            key, _, value = line.partition("=")
+            environment[key] = value
+
+        if self.server.dispatch(event, environment, received):
+            self.wfile.write(b"OK\n")
+
+        else:
+            self.wfile.write(b"ERROR\n")
+
+
+class Dispatcher(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """A resident server that accepts attach/detach events over a Unix socket and
+    runs the attach/detach workflows on a pool of worker threads, instead of
+    starting a new Python process for every event.
+
+    It also keeps the environment of every attached device, so that a device whose
+    workflow failed is attached again once its retry backoff has passed.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=None, workers=None, handlers=None):
+
+        self.socket_path = socket_path or settings.DISPATCHER_SOCKET
+        self.handlers = handlers or { "attach": attach.main, "detach": detach.main }
+        self.latencies = []
+        self.attached = {}
+        self.attached_lock = threading.Lock()
+        self.retry_job = None
+
+        # Remove a socket left behind by a previous run
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        super().__init__(self.socket_path, EventHandler)
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or settings.DISPATCHER_WORKERS, thread_name_prefix="AZTEC")
+
+        # A detach is quick, but must not wait for a worker behind workflows that hold
+        # theirs for a whole erase, restore or prepare (e.g. the detach that marks a
+        # device as erased)
+        self.detach_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings.DISPATCHER_DETACH_WORKERS, thread_name_prefix="AZTEC-detach")
+
+
+    def dispatch(self, event, environment, received):
+        """Queues an event to be handled by a worker thread.
+
+        Args:
+            event (str):  Name of the event, e.g. "attach" or "detach"
+            environment (dict):  The cfgutil environment variables for the event
+            received (float):  `time.monotonic()` value of when the event was received
+
+        Returns:
+            bool:  Whether the event was accepted
+        """
+
+        handler = self.handlers.get(event)
+
+        if not handler:
+            main_logger = utilities.log_setup()
+            main_logger.error("\U0001F6D1 Received an unknown event:  {}".format(event))
+            return False
+
+        if environment.get("ECID"):
+
+            with self.attached_lock:
+
+                if event == "attach":
+                    self.attached[environment["ECID"]] = environment
+
+                elif event == "detach":
+                    self.attached.pop(environment["ECID"], None)
+
+        executor = self.detach_executor if event == "detach" else self.executor
+        executor.submit(self.run_handler, handler, environment, received)
+
+        return True
+
+
+    def dispatch_retries(self):
+        """Queues an attach event for each attached device whose retry backoff has passed."""
+
+        with self.attached_lock:
+            attached = dict(self.attached)
+
+        if not attached:
+            return
+
+        try:
+            devices = workflow.take_due(sorted(attached))
+
+        except Exception:
+            main_logger = utilities.log_setup()
+            main_logger.exception("\U0001F6D1 Failed to look up the devices due to be tried again")
+            return
+
+        for device in devices:
+
+            device_logger = utilities.log_setup(log_name=device["ECID"])
+            device_logger.info("\u21BB Trying the device again...")
+
+            self.dispatch("attach", attached[device["ECID"]], time.monotonic())
+
+
+    def run_handler(self, handler, environment, received):
+        """Runs an event handler on a worker thread.
+
+        Args:
+            handler (function):  The workflow to run, e.g. `attach.main`
+            environment (dict):  The cfgutil environment variables for the event
+            received (float):  `time.monotonic()` value of when the event was received
+        """
+
+        latency = time.monotonic() - received
+        self.latencies.append(latency)
+
+        try:
+
+            if environment.get("ECID"):
+                device_logger = utilities.log_setup(log_name=environment["ECID"])
+                device_logger.debug("Event dispatched in {:.1f} ms".format(latency * 1000))
+
+            handler(environment)
+
+        except SystemExit:
+            # The workflows call sys.exit() to stop working on a device
+            pass
+
+        except Exception:
+            main_logger = utilities.log_setup()
+            main_logger.exception(
+                "\U0001F6D1 Unhandled error while processing event for:  {}".format(
+                    environment.get("ECID")))
+
+
+    def start(self):
+        """Starts accepting events, and trying failed devices again, in background threads."""
+
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+        self.retry_job = utilities.Periodic(
+            function = self.dispatch_retries, 
+            interval = settings.RETRY_CHECK_INTERVAL, 
+            event = threading.Event()
+        )
+        self.retry_job.daemon = True
+        self.retry_job.start()
+
+
+    def stop(self):
+        """Stops accepting events and removes the socket."""
+
+        if self.retry_job:
+            self.retry_job.cancel()
+
+        self.shutdown()
+        self.server_close()
+        self.executor.shutdown(wait=False)
+        self.detach_executor.shutdown(wait=False)
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def send_event(event, environment, socket_path=None):
+    """Sends an event to a running dispatcher; this is what the shell hooks do with `nc`.
+
+    Args:
+        event (str):  Name of the event, e.g. "attach" or "detach"
+        environment (dict):  The cfgutil environment variables for the event
+        socket_path (str, optional):  The dispatcher's socket.
+            Defaults to settings.DISPATCHER_SOCKET
+
+    Returns:
+        bool:  Whether the dispatcher accepted the event
+    """
+
+    message = "{}\n{}\n".format(event, "".join(
+        "{}={}\n".format(key, value) for key, value in environment.items() ))
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path or settings.DISPATCHER_SOCKET)
+        client.sendall(message.encode("utf-8"))
+        response = client.makefile().readline().strip()
+
+    return response == "OK"
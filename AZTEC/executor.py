@@ -0,0 +1,378 @@
+import asyncio
+import concurrent.futures
+import re
+import shlex
+import signal
+import threading
+import time
+
+from concurrent.futures import CancelledError
+
+from AZTEC import utilities
+from AZTEC.db_utils import Query
+
+
+# Progress cfgutil reports while a command runs, e.g. "Step 2 of 4: Restoring 45%"
+PROGRESS_PERCENT = re.compile(r"(\d{1,3}(?:\.\d+)?)\s?%")
+PROGRESS_STEP = re.compile(r"[Ss]tep (\d+) of (\d+)")
+
+# Minimum change in a device's progress, in percent, before it is written to the database
+PROGRESS_RESOLUTION = 1
+
+# Bytes read from a command's stdout or stderr at a time; lines may be any length, as
+# `cfgutil --format JSON` prints its whole document on one line
+READ_SIZE = 65536
+
+
+def parse_progress(line):
+    """Finds the progress in a line of cfgutil's output.
+
+    Args:
+        line (str):  A line of stdout or stderr
+
+    Returns:
+        float:  Percent complete, or None if the line does not report progress
+    """
+
+    step = PROGRESS_STEP.search(line)
+    percent = PROGRESS_PERCENT.search(line)
+
+    if percent:
+        percent = min(float(percent.group(1)), 100)
+
+    if step:
+
+        # Spread the percentage over the steps, e.g. 50% of step 2 of 4 is 37.5%
+        current, total = int(step.group(1)), int(step.group(2))
+
+        if total:
+            return ( current - 1 + ( percent or 0 ) / 100 ) / total * 100
+
+    return percent
+
+
+class ProcessExecutor():
+    """Runs commands from a single asyncio event loop, on a background thread.
+
+    Unlike `utilities.execute_process`, which ties up a thread until the command
+    exits, any number of commands can run at once; their stdout and stderr are
+    read line by line as they are written, so the progress of each device's
+    command is known while it runs, and a device's command can be cancelled.
+
+    Nothing that blocks runs on the event loop:  progress is written to the
+    database by a separate thread, in the order it was reported.
+    """
+
+    def __init__(self):
+
+        self.loop = None
+        self.thread = None
+        self.writer = None
+        self.lock = threading.Lock()
+        self.running = {}
+        self.progress = {}
+        self.statistics = { "commands": 0, "cancelled": 0, "progress_updates": 0 }
+
+
+    def start(self):
+        """Starts the event loop."""
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="ProcessExecutor", daemon=True)
+        self.thread.start()
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="AZTEC-progress")
+
+
+    def stop(self):
+        """Cancels the running commands and stops the event loop."""
+
+        if not self.loop:
+            return
+
+        self.cancel()
+
+        # Wait for the cancelled commands to be killed
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(timeout=15)
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+        self.writer.shutdown()
+
+
+    async def shutdown(self):
+        """Cancels every task on the event loop and waits for them to finish."""
+
+        tasks = [ task for task in asyncio.all_tasks() if task is not asyncio.current_task() ]
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+    async def run(self, command, on_line=None, timeout=None):
+        """Runs a command, handing each line of its output to a callback as it is written.
+
+        Args:
+            command (str):  The command line level syntax that would be written in a
+                shell script or a terminal window
+            on_line (callable, optional):  Called with the stream's name ("stdout" or
+                "stderr") and each line
+            timeout (float, optional):  Seconds after which the command, and any
+                processes it started, are killed
+
+        Returns:
+            dict:  Results in the same dictionary as utilities.execute_process
+        """
+
+        # In its own process group, so that any processes it starts are stopped with it
+        process = await asyncio.create_subprocess_exec( *shlex.split(command),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True )
+
+        output = { "stdout": [], "stderr": [] }
+        timed_out = False
+        exited = False
+
+        async def read(name, stream):
+
+            # Read in chunks rather than lines, as StreamReader cannot read a line
+            # longer than its buffer
+            line = b""
+
+            while True:
+
+                chunk = await stream.read(READ_SIZE)
+                output[name].append(chunk)
+
+                if on_line:
+
+                    *lines, line = ( line + chunk ).split(b"\n")
+
+                    for complete in lines:
+                        on_line(name, complete.decode("utf-8", errors="replace"))
+
+                if not chunk:
+                    break
+
+            if on_line and line:
+                on_line(name, line.decode("utf-8", errors="replace"))
+
+        async def communicate():
+            await asyncio.gather( read("stdout", process.stdout), read("stderr", process.stderr) )
+            await process.wait()
+
+        try:
+            await asyncio.wait_for(communicate(), timeout)
+            exited = True
+
+        except asyncio.TimeoutError:
+            timed_out = True
+
+        finally:
+
+            # Whether it timed out, was cancelled or reading its output failed, stop the
+            # command and any processes it started, and reap it
+            if not exited:
+                await self.kill(process)
+
+        return {
+            "stdout": b"".join(output["stdout"]).decode("utf-8", errors="replace").strip(),
+            "stderr": b"".join(output["stderr"]).decode("utf-8", errors="replace").strip(),
+            "exitcode": process.returncode,
+            "success": process.returncode == 0 and not timed_out,
+            "timed_out": timed_out
+        }
+
+
+    async def kill(self, process):
+        """Stops a command and every process it started."""
+
+        # Give the command a moment to exit on its own before it is killed
+        utilities.signal_process_group(process.pid, signal.SIGTERM)
+
+        try:
+            await asyncio.wait_for(process.wait(), 5)
+
+        except asyncio.TimeoutError:
+            pass
+
+        utilities.signal_process_group(process.pid, signal.SIGKILL)
+        await process.wait()
+
+
+    def submit(self, command, ECID=None, timeout=None):
+        """Starts a command from any thread.
+
+        Args:
+            command (str):  The command to run
+            ECID (str, optional):  ECID of the device the command is for, to
+                track its progress and be able to cancel it
+            timeout (float, optional):  Seconds after which the command is killed
+
+        Returns:
+            concurrent.futures.Future:  The command's results
+        """
+
+        on_line = ( lambda name, line: self.update_progress(ECID, line) ) if ECID else None
+        future = asyncio.run_coroutine_threadsafe(self.run(command, on_line, timeout), self.loop)
+
+        with self.lock:
+            self.statistics["commands"] += 1
+
+            if ECID:
+                self.running.setdefault(ECID, set()).add(future)
+
+        if ECID:
+            future.add_done_callback(lambda future: self.finished(ECID, future))
+
+        return future
+
+
+    def execute(self, command, ECID=None, timeout=None):
+        """Runs a command and waits for its results, like `utilities.execute_process`.
+
+        Args:
+            command (str):  The command to run
+            ECID (str, optional):  ECID of the device the command is for
+            timeout (float, optional):  Seconds after which the command is killed
+
+        Returns:
+            dict:  Results in the same dictionary as utilities.execute_process
+
+        Raises:
+            CancelledError:  If the command was cancelled
+        """
+
+        return self.submit(command, ECID, timeout).result()
+
+
+    def cancel(self, ECID=None):
+        """Cancels a device's running commands, or every running command.
+
+        Args:
+            ECID (str, optional):  ECID of a device
+
+        Returns:
+            int:  The number of commands cancelled
+        """
+
+        with self.lock:
+            futures = [ future for device, running in self.running.items()
+                if ECID in { None, device } for future in running ]
+
+        cancelled = sum( future.cancel() for future in futures )
+
+        with self.lock:
+            self.statistics["cancelled"] += cancelled
+
+        return cancelled
+
+
+    def finished(self, ECID, future):
+        """Stops tracking a device's command once it has exited."""
+
+        with self.lock:
+
+            running = self.running.get(ECID, set())
+            running.discard(future)
+
+            if running:
+                return
+
+            self.running.pop(ECID, None)
+            reported = self.progress.pop(ECID, None) is not None
+
+        # The device has no command running anymore, so it has no progress
+        if reported:
+            self.writer.submit(self.write_progress, ECID, None)
+
+
+    def update_progress(self, ECID, line):
+        """Records a device's progress when a line of output reports it.
+
+        Runs on the event loop; the progress is only handed to the writer thread
+        when it has moved on by PROGRESS_RESOLUTION.
+
+        Args:
+            ECID (str):  ECID of a device
+            line (str):  A line of the command's output
+        """
+
+        percent = parse_progress(line)
+
+        if percent is None or abs(percent - self.progress.get(ECID, -100)) < PROGRESS_RESOLUTION:
+            return
+
+        with self.lock:
+            self.progress[ECID] = percent
+            self.statistics["progress_updates"] += 1
+
+        self.writer.submit(self.write_progress, ECID, percent, line.strip())
+
+
+    def write_progress(self, ECID, percent, line=None):
+        """Writes a device's progress to the database; runs on the writer thread.
+
+        Args:
+            ECID (str):  ECID of a device
+            percent (float):  Percent complete, or None once its command has finished
+            line (str, optional):  The line of output that reported it, for the log
+        """
+
+        # Update progress in the database
+        with Query() as run:
+            run.execute('UPDATE devices SET progress = ?, progress_updated = ? WHERE ECID = ?',
+                (percent, time.time(), ECID))
+
+        if percent is not None:
+            utilities.log_setup(log_name=ECID).debug("Progress:  {:.0f}%  ({})".format(percent, line))
+
+
+executor = None
+
+
+def start():
+    """Starts the shared executor for this process."""
+
+    global executor
+
+    executor = ProcessExecutor()
+    executor.start()
+
+
+def stop():
+    """Cancels the shared executor's commands and stops it."""
+
+    if executor:
+        executor.stop()
+
+
+def is_running():
+    """Returns whether this process has a running shared executor."""
+
+    return bool(executor and executor.loop)
+
+
+def cancel(ECID=None):
+    """Cancels a device's running commands, or every running command.
+
+    Args:
+        ECID (str, optional):  ECID of a device
+
+    Returns:
+        int:  The number of commands cancelled
+    """
+
+    return executor.cancel(ECID) if executor else 0
+
+
+def get_statistics():
+    """Returns the number of commands run and cancelled, and progress updates written.
+
+    Returns:
+        dict:  The shared executor's statistics
+    """
+
+    return dict(executor.statistics) if executor else {}
@@ -0,0 +1,247 @@
+import fcntl
+import json
+import os
+import threading
+import time
+
+from AZTEC import settings, utilities
+
+
+catalog_file = os.path.join(settings.CACHE_DIRECTORY, "firmware_catalog.json")
+catalog_lock_file = os.path.join(settings.CACHE_DIRECTORY, "firmware_catalog.lock")
+
+# Touched when a check for an updated catalog fails, so that every process waits out the retry interval
+catalog_failed_file = os.path.join(settings.CACHE_DIRECTORY, "firmware_catalog.failed")
+
+# The parsed catalog is kept in memory and reloaded only when the file on disk changes
+catalog_cache = { "mtime": None, "catalog": None }
+catalog_cache_lock = threading.Lock()
+refresh_lock = threading.Lock()
+
+session = None
+session_lock = threading.Lock()
+
+
+def get_session():
+    """Returns a requests Session that is shared by the process so that
+    connections to Apple's servers are pooled and reused.
+
+    Returns:
+        requests.Session:  The shared session
+    """
+
+    global session
+
+    # Imported here as it is only needed when the catalog has to be downloaded
+    import requests
+
+    with session_lock:
+
+        if session is None:
+            session = requests.Session()
+
+    return session
+
+
+def parse_catalog(content):
+    """Parses Apple's firmware version plist into an index of the latest firmware per model.
+
+    Args:
+        content (bytes):  The MZITunesClientCheck version plist
+
+    Returns:
+        dict:  Device model -> latest restore details, e.g.
+            { "iPad6,11": { "ProductVersion": "15.2", "BuildVersion": "19C56",
+                "FirmwareURL": "https://...ipsw", "FirmwareSHA1": "..." } }
+    """
+
+    import plistlib
+
+    index = {}
+    versions = plistlib.loads(content).get("MobileDeviceSoftwareVersionsByVersion", {})
+
+    for version in versions.values():
+
+        for model, builds in version.get("MobileDeviceSoftwareVersions", {}).items():
+
+            restore = builds.get("Unknown", {}).get("Universal", {}).get("Restore")
+
+            if not restore or "ProductVersion" not in restore:
+                continue
+
+            latest = index.get(model)
+
+            if ( not latest or utilities.version_key(restore["ProductVersion"]) >
+                utilities.version_key(latest["ProductVersion"]) ):
+
+                index[model] = {
+                    "ProductVersion": restore["ProductVersion"],
+                    "BuildVersion": restore.get("BuildVersion"),
+                    "FirmwareURL": restore.get("FirmwareURL"),
+                    "FirmwareSHA1": restore.get("FirmwareSHA1")
+                }
+
+    return index
+
+
+def load_catalog():
+    """Loads the cached catalog from disk, if it has changed since it was last loaded.
+
+    Returns:
+        dict:  The cached catalog or None if it has not been downloaded yet
+    """
+
+    try:
+        mtime = os.stat(catalog_file).st_mtime
+
+    except FileNotFoundError:
+        return None
+
+    with catalog_cache_lock:
+
+        if catalog_cache["mtime"] != mtime:
+
+            with open(catalog_file, "r") as cache:
+                catalog_cache["catalog"] = json.load(cache)
+
+            catalog_cache["mtime"] = mtime
+
+        return catalog_cache["catalog"]
+
+
+def save_catalog(catalog):
+    """Atomically writes the catalog to disk.
+
+    Args:
+        catalog (dict):  The catalog to save
+    """
+
+    temp_file = "{}.{}".format(catalog_file, os.getpid())
+
+    with open(temp_file, "w") as cache:
+        json.dump(catalog, cache)
+
+    os.replace(temp_file, catalog_file)
+
+
+def is_fresh(catalog):
+    """Checks if the catalog was downloaded or validated within the TTL.
+
+    Args:
+        catalog (dict):  A cached catalog
+
+    Returns:
+        bool:  Whether the catalog can be used without checking with Apple's servers
+    """
+
+    return bool(catalog) and time.time() - catalog["fetched"] < settings.FIRMWARE_CATALOG_TTL
+
+
+def has_failed():
+    """Checks if the last check for an updated catalog failed within the last
+    settings.FIRMWARE_CATALOG_RETRY_INTERVAL seconds.
+
+    Returns:
+        bool:  Whether Apple's servers should not be contacted yet
+    """
+
+    try:
+        return time.time() - os.path.getmtime(catalog_failed_file) < settings.FIRMWARE_CATALOG_RETRY_INTERVAL
+
+    except FileNotFoundError:
+        return False
+
+
+def refresh_catalog():
+    """Makes sure the cached firmware catalog is up to date.
+
+    Apple's servers are only contacted once the cached catalog is older than the
+    TTL, and then with a conditional GET so that the catalog is only downloaded
+    and parsed again when it has changed.  If the network is unavailable, the
+    catalog cannot be parsed, or offline mode is enabled, the cached catalog is used
+    as is; after a failure, the servers are not contacted again for
+    settings.FIRMWARE_CATALOG_RETRY_INTERVAL seconds.
+
+    Returns:
+        dict:  The cached catalog or None if it is not available
+    """
+
+    catalog = load_catalog()
+
+    if settings.OFFLINE or is_fresh(catalog) or has_failed():
+        return catalog
+
+    main_logger = utilities.log_setup()
+    os.makedirs(settings.CACHE_DIRECTORY, exist_ok=True)
+
+    # Only one thread or process refreshes the catalog; the others wait and use its result
+    with refresh_lock, open(catalog_lock_file, "w") as lock:
+
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        catalog = load_catalog()
+
+        if is_fresh(catalog) or has_failed():
+            return catalog
+
+        headers = {}
+
+        if catalog and catalog.get("etag"):
+            headers["If-None-Match"] = catalog["etag"]
+
+        if catalog and catalog.get("last_modified"):
+            headers["If-Modified-Since"] = catalog["last_modified"]
+
+        try:
+
+            response = get_session().get(settings.FIRMWARE_CATALOG_URL, headers=headers, timeout=60)
+            response.raise_for_status()
+
+            if response.status_code == 304:
+                main_logger.debug("Firmware catalog has not changed")
+                catalog["fetched"] = time.time()
+
+            else:
+                catalog = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "fetched": time.time(),
+                    "index": parse_catalog(response.content)
+                }
+                main_logger.info("\U0001F4E5 Downloaded an updated firmware catalog")
+
+        except Exception as error:
+            main_logger.warning(
+                "\u26A0 Unable to check for an updated firmware catalog, using the cached catalog."
+                "\n\tError:  {}".format(error))
+
+            # Record the failure, so the servers are not contacted on every attach
+            with open(catalog_failed_file, "w"):
+                pass
+
+            return catalog
+
+        save_catalog(catalog)
+
+        if os.path.exists(catalog_failed_file):
+            os.remove(catalog_failed_file)
+
+    return load_catalog()
+
+
+def latest_firmware(model):
+    """Looks up the latest firmware for a device model in the cached catalog.
+
+    Args:
+        model (str):  Device model, e.g. "iPad6,11"
+
+    Returns:
+        dict:  The latest restore details for the model or None if it is not in the catalog
+    """
+
+    catalog = refresh_catalog()
+
+    if not catalog:
+        return None
+
+    return catalog["index"].get(model)
@@ -0,0 +1,241 @@
+import fcntl
+import hashlib
+import os
+import threading
+import time
+
+from AZTEC import firmware, settings, utilities
+from AZTEC.db_utils import Query
+
+
+# The download of each firmware file that is in progress, so that concurrent requesters
+# wait for its result instead of each downloading it
+inflight = {}
+inflight_lock = threading.Lock()
+
+
+def library_path(latest):
+    """Returns where a firmware file is stored in the local library.
+
+    Args:
+        latest (dict):  Restore details from the firmware catalog
+
+    Returns:
+        str:  Path to the firmware file
+    """
+
+    return os.path.join(settings.IPSW_DIRECTORY, os.path.basename(latest["FirmwareURL"]))
+
+
+def is_staged(path, latest):
+    """Checks if a firmware file has been downloaded and verified.
+
+    Args:
+        path (str):  Path to the firmware file
+        latest (dict):  Restore details from the firmware catalog
+
+    Returns:
+        bool:  Whether the firmware file can be used
+    """
+
+    try:
+
+        with open("{}.sha1".format(path), "r") as verified:
+            checksum = verified.read().strip()
+
+    except FileNotFoundError:
+        return False
+
+    expected = latest.get("FirmwareSHA1")
+
+    return os.path.exists(path) and ( not expected or checksum == expected.lower() )
+
+
+def download(path, latest):
+    """Downloads a firmware file into the library and verifies its checksum.
+
+    Args:
+        path (str):  Path to save the firmware file to
+        latest (dict):  Restore details from the firmware catalog
+
+    Returns:
+        bool:  Whether the firmware file was downloaded and verified
+    """
+
+    main_logger = utilities.log_setup()
+    main_logger.info("\U0001F4E5 Downloading firmware {}...".format(os.path.basename(path)))
+
+    temp_file = "{}.part".format(path)
+    checksum = hashlib.sha1()
+
+    try:
+
+        with firmware.get_session().get(latest["FirmwareURL"], stream=True, timeout=60) as response:
+
+            response.raise_for_status()
+
+            with open(temp_file, "wb") as ipsw:
+
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    checksum.update(chunk)
+                    ipsw.write(chunk)
+
+    except Exception as error:
+        main_logger.error("\U0001F6D1 Failed to download firmware {}\n\tError:  {}".format(
+            os.path.basename(path), error))
+
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+        return False
+
+    if latest.get("FirmwareSHA1") and checksum.hexdigest() != latest["FirmwareSHA1"].lower():
+        main_logger.error("\U0001F6D1 Checksum mismatch for firmware {}, discarding it".format(
+            os.path.basename(path)))
+        os.remove(temp_file)
+        return False
+
+    os.replace(temp_file, path)
+
+    with open("{}.sha1".format(path), "w") as verified:
+        verified.write(checksum.hexdigest())
+
+    main_logger.info("\U0001F4BE Firmware {} ({}) added to the library".format(
+        os.path.basename(path), utilities.HumanBytes.format(os.path.getsize(path))))
+
+    return True
+
+
+def has_failed(path):
+    """Checks if downloading a firmware file failed within the last
+    settings.IPSW_FAILURE_BACKOFF seconds, in any process.
+
+    Args:
+        path (str):  Path to the firmware file
+
+    Returns:
+        bool:  Whether the download should not be tried yet
+    """
+
+    try:
+        return time.time() - os.path.getmtime("{}.failed".format(path)) < settings.IPSW_FAILURE_BACKOFF
+
+    except FileNotFoundError:
+        return False
+
+
+def fetch(path, latest):
+    """Downloads a firmware file, unless another process has (or failed to) while
+    this one waited for the lock.
+
+    Args:
+        path (str):  Path to the firmware file
+        latest (dict):  Restore details from the firmware catalog
+
+    Returns:
+        (tuple):  Path to the firmware file (or None if it is not available)
+            and whether this call downloaded it
+    """
+
+    with open("{}.lock".format(path), "w") as lock_file:
+
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        # Another requester may have downloaded it while this one was waiting
+        if is_staged(path, latest):
+            return path, False
+
+        if has_failed(path):
+            return None, False
+
+        if download(path, latest):
+
+            if os.path.exists("{}.failed".format(path)):
+                os.remove("{}.failed".format(path))
+
+            return path, True
+
+        # Record the failure, so the download is not tried again by every requester
+        with open("{}.failed".format(path), "w"):
+            pass
+
+    return None, False
+
+
+def stage(model):
+    """Makes sure the latest firmware for a device model is in the local library.
+
+    Each firmware file is only downloaded once; threads and processes that
+    request a firmware file that is being downloaded wait for that download and
+    share its result.  A download that failed is not tried again for
+    settings.IPSW_FAILURE_BACKOFF seconds, cfgutil downloads the firmware itself
+    until then.
+
+    Args:
+        model (str):  Device model, e.g. "iPad6,11"
+
+    Returns:
+        (tuple):  Path to the firmware file (or None if it is not available)
+            and whether this call downloaded it
+    """
+
+    latest = firmware.latest_firmware(model)
+
+    if not latest or not latest.get("FirmwareURL"):
+        return None, False
+
+    path = library_path(latest)
+
+    if is_staged(path, latest):
+        return path, False
+
+    # Firmware cannot be downloaded in offline mode
+    if settings.OFFLINE:
+        return None, False
+
+    if has_failed(path):
+        return None, False
+
+    os.makedirs(settings.IPSW_DIRECTORY, exist_ok=True)
+
+    # Imported here as it is only needed once there is something to download
+    import concurrent.futures
+
+    with inflight_lock:
+
+        staging = inflight.get(path)
+        owner = staging is None
+
+        if owner:
+            staging = inflight[path] = concurrent.futures.Future()
+
+    if not owner:
+        path, downloaded = staging.result()
+        return path, False
+
+    try:
+        result = fetch(path, latest)
+        staging.set_result(result)
+
+    except BaseException as error:
+        staging.set_exception(error)
+        raise
+
+    finally:
+
+        with inflight_lock:
+            inflight.pop(path, None)
+
+    return result
+
+
+def prestage():
+    """Stages the latest firmware for every device model in the devices table."""
+
+    with Query() as run:
+        models = run.execute("SELECT DISTINCT deviceType FROM devices").fetchall()
+
+    for model in models:
+
+        if model["deviceType"]:
+            stage(model["deviceType"])
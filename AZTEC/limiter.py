@@ -0,0 +1,262 @@
+import contextlib
+import os
+import sys
+import threading
+import time
+
+from AZTEC import cleaner, settings, timing, utilities, workflow
+from AZTEC.db_utils import Query
+
+
+# Seconds a queued ticket waits between checks, doubled while it is not woken up by a slot
+# of this process being released, as those of hook processes are only found by polling
+POLL_INTERVAL_MIN = 0.5
+POLL_INTERVAL_MAX = 5
+
+# Seconds between the scans for slots left behind by hook processes that exited
+REAP_INTERVAL = 5
+
+last_reclaim = None
+reclaim_lock = threading.Lock()
+
+# Notified, with the generation incremented, whenever this process releases a slot
+released = threading.Condition()
+generation = 0
+last_reap = None
+
+
+def has_disk_space(running):
+    """Checks if there will still be enough free disk space once another restore starts.
+
+    Every running restore, and the new one, is projected to use its full share of
+    disk space, as the firmware may not have been extracted yet.
+
+    Args:
+        running (int):  Number of restores that are currently running
+
+    Returns:
+        bool:  Whether another restore can start
+    """
+
+    total, used, free = utilities.get_disk_usage("/", human=False)
+
+    return free - ( running + 1 ) * settings.RESTORE_DISK_SPACE >= settings.DISK_FREE_RESERVE
+
+
+def reclaim_disk_space():
+    """Cleans up the Configurator temporary directory now, instead of waiting for the
+    background job; runs at most once every thirty seconds per process.
+    """
+
+    global last_reclaim
+
+    with reclaim_lock:
+
+        if last_reclaim and time.monotonic() - last_reclaim < 30:
+            return
+
+        last_reclaim = time.monotonic()
+        cleaner.clean_configurator_temp_dir()
+
+
+def reap(run):
+    """Releases the slots of hook processes that exited without releasing them; the
+    processes are only checked every REAP_INTERVAL seconds.
+
+    Args:
+        run (Cursor):  A cursor
+    """
+
+    global last_reap
+
+    if last_reap and time.monotonic() - last_reap < REAP_INTERVAL:
+        return
+
+    last_reap = time.monotonic()
+
+    exited = [ row["pid"] for row in run.execute("SELECT DISTINCT pid FROM operation_slots").fetchall() 
+        if not utilities.is_process_running(row["pid"]) ]
+
+    if exited:
+        run.execute("DELETE FROM operation_slots WHERE pid IN ( {} )".format(", ".join("?" * len(exited))), 
+            exited)
+
+
+def get_queue(run, ticket, operation):
+    """Counts the tickets of an operation that are running and that are queued ahead of a ticket.
+
+    Args:
+        run (Cursor):  A cursor
+        ticket (int):  The ticket's ID
+        operation (str):  The operation, e.g. "restore"
+
+    Returns:
+        tuple:  The number of running tickets and of tickets ahead
+    """
+
+    running = run.execute(
+        "SELECT count(*) FROM operation_slots WHERE operation = ? AND started IS NOT NULL", 
+        (operation,) ).fetchone()[0]
+    ahead = run.execute(
+        "SELECT count(*) FROM operation_slots WHERE operation = ? AND started IS NULL AND id < ?", 
+        (operation, ticket) ).fetchone()[0]
+
+    return running, ahead
+
+
+def try_acquire(ticket, operation, slots):
+    """Starts a queued ticket if a slot is free and every ticket ahead of it has been served.
+
+    Args:
+        ticket (int):  The ticket's ID
+        operation (str):  The operation, e.g. "restore"
+        slots (int):  Number of slots for the operation
+
+    Returns:
+        str:  "started" if the ticket was started, "queued" if it has to wait for a slot
+            or "deferred" if a slot is free but there is not enough free disk space
+    """
+
+    with Query() as run:
+
+        reap(run)
+
+        # Only take the write lock once the ticket looks like it can start
+        running, ahead = get_queue(run, ticket, operation)
+
+        if running + ahead >= slots:
+            return "queued"
+
+        run.execute("BEGIN IMMEDIATE")
+        running, ahead = get_queue(run, ticket, operation)
+
+        if running + ahead >= slots:
+            return "queued"
+
+        if operation == "restore" and not has_disk_space(running):
+            return "deferred"
+
+        run.execute("UPDATE operation_slots SET started = ? WHERE id = ?", (time.time(), ticket))
+
+    return "started"
+
+
+@contextlib.contextmanager
+def slot(operation, ECID):
+    """Holds one of an operation's host-wide slots while the block runs.
+
+    Slots are shared by every thread and hook process through the database and are
+    handed out in the order they were requested.  Waiting threads are woken up when
+    a slot of this process is released, and otherwise check with a growing interval.  Operations without a configured
+    number of slots are not limited.  A restore that is deferred for disk space for
+    longer than settings.DISK_SPACE_TIMEOUT gives up its place in the queue, and the
+    device is tried again later, which counts against its retry budget.
+
+    Args:
+        operation (str):  The operation, e.g. "restore"
+        ECID (str):  ECID of the device the operation is for
+    """
+
+    global generation
+
+    slots = settings.OPERATION_SLOTS.get(operation)
+
+    if not slots:
+        yield
+        return
+
+    device_logger = utilities.log_setup(log_name=ECID)
+    enqueued = time.time()
+
+    with Query() as run:
+        ticket = run.execute(
+            "INSERT INTO operation_slots ( operation, ECID, pid, enqueued ) VALUES (?, ?, ?, ?)", 
+            (operation, ECID, os.getpid(), enqueued) ).lastrowid
+
+    try:
+
+        with released:
+            seen = generation
+
+        state = try_acquire(ticket, operation, slots)
+        logged = set()
+        deferred = None
+        interval = POLL_INTERVAL_MIN
+
+        if state != "started":
+            timing.enter(ECID, "{}_queued".format(operation))
+
+        while state != "started":
+
+            if state == "deferred":
+
+                if state not in logged:
+                    device_logger.warning(
+                        "\U0001F4BE Not enough free disk space for another {}, deferring it...".format(operation))
+
+                deferred = deferred or time.monotonic()
+
+                if time.monotonic() - deferred > settings.DISK_SPACE_TIMEOUT:
+
+                    device_logger.error(
+                        "\U0001F4BE Not enough free disk space for a {} after {:g} seconds, "
+                        "giving up its place in the queue".format(operation, settings.DISK_SPACE_TIMEOUT))
+
+                    # The device is tried again later, so it does not hold up the queue
+                    workflow.retry(ECID, "{} deferred for disk space".format(operation))
+                    sys.exit(1)
+
+                # Free up space now rather than waiting on the background clean up job
+                reclaim_disk_space()
+                time.sleep(5)
+
+            else:
+
+                deferred = None
+
+                if state not in logged:
+                    device_logger.info("\u23F3 Waiting for a free {} slot...".format(operation))
+
+                with released:
+
+                    if released.wait_for(lambda: generation != seen, timeout=interval):
+                        interval = POLL_INTERVAL_MIN
+
+                    else:
+                        interval = min(interval * 2, POLL_INTERVAL_MAX)
+
+            logged.add(state)
+
+            with released:
+                seen = generation
+
+            state = try_acquire(ticket, operation, slots)
+
+        if logged:
+            timing.enter(ECID, operation)
+
+        wait = time.time() - enqueued
+        device_logger.debug("Waited {:.1f} seconds for a {} slot".format(wait, operation))
+
+        with Query() as run:
+            run.execute("INSERT INTO operation_waits ( ECID, operation, enqueued, wait ) VALUES (?, ?, ?, ?)", 
+                (ECID, operation, enqueued, wait))
+
+        yield
+
+    finally:
+
+        with Query() as run:
+            run.execute("DELETE FROM operation_slots WHERE id = ?", (ticket,))
+
+        # Wake up the threads waiting for a slot
+        with released:
+            generation += 1
+            released.notify_all()
+
+
+def reset():
+    """Releases every slot, e.g. those left behind by a previous run."""
+
+    with Query() as run:
+        run.execute("DELETE FROM operation_slots")
@@ -0,0 +1,142 @@
+import http.server
+import threading
+import time
+
+from AZTEC import cfgutil, executor, settings
+from AZTEC.db_utils import Query
+
+
+# Upper bounds, in seconds, of the stage duration histogram buckets
+BUCKETS = ( 5, 15, 30, 60, 120, 300, 600, 900, 1800, 3600 )
+
+
+def render():
+    """Builds the metrics in the Prometheus text exposition format.
+
+    Returns:
+        str:  The metrics
+    """
+
+    lines = []
+
+    with Query() as run:
+
+        in_flight = run.execute(
+            "SELECT count(*) FROM devices WHERE status IS NOT 'done' AND status IS NOT 'quarantined'").fetchone()[0]
+        statuses = run.execute(
+            "SELECT COALESCE(status, 'unknown') AS status, count(*) AS devices FROM devices GROUP BY status"
+            ).fetchall()
+        completions = run.execute(
+            "SELECT count(*) FROM report WHERE end_time >= ?", (time.time() - 3600,)).fetchone()[0]
+        stages_in_flight = run.execute(
+            "SELECT stage, count(*) AS devices FROM stage_timings WHERE duration IS NULL AND backfilled = 0 "
+            "GROUP BY stage"
+            ).fetchall()
+        timeouts = run.execute(
+            "SELECT COALESCE(locationID, 'unknown') AS locationID, operation, count(*) AS count "
+            "FROM command_timeouts GROUP BY locationID, operation").fetchall()
+        histograms = run.execute(
+            "SELECT stage, count(*) AS count, SUM(duration) AS sum, {} FROM stage_timings "
+            "WHERE duration IS NOT NULL GROUP BY stage".format(
+                ", ".join( "SUM(duration <= {0}) AS le_{0}".format(bucket) for bucket in BUCKETS ))
+            ).fetchall()
+
+    lines.append("# HELP aztec_devices_in_flight Devices in the queue that have not been provisioned yet.")
+    lines.append("# TYPE aztec_devices_in_flight gauge")
+    lines.append("aztec_devices_in_flight {}".format(in_flight))
+
+    lines.append("# HELP aztec_devices Devices in the queue by status.")
+    lines.append("# TYPE aztec_devices gauge")
+
+    for row in statuses:
+        lines.append('aztec_devices{{status="{}"}} {}'.format(row["status"], row["devices"]))
+
+    lines.append("# HELP aztec_completions_per_hour Devices provisioned in the last hour.")
+    lines.append("# TYPE aztec_completions_per_hour gauge")
+    lines.append("aztec_completions_per_hour {}".format(completions))
+
+    lines.append("# HELP aztec_stage_in_flight Devices currently in each stage.")
+    lines.append("# TYPE aztec_stage_in_flight gauge")
+
+    for row in stages_in_flight:
+        lines.append('aztec_stage_in_flight{{stage="{}"}} {}'.format(row["stage"], row["devices"]))
+
+    lines.append("# HELP aztec_stage_duration_seconds Time devices spent in each stage.")
+    lines.append("# TYPE aztec_stage_duration_seconds histogram")
+
+    for row in histograms:
+
+        for bucket in BUCKETS:
+            lines.append('aztec_stage_duration_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                row["stage"], bucket, row["le_{}".format(bucket)]))
+
+        lines.append('aztec_stage_duration_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(
+            row["stage"], row["count"]))
+        lines.append('aztec_stage_duration_seconds_sum{{stage="{}"}} {:.3f}'.format(row["stage"], row["sum"]))
+        lines.append('aztec_stage_duration_seconds_count{{stage="{}"}} {}'.format(row["stage"], row["count"]))
+
+    lines.append("# HELP aztec_command_timeouts_total cfgutil commands stopped for running past their timeout, by port.")
+    lines.append("# TYPE aztec_command_timeouts_total counter")
+
+    for row in timeouts:
+        lines.append('aztec_command_timeouts_total{{locationID="{}",operation="{}"}} {}'.format(
+            row["locationID"], row["operation"], row["count"]))
+
+    lines.append("# HELP aztec_device_progress Percent complete of each device's running cfgutil command.")
+    lines.append("# TYPE aztec_device_progress gauge")
+
+    for ECID, percent in sorted(dict(executor.executor.progress if executor.executor else {}).items()):
+        lines.append('aztec_device_progress{{ECID="{}"}} {:.1f}'.format(ECID, percent))
+
+    lines.append("# HELP aztec_cfgutil_errors_total cfgutil errors seen, by the entry of cfgutil.ERRORS they matched.")
+    lines.append("# TYPE aztec_cfgutil_errors_total counter")
+
+    for name, count in sorted(cfgutil.get_statistics().items()):
+        lines.append('aztec_cfgutil_errors_total{{error="{}"}} {}'.format(name, count))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the metrics at /metrics."""
+
+    def do_GET(self):
+
+        if self.path.split("?")[0] not in { "/", "/metrics" }:
+            self.send_error(404)
+            return
+
+        body = render().encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth logging
+        pass
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """A localhost-only HTTP server that exposes AZTEC's metrics for a scraper to poll."""
+
+    daemon_threads = True
+
+    def __init__(self, port=None):
+        super().__init__(("127.0.0.1", settings.METRICS_PORT if port is None else port), MetricsHandler)
+
+
+    def start(self):
+        """Starts serving metrics in a background thread."""
+
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+
+    def stop(self):
+        """Stops serving metrics."""
+
+        self.shutdown()
+        self.server_close()
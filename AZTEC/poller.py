@@ -0,0 +1,194 @@
+import threading
+import time
+
+from AZTEC import settings, utilities
+
+
+# Properties that never change for a device; these are provided by the cfgutil
+# environment or only need to be fetched once
+STATIC_PROPERTIES = ( "UDID", "serialNumber", "deviceType" )
+
+# Properties that change while a device is being provisioned (the firmware after a
+# restore, the port after a replug); only these are polled
+VOLATILE_PROPERTIES = ( "buildVersion", "firmwareVersion", "locationID", "activationState", 
+    "bootedState", "isSupervised", "batteryCurrentCapacity", "batteryIsCharging" )
+
+
+class PropertyPoller(threading.Thread):
+    """Polls the properties of every tracked device with a single `cfgutil get`
+    per interval and hands the results out to the threads waiting on them.
+    """
+
+    def __init__(self, interval=None):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.interval = interval or settings.POLL_INTERVAL
+        self.condition = threading.Condition()
+        self.finished = threading.Event()
+        self.waiters = {}
+        self.results = {}
+        self.generation = 0
+        self.statistics = { "polls": 0, "devices_polled": 0 }
+
+
+    def run(self):
+        """Runs when the thread is started."""
+
+        while not self.finished.is_set():
+
+            with self.condition:
+
+                self.condition.wait_for(lambda: self.waiters or self.finished.is_set())
+                ECIDs = sorted(self.waiters)
+
+            if self.finished.is_set():
+                break
+
+            started = time.monotonic()
+
+            try:
+                results = self.poll(ECIDs)
+
+            except Exception:
+                main_logger = utilities.log_setup()
+                main_logger.exception("\U0001F6D1 Failed to poll device properties")
+                results = {}
+
+            with self.condition:
+
+                self.generation += 1
+
+                for ECID in ECIDs:
+                    self.results[ECID] = ( self.generation, results.get(ECID) )
+
+                self.condition.notify_all()
+
+            self.finished.wait(max(0, self.interval - ( time.monotonic() - started )))
+
+
+    def poll(self, ECIDs):
+        """Gets the properties of several devices with one cfgutil command.
+
+        The properties are only handed to the waiting threads; each device's record
+        is written by `device.create_or_update_record`, and only if it has changed.
+
+        Args:
+            ECIDs (list):  ECIDs of the devices to poll
+
+        Returns:
+            dict:  ECID -> dict of properties, for the devices that reported no errors
+        """
+
+        results = utilities.execute_process("cfgutil {} --format JSON get {}".format(
+            " ".join( "--ecid {}".format(ECID) for ECID in ECIDs ), " ".join(VOLATILE_PROPERTIES)), 
+            settings.COMMAND_TIMEOUTS["get"])
+
+        self.statistics["polls"] += 1
+        self.statistics["devices_polled"] += len(ECIDs)
+
+        if results["timed_out"]:
+            utilities.log_setup().warning(
+                "\u26A0 `cfgutil get` did not finish within {:g} seconds and was stopped".format(
+                    settings.COMMAND_TIMEOUTS["get"]))
+            return {}
+
+        json_data = utilities.parse_json(results["stdout"])
+
+        if not isinstance(json_data, dict) or not isinstance(json_data.get("Output"), dict):
+            return {}
+
+        errors = json_data["Output"].get("Errors") or {}
+        affected = json_data.get("AffectedDevices") or []
+        properties = {
+            ECID: json_data["Output"][ECID] for ECID in ECIDs 
+            if ECID in json_data["Output"] and ECID not in errors and ECID not in affected
+        }
+
+        return properties
+
+
+    def get(self, ECID, timeout=None):
+        """Waits for the next poll that includes the device and returns its properties.
+
+        Args:
+            ECID (str):  ECID of a device
+            timeout (float, optional):  Seconds to wait for the poll
+
+        Returns:
+            dict:  The device's properties or None if they could not be determined
+        """
+
+        with self.condition:
+
+            self.waiters[ECID] = self.waiters.get(ECID, 0) + 1
+            registered = self.generation
+            self.condition.notify_all()
+
+            try:
+                self.condition.wait_for( 
+                    lambda: self.results.get(ECID, (0, None))[0] > registered, timeout )
+
+            finally:
+
+                self.waiters[ECID] -= 1
+
+                if not self.waiters[ECID]:
+                    del self.waiters[ECID]
+
+            generation, properties = self.results.get(ECID, (0, None))
+
+            return properties if generation > registered else None
+
+
+    def cancel(self):
+        """Stops the poller."""
+
+        with self.condition:
+            self.finished.set()
+            self.condition.notify_all()
+
+
+poller = None
+
+
+def start():
+    """Starts the shared poller for this process."""
+
+    global poller
+
+    poller = PropertyPoller()
+    poller.start()
+
+
+def stop():
+    """Stops the shared poller for this process."""
+
+    if poller:
+        poller.cancel()
+
+
+def get_statistics():
+    """Returns the number of polls and the number of devices they covered.
+
+    Returns:
+        dict:  The shared poller's statistics
+    """
+
+    return dict(poller.statistics) if poller else {}
+
+
+def get_properties(ECID):
+    """Gets a device's properties from the shared poller.
+
+    Args:
+        ECID (str):  ECID of a device
+
+    Returns:
+        dict:  The device's properties or None if the poller is not running
+            or the properties could not be determined
+    """
+
+    if not poller or not poller.is_alive():
+        return None
+
+    return poller.get(ECID, timeout=poller.interval + 60)
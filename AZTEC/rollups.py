@@ -0,0 +1,236 @@
+import math
+import time
+
+from AZTEC.db_utils import Query
+
+
+# Cycle times are counted in buckets that are each 5% wider than the last, so
+# percentiles can be read from the rollups to within a few percent without
+# going back over every completed device.
+BUCKET_GROWTH = 1.05
+
+
+def get_bucket(duration):
+    """Gets the histogram bucket a cycle time falls into.
+
+    Args:
+        duration (float):  Cycle time in seconds
+
+    Returns:
+        int:  The bucket
+    """
+
+    return int(math.floor(math.log(max(duration, 1)) / math.log(BUCKET_GROWTH)))
+
+
+def get_bucket_value(bucket):
+    """Gets the cycle time a histogram bucket represents, its midpoint.
+
+    Args:
+        bucket (int):  The bucket
+
+    Returns:
+        float:  Cycle time in seconds
+    """
+
+    return BUCKET_GROWTH ** ( bucket + 0.5 )
+
+
+def get_dimensions(completion):
+    """Gets the rollups a completed device is counted in.
+
+    Args:
+        completion (dict):  The device's row in the completions table
+
+    Returns:
+        list:  (dimension, value) tuples
+    """
+
+    return [
+        ( "all", "all" ),
+        ( "model", completion["deviceType"] or "unknown" ),
+        ( "firmware", completion["firmwareVersion"] or "unknown" ),
+        ( "hour", "{:02}".format(time.localtime(completion["end_time"]).tm_hour) )
+    ]
+
+
+def add_to_rollups(run, completion):
+    """Counts a completed device in the rollups.
+
+    Args:
+        run (Cursor):  A cursor within an open transaction
+        completion (dict):  The device's row in the completions table
+    """
+
+    bucket = get_bucket(completion["duration"])
+
+    for dimension, value in get_dimensions(completion):
+
+        run.execute(
+            """INSERT INTO rollup_totals ( dimension, value, count, duration ) VALUES (?, ?, 1, ?) 
+            ON CONFLICT ( dimension, value ) DO UPDATE SET 
+            count = count + 1, duration = duration + excluded.duration""",
+            (dimension, value, completion["duration"]) )
+        run.execute(
+            """INSERT INTO rollup_histograms ( dimension, value, bucket, count ) VALUES (?, ?, ?, 1) 
+            ON CONFLICT ( dimension, value, bucket ) DO UPDATE SET count = count + 1""",
+            (dimension, value, bucket) )
+
+    run.execute(
+        """INSERT INTO hourly_completions ( hour, count ) VALUES (?, 1) 
+        ON CONFLICT ( hour ) DO UPDATE SET count = count + 1""",
+        (int(completion["end_time"] // 3600),) )
+
+
+def record_completion(run, ECID, end_time):
+    """Records a provisioned device and counts it in the rollups.
+
+    The device is recorded only once, even if it is reported done again.
+
+    Args:
+        run (Cursor):  A cursor within an open transaction
+        ECID (str):  ECID of the device
+        end_time (float):  Epoch time the device was provisioned
+    """
+
+    completion = run.execute(
+        """INSERT INTO completions 
+        ( id, ECID, SerialNumber, deviceType, firmwareVersion, start_time, end_time, duration ) 
+        SELECT devices.id, devices.ECID, devices.SerialNumber, devices.deviceType, 
+        devices.firmwareVersion, report.start_time, :end_time, :end_time - report.start_time 
+        FROM devices JOIN report ON report.id = devices.id 
+        WHERE devices.ECID = :ECID AND report.start_time IS NOT NULL 
+        ON CONFLICT ( id ) DO NOTHING 
+        RETURNING *""",
+        { "ECID": ECID, "end_time": end_time } ).fetchone()
+
+    if completion:
+        add_to_rollups(run, completion)
+
+
+def rebuild(database="devices.db"):
+    """Rebuilds the rollups from the completions table, e.g. after an upgrade or a back-fill.
+
+    Args:
+        database (str, optional):  The database file
+    """
+
+    with Query(database=database) as run:
+
+        run.execute("BEGIN IMMEDIATE")
+        run.execute("DELETE FROM rollup_totals")
+        run.execute("DELETE FROM rollup_histograms")
+        run.execute("DELETE FROM hourly_completions")
+
+        for completion in run.execute("SELECT * FROM completions").fetchall():
+            add_to_rollups(run, completion)
+
+
+def get_percentiles(histogram, total, percentiles):
+    """Reads percentiles from a rollup histogram.
+
+    Args:
+        histogram (list):  (bucket, count) tuples, sorted by bucket
+        total (int):  Number of devices in the histogram
+        percentiles (tuple):  The percentiles, e.g. (50, 95, 99)
+
+    Returns:
+        list:  The cycle time, in seconds, at each percentile
+    """
+
+    values = []
+    targets = iter(sorted(percentiles))
+    target = next(targets, None)
+    cumulative = 0
+
+    for bucket, count in histogram:
+
+        cumulative += count
+
+        while target is not None and cumulative >= total * target / 100:
+            values.append(get_bucket_value(bucket))
+            target = next(targets, None)
+
+    return values
+
+
+def summarize(dimension, database="devices.db", percentiles=(50, 95, 99)):
+    """Summarizes the cycle times of one of the rollup dimensions.
+
+    Args:
+        dimension (str):  "all", "model", "firmware" or "hour"
+        database (str, optional):  The database file
+        percentiles (tuple, optional):  The percentiles to read
+
+    Returns:
+        list:  A dict for each value of the dimension, with its count, mean and percentiles
+    """
+
+    with Query(database=database) as run:
+
+        totals = run.execute(
+            "SELECT * FROM rollup_totals WHERE dimension = ? ORDER BY value", (dimension,)).fetchall()
+        histograms = {}
+
+        for row in run.execute(
+            "SELECT value, bucket, count FROM rollup_histograms WHERE dimension = ? ORDER BY value, bucket",
+            (dimension,) ).fetchall():
+
+            histograms.setdefault(row["value"], []).append( ( row["bucket"], row["count"] ) )
+
+    return [ {
+        "value": row["value"],
+        "count": row["count"],
+        "mean": row["duration"] / row["count"],
+        "percentiles": dict(zip(sorted(percentiles), 
+            get_percentiles(histograms.get(row["value"], []), row["count"], percentiles)))
+    } for row in totals ]
+
+
+def get_throughput(database="devices.db"):
+    """Gets the number of devices provisioned per hour.
+
+    Args:
+        database (str, optional):  The database file
+
+    Returns:
+        dict:  Devices provisioned, hours in which devices were provisioned, the
+            average devices per active hour, the busiest hour and the last 24 hours
+    """
+
+    with Query(database=database) as run:
+
+        row = run.execute(
+            "SELECT SUM(count) AS devices, count(*) AS hours, MAX(count) AS peak FROM hourly_completions"
+            ).fetchone()
+        recent = run.execute("SELECT SUM(count) FROM hourly_completions WHERE hour >= ?", 
+            (int(time.time() // 3600) - 23,) ).fetchone()[0]
+
+    devices = row["devices"] or 0
+
+    return {
+        "devices": devices,
+        "hours": row["hours"],
+        "per_hour": devices / row["hours"] if row["hours"] else 0,
+        "peak": row["peak"] or 0,
+        "last_24_hours": recent or 0
+    }
+
+
+def is_current(database="devices.db"):
+    """Checks if every completed device has been counted in the rollups.
+
+    Args:
+        database (str, optional):  The database file
+
+    Returns:
+        bool:  Whether the rollups are up to date
+    """
+
+    with Query(database=database) as run:
+
+        counted = run.execute(
+            "SELECT COALESCE(SUM(count), 0) FROM rollup_totals WHERE dimension = 'all'").fetchone()[0]
+        completed = run.execute("SELECT count(*) FROM completions").fetchone()[0]
+
+    return counted == completed
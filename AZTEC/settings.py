@@ -0,0 +1,111 @@
+import json
+import os
+
+
+# Settings are read from the environment so that `main.py` can pass them on to
+# every process (and thread) that `cfgutil exec` starts on its behalf.
+
+# Unix socket the resident attach/detach dispatcher listens on
+DISPATCHER_SOCKET = os.getenv("AZTEC_DISPATCHER_SOCKET", "/tmp/AZTEC-dispatcher.sock")
+
+# Unix socket the log aggregator in main.py listens on for the hook processes' log records
+LOG_SOCKET = os.getenv("AZTEC_LOG_SOCKET", "/tmp/AZTEC-logs.sock")
+
+# Local port main.py serves metrics on, for a scraper to poll; 0 disables it
+METRICS_PORT = int(os.getenv("AZTEC_METRICS_PORT", "9465"))
+
+# Maximum number of attach events (device workflows) handled at the same time
+DISPATCHER_WORKERS = int(os.getenv("AZTEC_DISPATCHER_WORKERS", "64"))
+
+# Maximum number of detach events handled at the same time, on their own workers so that
+# they never wait behind the attach workflows' long cfgutil commands
+DISPATCHER_DETACH_WORKERS = int(os.getenv("AZTEC_DISPATCHER_DETACH_WORKERS", "8"))
+
+# Environment variables `cfgutil exec` provides that are forwarded to the dispatcher
+DEVICE_ENVIRONMENT = (
+    "ECID", "UDID", "deviceType", "firmwareVersion", "buildVersion", "locationID", "deviceName" )
+
+# Directory for files AZTEC caches between runs, e.g. the firmware catalog
+CACHE_DIRECTORY = os.getenv("AZTEC_CACHE_DIRECTORY", 
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache"))
+
+# Apple's catalog of the latest firmware for each device model
+FIRMWARE_CATALOG_URL = os.getenv("AZTEC_FIRMWARE_CATALOG_URL", 
+    "http://ax.phobos.apple.com.edgesuite.net/WebObjects/MZStore.woa/wa/com.apple.jingle.appserver.client.MZITunesClientCheck/version/")
+
+# Seconds the firmware catalog is used before checking if Apple has published a new one
+FIRMWARE_CATALOG_TTL = int(os.getenv("AZTEC_FIRMWARE_CATALOG_TTL", "21600"))
+
+# Seconds after a failed check of the firmware catalog before Apple's servers are contacted again
+FIRMWARE_CATALOG_RETRY_INTERVAL = int(os.getenv("AZTEC_FIRMWARE_CATALOG_RETRY_INTERVAL", "300"))
+
+# Only use the cached firmware catalog, e.g. when the network is down
+OFFLINE = os.getenv("AZTEC_OFFLINE", "false").lower() in { "1", "true", "yes", "y" }
+
+# Directory of the local firmware (IPSW) library that restores are performed from
+IPSW_DIRECTORY = os.getenv("AZTEC_IPSW_DIRECTORY", os.path.join(CACHE_DIRECTORY, "ipsw"))
+
+# Seconds a firmware file whose download failed is not downloaded again; cfgutil downloads it meanwhile
+IPSW_FAILURE_BACKOFF = float(os.getenv("AZTEC_IPSW_FAILURE_BACKOFF", "900"))
+
+# Milliseconds SQLite waits on a locked database before a statement is retried
+DATABASE_BUSY_TIMEOUT = int(os.getenv("AZTEC_DATABASE_BUSY_TIMEOUT", "250"))
+
+# Minimum seconds between the batched `cfgutil get` polls of all tracked devices
+POLL_INTERVAL = float(os.getenv("AZTEC_POLL_INTERVAL", "2"))
+
+# Seconds given to remove a device before it is erased
+ERASE_WARNING = float(os.getenv("AZTEC_ERASE_WARNING", "5"))
+
+# Maximum seconds to wait for a device to boot (or finish restoring)
+BOOT_TIMEOUT = float(os.getenv("AZTEC_BOOT_TIMEOUT", "1800"))
+
+# Maximum seconds to wait for an erased device to be ready to be prepared
+PREPARE_READY_TIMEOUT = float(os.getenv("AZTEC_PREPARE_READY_TIMEOUT", "70"))
+
+# Shortest and longest seconds between polls while waiting on a device
+READY_POLL_MIN = float(os.getenv("AZTEC_READY_POLL_MIN", "1"))
+READY_POLL_MAX = float(os.getenv("AZTEC_READY_POLL_MAX", "10"))
+
+# Maximum number of each cfgutil operation that may run at the same time, host-wide
+OPERATION_SLOTS = {
+    "erase": int(os.getenv("AZTEC_ERASE_SLOTS", "16")),
+    "prepare": int(os.getenv("AZTEC_PREPARE_SLOTS", "16")),
+    "restore": int(os.getenv("AZTEC_RESTORE_SLOTS", "4"))
+}
+
+# Seconds each cfgutil operation may run before it is stopped and the device is marked to be retried
+COMMAND_TIMEOUTS = {
+    "get": float(os.getenv("AZTEC_GET_TIMEOUT", "120")),
+    "erase": float(os.getenv("AZTEC_ERASE_TIMEOUT", "900")),
+    "prepare": float(os.getenv("AZTEC_PREPARE_TIMEOUT", "1200")),
+    "restore": float(os.getenv("AZTEC_RESTORE_TIMEOUT", "5400"))
+}
+
+# Per model overrides of COMMAND_TIMEOUTS, as JSON, e.g. '{"restore": {"iPad6,11": 7200}}'
+MODEL_COMMAND_TIMEOUTS = json.loads(os.getenv("AZTEC_MODEL_COMMAND_TIMEOUTS", "{}"))
+
+# Failed attempts to provision a device after which it is quarantined instead of tried again
+RETRY_LIMIT = int(os.getenv("AZTEC_RETRY_LIMIT", "3"))
+
+# Seconds waited before trying a device again, doubled after each failed attempt, up to RETRY_BACKOFF_MAX
+RETRY_BACKOFF = float(os.getenv("AZTEC_RETRY_BACKOFF", "30"))
+RETRY_BACKOFF_MAX = float(os.getenv("AZTEC_RETRY_BACKOFF_MAX", "600"))
+
+# Seconds between the dispatcher's checks for devices whose backoff has passed
+RETRY_CHECK_INTERVAL = float(os.getenv("AZTEC_RETRY_CHECK_INTERVAL", "5"))
+
+# Disk space (in GB) each restore is expected to use while cfgutil extracts its firmware
+RESTORE_DISK_SPACE = float(os.getenv("AZTEC_RESTORE_DISK_SPACE_GB", "6")) * 1024 ** 3
+
+# Free disk space (in GB) to keep in reserve; restores are deferred rather than dip below it
+DISK_FREE_RESERVE = float(os.getenv("AZTEC_DISK_FREE_RESERVE_GB", "10")) * 1024 ** 3
+
+# Seconds a restore waits for enough free disk space before its device is tried again later
+DISK_SPACE_TIMEOUT = float(os.getenv("AZTEC_DISK_SPACE_TIMEOUT", "1800"))
+
+# Where to look for the Apple Configurator temporary directory
+CONFIGURATOR_SCAN_ROOT = os.getenv("AZTEC_CONFIGURATOR_SCAN_ROOT", "/private/var/folders")
+
+# Number of temporary directories that are deleted at the same time
+CLEANUP_WORKERS = int(os.getenv("AZTEC_CLEANUP_WORKERS", "4"))
@@ -1,5 +1,21 @@
 #!/bin/sh
 
+# Forward the event to the resident dispatcher in main.py, if it is running
+socket="${AZTEC_DISPATCHER_SOCKET:-/tmp/AZTEC-dispatcher.sock}"
+
+if [ -S "${socket}" ]; then
+
+    response="$( printf 'detach\nECID=%s\nUDID=%s\ndeviceType=%s\nfirmwareVersion=%s\nbuildVersion=%s\nlocationID=%s\ndeviceName=%s\n\n' \
+        "${ECID}" "${UDID}" "${deviceType}" "${firmwareVersion}" "${buildVersion}" "${locationID}" "${deviceName}" \
+        | /usr/bin/nc -U "${socket}" 2>/dev/null )"
+
+    if [ "${response}" = "OK" ]; then
+        exit 0
+    fi
+
+fi
+
+# Otherwise, handle the event in its own Python process
 # Get the scripts current directory
 script_directory="$( cd "$(dirname "$0")" >/dev/null 2>&1 ; pwd -P )"
 # Get the scripts parent directory
@@ -0,0 +1,43 @@
+import time
+
+from AZTEC.db_utils import Query
+
+
+# time.monotonic() is system-wide, so the timestamps of the dispatcher and hook
+# processes can be compared; `started` is the wall clock time, for reporting.
+
+
+def enter(ECID, stage):
+    """Records that a device has moved on to a stage, finishing the stage it was in.
+
+    Args:
+        ECID (str):  ECID of a device
+        stage (str):  The stage, e.g. "restore" or "boot_wait"
+    """
+
+    now = time.monotonic()
+
+    with Query() as run:
+
+        run.execute("BEGIN IMMEDIATE")
+        run.execute(
+            """UPDATE stage_timings SET finished_monotonic = ?, duration = ? - started_monotonic 
+            WHERE ECID = ? AND duration IS NULL AND backfilled = 0""", (now, now, ECID))
+        run.execute(
+            "INSERT INTO stage_timings ( ECID, stage, started, started_monotonic ) VALUES (?, ?, ?, ?)",
+            (ECID, stage, time.time(), now))
+
+
+def finish(ECID):
+    """Records that a device has finished the stage it was in, e.g. once it is provisioned.
+
+    Args:
+        ECID (str):  ECID of a device
+    """
+
+    now = time.monotonic()
+
+    with Query() as run:
+        run.execute(
+            """UPDATE stage_timings SET finished_monotonic = ?, duration = ? - started_monotonic 
+            WHERE ECID = ? AND duration IS NULL AND backfilled = 0""", (now, now, ECID))
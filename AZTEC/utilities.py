@@ -1,17 +1,20 @@
+import collections
 import datetime
+import functools
 import json
-import logging.config
+import logging
 import os
-import pathlib
 import re
 import shlex
 import shutil
+import signal
 import subprocess
 import threading
 
-from distutils.util import strtobool
 from typing import List, Union
 
+from AZTEC import settings
+
 from logging_config import (
     LOGGING_CONFIG_DEVICE_HANDLER, 
     LOGGING_CONFIG_DEVICE_LOGGER, 
@@ -20,8 +23,20 @@ from logging_config import (
 
 
 module_directory =  os.path.dirname(os.path.abspath(__file__))
-package_directory = pathlib.Path(__file__).parent.absolute().parent.absolute()
+package_directory = os.path.dirname(module_directory)
 log_directory = "{}/logs".format(package_directory)
+log_setup_lock = threading.Lock()
+
+# Loggers that have been set up, by name, and the thread that writes their records
+loggers = {}
+log_writer = None
+log_queue_handler = None
+
+# Set by the log aggregator, as the process that hosts it writes its own records
+log_aggregator_running = False
+
+# Most device log files kept open at once; the least recently written is closed first
+MAX_OPEN_DEVICE_LOGS = 64
 
 
 class Periodic(threading.Thread):
@@ -73,39 +88,216 @@ def log_backup():
         os.rename(log_directory, "{}_{}".format(log_directory, time_stamp))
 
 
-def log_setup(log_name="main"): # level=logging.INFO):
-    """Sets up a logger to handle logging messages for the AZTEC process.
-
-    Multiple log files are created:
-        main:  This is the parent log (and console) that all information is posted too
-        <device>:  Each device will have its own log for easier parsing for device specific errors
+class StrippingLogRecord(logging.LogRecord):
+    """A class that is used to strip undesired information from the
+    provided text in a message before it is written to a log.
 
     Args:
-        log_name ([str], optional): A log to write too. Defaults to "main"
-            If not main, a device ECID should be passed to create a device specific log
+        logging (LogRecord): The message to parse
 
     Returns:
-        [logger]: A logger object
+        str: The parsed message
     """
 
-    class StrippingLogRecord(logging.LogRecord):
-        """A class that is used to strip undesired information from the
-        provided text in a message before it is written to a log.
+    pattern = re.compile(r"objc\[\d+\]: Class AMSupport.+ Which one is undefined\.")
+
+    def getMessage(self):
+        message = super(StrippingLogRecord, self).getMessage()
+        message = self.pattern.sub("", message)
+        return message
+
+
+class LogWriter(threading.Thread):
+    """Writes the queued log records of every logger in the process from a single
+    thread, flushing the console and log files once per batch rather than per record.
+
+    When `main.py`'s log aggregator is reachable, the records are sent to it instead
+    so that it is the only writer of the log files; if it cannot be reached, the
+    records are written to the log files directly.
+    """
+
+    def __init__(self, log_queue, handlers, batch_size=500):
+
+        super().__init__(name="AZTEC-log-writer", daemon=True)
+        self.queue = log_queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.devices = collections.OrderedDict()
+        self.aggregator = None
+
+
+    def connect(self, socket_path):
+        """Connects to a log aggregator.
+
+        Args:
+            socket_path (str):  The log aggregator's socket
+
+        Returns:
+            bool:  Whether the aggregator could be reached
+        """
+
+        import socket
+
+        try:
+            self.aggregator = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.aggregator.connect(socket_path)
+
+        except OSError:
+            self.aggregator.close()
+            self.aggregator = None
+
+        return self.aggregator is not None
+
+
+    def get_device_handler(self, log_name):
+        """Gets the handler for a device's log file, creating it the first time the device
+        logs a record.
+
+        Only the MAX_OPEN_DEVICE_LOGS most recently written device logs are kept open, so
+        that a long run does not use up the process' file descriptors; a device whose
+        log was closed has it opened again (and appended to) when it next logs a record.
 
         Args:
-            logging (LogRecord): The message to parse
+            log_name (str):  The device's ECID
 
         Returns:
-            str: The parsed message
+            logging.FileHandler:  The handler for the device's log file
+        """
+
+        handler = self.devices.get(log_name)
+
+        if handler:
+            self.devices.move_to_end(log_name)
+            return handler
+
+        config = LOGGING_CONFIG_DEVICE_HANDLER.get("device")
+        handler = logging.FileHandler("{}/{}.log".format(log_directory, log_name), delay=True)
+        handler.setLevel(config.get("level"))
+        handler.setFormatter(logging.Formatter(
+            LOGGING_CONFIG_MAIN.get("formatters").get(config.get("formatter")).get("format")))
+        self.devices[log_name] = handler
+
+        while len(self.devices) > MAX_OPEN_DEVICE_LOGS:
+            name, evicted = self.devices.popitem(last=False)
+            evicted.close()
+
+        return handler
+
+
+    def emit(self, handler, record):
+        """Writes a record to a handler's stream without flushing it.
+
+        The handler's lock is held while writing, as `logging` does, and a log file that
+        has not been opened yet is opened.
+
+        Args:
+            handler (logging.StreamHandler):  The handler
+            record (logging.LogRecord):  The log record
         """
 
-        pattern = re.compile(r"objc\[\d+\]: Class AMSupport.+ Which one is undefined\.")
+        handler.acquire()
+
+        try:
+
+            if handler.stream is None and isinstance(handler, logging.FileHandler):
+                handler.stream = handler._open()
+
+            handler.stream.write(handler.format(record) + handler.terminator)
+
+        finally:
+            handler.release()
+
+
+    def write(self, records):
+        """Writes records to the console and log files, and flushes each of them once.
+
+        Args:
+            records (list):  The log records
+        """
+
+        written = set()
+
+        for record in records:
+
+            handlers = list(self.handlers)
+
+            if record.name != "main":
+                handlers.append(self.get_device_handler(record.name))
+
+            for handler in handlers:
+
+                if record.levelno >= handler.level and handler.filter(record):
+
+                    try:
+                        self.emit(handler, record)
+                        written.add(handler)
+
+                    except Exception:
+                        handler.handleError(record)
+
+        for handler in written:
+            handler.flush()
+
+
+    def send(self, records):
+        """Sends records to the log aggregator.
+
+        Args:
+            records (list):  The log records
+
+        Returns:
+            bool:  Whether the records were sent
+        """
+
+        message = "".join( json.dumps( { key: getattr(record, key) for key in 
+            ( "name", "msg", "levelname", "levelno", "created", "msecs", "process", "thread", "threadName" ) } 
+            ) + "\n" for record in records )
+
+        try:
+            self.aggregator.sendall(message.encode("utf-8"))
+
+        except OSError:
+            self.aggregator.close()
+            self.aggregator = None
+            return False
+
+        return True
+
+
+    def run(self):
+
+        while True:
+
+            batch = [ self.queue.get() ]
+
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get())
+
+            records = [ record for record in batch if record is not None ]
+
+            if records and not ( self.aggregator and self.send(records) ):
+                self.write(records)
+
+            # None is queued to stop the writer
+            if len(records) < len(batch):
+                return
+
+
+def start_log_writer():
+    """Configures the main logger once and moves its handlers behind a queue.
+
+    Log records are put on the queue by the thread that logs them and are formatted
+    and written by a single writer thread, so logging never waits on the console
+    or a log file.
+    """
 
-        def getMessage(self):
-            message = super(StrippingLogRecord, self).getMessage()
-            message = self.pattern.sub("", message)
-            return message
+    global log_writer, log_queue_handler
 
+    # Imported here as the logging.config machinery is only needed once a logger is set up
+    import atexit
+    import logging.handlers
+    import queue
+    from logging.config import dictConfig
 
     if not os.path.exists(log_directory):
         os.mkdir(log_directory)
@@ -113,22 +305,84 @@ def log_setup(log_name="main"): # level=logging.INFO):
     LOGGING_CONFIG_MAIN.get("handlers").get("main").update(
         { "filename": "{}/main.log".format(log_directory) } )
 
-    if log_name not in ( None, "main" ):
+    dictConfig(LOGGING_CONFIG_MAIN)
+    logging.setLogRecordFactory(StrippingLogRecord)
 
-        if "device" in LOGGING_CONFIG_DEVICE_LOGGER.keys():
-            LOGGING_CONFIG_DEVICE_LOGGER[log_name] =  LOGGING_CONFIG_DEVICE_LOGGER.pop("device")
+    # Hand the console and main.log handlers that were just configured to the writer
+    main_logger = logging.getLogger("main")
+    log_queue = queue.SimpleQueue()
+    log_writer = LogWriter(log_queue, list(main_logger.handlers))
+    log_queue_handler = logging.handlers.QueueHandler(log_queue)
 
-        LOGGING_CONFIG_DEVICE_HANDLER.get("device").update(
-            { "filename": "{}/{}.log".format(log_directory, log_name) } )
-        LOGGING_CONFIG_MAIN.get("handlers").update(LOGGING_CONFIG_DEVICE_HANDLER)
-        LOGGING_CONFIG_MAIN.get("loggers").update(LOGGING_CONFIG_DEVICE_LOGGER)
-        LOGGING_CONFIG_MAIN.get("loggers").get("main").get("handlers").append("device")
+    for handler in list(main_logger.handlers):
+        main_logger.removeHandler(handler)
 
-    logging.config.dictConfig(LOGGING_CONFIG_MAIN)
+    main_logger.addHandler(log_queue_handler)
 
-    logging.setLogRecordFactory(StrippingLogRecord)
+    # Send the records to main.py's log aggregator, unless this is main.py
+    if not log_aggregator_running:
+        log_writer.connect(settings.LOG_SOCKET)
+
+    log_writer.start()
+
+    # Write out everything that is still queued when the process exits
+    atexit.register(log_shutdown)
+
+
+def log_shutdown():
+    """Stops the log writer once every queued record has been written."""
+
+    global log_writer
+
+    with log_setup_lock:
+
+        if log_writer:
+            log_writer.queue.put(None)
+            log_writer.join()
+            log_writer = None
+
+
+def log_setup(log_name="main"): # level=logging.INFO):
+    """Sets up a logger to handle logging messages for the AZTEC process.
+
+    Multiple log files are created:
+        main:  This is the parent log (and console) that all information is posted too
+        <device>:  Each device will have its own log for easier parsing for device specific errors
+
+    Each logger is only built the first time it is asked for; after that it is
+    returned from the registry.
+
+    Args:
+        log_name ([str], optional): A log to write too. Defaults to "main"
+            If not main, a device ECID should be passed to create a device specific log
+
+    Returns:
+        [logger]: A logger object
+    """
+
+    log_name = log_name or "main"
+    logger = loggers.get(log_name)
+
+    if logger:
+        return logger
+
+    # The dispatcher in main.py sets up loggers from several threads at once
+    with log_setup_lock:
 
-    return logging.getLogger(log_name)
+        if log_writer is None:
+            start_log_writer()
+
+        logger = logging.getLogger(log_name)
+
+        if log_name != "main":
+
+            # Each device gets its own log file, named after its ECID, which the writer opens
+            logger.setLevel(LOGGING_CONFIG_DEVICE_LOGGER.get("device").get("level"))
+            logger.addHandler(log_queue_handler)
+
+        loggers[log_name] = logger
+
+    return logger
 
 
 def parse_json(json_data):
@@ -242,11 +496,13 @@ class HumanBytes:
         return HumanBytes.PRECISION_FORMATS[precision].format("-" if is_negative else "", num, unit)
 
 
-def get_disk_usage(disk):
+def get_disk_usage(disk, human=True):
     """Gets the current disk usage properties and returns them.
 
     Args:
         disk (str):  Which disk to check
+        human (bool, optional):  Return human friendly strings instead of bytes.
+            Defaults to True
 
     Returns:
         (tuple): Results in a tuple format (total, used, free)
@@ -255,6 +511,9 @@ def get_disk_usage(disk):
     # Get the disk usage
     total, used, free = shutil.disk_usage(disk)
 
+    if not human:
+        return (total, used, free)
+
     total_human = HumanBytes.format(total, metric=False, precision=1)
     used_human = HumanBytes.format(used, metric=False, precision=1)
     free_human = HumanBytes.format(free, metric=False, precision=1)
@@ -286,6 +545,77 @@ def is_string_GUID(possible_GUID):
     return bool(re.search(pattern, possible_GUID))
 
 
+def is_process_running(pid):
+    """Checks if a process is still running.
+
+    Args:
+        pid (int):  A process ID
+
+    Returns:
+        bool:  Whether the process is running
+    """
+
+    try:
+        os.kill(pid, 0)
+
+    except ProcessLookupError:
+        return False
+
+    except PermissionError:
+        pass
+
+    return True
+
+
+def strtobool(value):
+    """Converts a string representation of truth to True or False.
+
+    A replacement for `distutils.util.strtobool`, which is slow to import.
+
+    Args:
+        value (str):  A string such as "yes", "no", "true", "false", "1" or "0"
+
+    Returns:
+        True or false
+
+    Raises:
+        ValueError:  If the string is not a recognized value
+    """
+
+    value = str(value).lower()
+
+    if value in { "y", "yes", "t", "true", "on", "1" }:
+        return True
+
+    elif value in { "n", "no", "f", "false", "off", "0" }:
+        return False
+
+    raise ValueError("invalid truth value {!r}".format(value))
+
+
+@functools.lru_cache(maxsize=None)
+def version_key(version):
+    """Converts a firmware version into a key that compares in version order.
+
+    A lightweight replacement for `pkg_resources.parse_version`; firmware versions
+    are only ever dotted numbers, e.g. "14.8.1".
+
+    Args:
+        version (str):  A firmware version, e.g. "14.8.1"
+
+    Returns:
+        tuple:  The numeric parts of the version, e.g. (14, 8, 1)
+    """
+
+    parts = [ int(part) if part.isdigit() else 0 for part in str(version).split(".") ]
+
+    # "14.0" and "14" are the same version
+    while parts and parts[-1] == 0:
+        parts.pop()
+
+    return tuple(parts)
+
+
 def query_user_yes_no(question):
     """Ask a yes/no question via input() and determine the value of the answer.
 
@@ -309,13 +639,15 @@ def query_user_yes_no(question):
             print('Please respond with [yes|y] or [no|n]: ', end="")
 
 
-def execute_process(command):
+def execute_process(command, timeout=None):
     """
     A helper function for subprocess.
 
     Args:
         command (str):  The command line level syntax that would be written in a 
             shell script or a terminal window
+        timeout (float, optional):  Seconds after which the command, and any 
+            processes it started, are killed
 
     Returns:
         dict:  Results in a dictionary
@@ -328,14 +660,48 @@ def execute_process(command):
     # Format the command
     command = shlex.split(command)
 
-    # Run the command
+    # Run the command; with a timeout, in its own process group so it can be killed as a whole
     process = subprocess.Popen( command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
-        shell=False, universal_newlines=True )
-    (stdout, stderr) = process.communicate()
+        shell=False, universal_newlines=True, start_new_session=bool(timeout) )
+
+    try:
+        (stdout, stderr) = process.communicate(timeout=timeout)
+        timed_out = False
+
+    except subprocess.TimeoutExpired:
+
+        # Give the command a moment to exit on its own before it is killed
+        signal_process_group(process.pid, signal.SIGTERM)
+
+        try:
+            process.wait(5)
+
+        except subprocess.TimeoutExpired:
+            pass
+
+        signal_process_group(process.pid, signal.SIGKILL)
+        (stdout, stderr) = process.communicate()
+        timed_out = True
 
     return {
         "stdout": (stdout).strip(),
         "stderr": (stderr).strip() if stderr != None else None,
         "exitcode": process.returncode,
-        "success": process.returncode == 0
+        "success": process.returncode == 0 and not timed_out,
+        "timed_out": timed_out
     }
+
+
+def signal_process_group(pid, signal_number):
+    """Sends a signal to a process started in its own session and every process it started.
+
+    Args:
+        pid (int):  The process ID, which is also its process group ID
+        signal_number (int):  The signal, e.g. signal.SIGTERM
+    """
+
+    try:
+        os.killpg(pid, signal_number)
+
+    except ProcessLookupError:
+        pass
@@ -0,0 +1,402 @@
+import time
+
+from AZTEC import settings, timing, utilities
+from AZTEC.db_utils import Query
+
+
+# The statuses a device moves through while it is provisioned, in order
+PROGRESSION = ( "new", "erase_warning", "erasing", "erased", "preparing", "check", "done" )
+
+# The statuses a device can be in; "removed" is only recorded in its history, once it was
+# unplugged when done and its record was deleted
+STATUSES = { *PROGRESSION, "error", "quarantined", "removed" }
+
+# The moves between statuses, as ( from_status, to_status ); a from_status of None is a
+# device that was just added to the queue.  A device can also stay in its status.
+ALLOWED = {
+    ( None, "new" ),
+    # Erased or restored, which is also what is done with a device in an unknown state
+    *( ( status, "erase_warning" ) for status in PROGRESSION + ( "error", ) ),
+    ( "erase_warning", "erasing" ),
+    # A restore, which erases the device, finished
+    ( "erase_warning", "erased" ),
+    # The device rebooted after it was erased
+    ( "erasing", "erased" ),
+    # Any device that is Unactivated is prepared
+    *( ( status, "preparing" ) for status in PROGRESSION[1:] ),
+    # A command's error left the device's state unknown, it is checked on its next attach
+    *( ( status, "check" ) for status in PROGRESSION + ( "error", ) ),
+    ( "preparing", "done" ),
+    ( "check", "done" ),
+    # Resumed from an earlier status
+    *( ( later, earlier ) for index, earlier in enumerate(PROGRESSION) for later in PROGRESSION[index + 1:] ),
+    # Failed, or used its retry budget
+    *( ( status, "error" ) for status in PROGRESSION ),
+    *( ( status, "quarantined" ) for status in PROGRESSION + ( "error", ) ),
+    # Released from quarantine
+    ( "quarantined", "error" ),
+    ( "done", "removed" )
+}
+
+# What the attach workflow does with a device, decided by the first entry that matches
+# its status, activationState, isSupervised and bootedState; None matches any value.
+#   provision:  update (restore) or erase the device, depending on its firmware
+#   erase:  erase the device
+#   prepare:  prepare the device
+#   complete:  mark the device as provisioned
+#   unplug:  nothing left to do, the device can be unplugged
+#   wait:  nothing to do until the device attaches again
+#   quarantine:  the device used its retry budget, it is not provisioned again until it is released
+TRANSITIONS = (
+    # status                            activationState  isSupervised  bootedState  action
+    ( { "quarantined" },                None,            None,         None,        "quarantine" ),
+    ( { "new", "error" },               None,            None,         None,        "provision" ),
+    # A restore that is still running reboots the device when it finishes
+    ( None,                             None,            None,         "Restore",   "wait" ),
+    ( None,                             "Unactivated",   None,         None,        "prepare" ),
+    ( { "check" },                      "Activated",     True,         None,        "complete" ),
+    # The device was prepared, but the workflow stopped before it could be marked done
+    ( { "preparing" },                  "Activated",     True,         None,        "complete" ),
+    ( { "done" },                       "Activated",     True,         None,        "unplug" ),
+    # The workflow stopped during the erase warning, before the device was erased
+    ( { "erase_warning" },              None,            None,         None,        "provision" ),
+    # The erase did not take, or the device cannot be prepared without being erased first
+    ( { "erasing", "erased" },          "Activated",     None,         None,        "erase" ),
+    ( { "preparing" },                  "Activated",     False,        None,        "erase" )
+)
+
+
+def matches(rule, status, activation_state, supervised, booted_state):
+    """Checks if an entry of TRANSITIONS matches a device."""
+
+    statuses, activation, supervision, booted, action = rule
+
+    return (
+        ( statuses is None or status in statuses ) and
+        ( activation is None or activation == activation_state ) and
+        ( supervision is None or supervision == supervised ) and
+        ( booted is None or booted == booted_state )
+    )
+
+
+def get_action(device, status=None):
+    """Looks up what to do with a device in the transition table.
+
+    Args:
+        device (dict):  Object of device's information from the database
+        status (str, optional):  The status to look up instead of the device's
+
+    Returns:
+        str:  The action, or None if no entry matches
+    """
+
+    status = status or device["status"]
+
+    try:
+        supervised = utilities.strtobool(device["isSupervised"])
+
+    except ValueError:
+        supervised = None
+
+    for rule in TRANSITIONS:
+
+        if matches(rule, status, device["activationState"], supervised, device["bootedState"]):
+            return rule[-1]
+
+    return None
+
+
+def get_history(ECID):
+    """Gets a device's status transitions, newest first.
+
+    Args:
+        ECID (str):  ECID of a device
+
+    Returns:
+        list:  The transitions
+    """
+
+    with Query() as run:
+        return run.execute(
+            "SELECT * FROM state_transitions WHERE ECID = ? ORDER BY id DESC", (ECID,)).fetchall()
+
+
+def resume(device):
+    """Decides what to do with a device, resuming from its last valid status when its
+    current one (with its properties) is not in the transition table.
+
+    Args:
+        device (dict):  Object of device's information from the database
+
+    Returns:
+        tuple:  The action, and the status it was decided from; the action is
+            None when no status the device has been in is in the table
+    """
+
+    action = get_action(device)
+
+    if action:
+        return action, device["status"]
+
+    for transition in get_history(device["ECID"]):
+
+        # Stop at the last time the device was provisioned and removed from the queue
+        if transition["to_status"] == "removed":
+            break
+
+        # Stop once the device was added to the queue, the statuses before it are from an
+        # earlier provisioning, e.g. one whose record was purged with `main.py --reset`
+        if transition["from_status"] is None:
+            break
+
+        status = transition["from_status"]
+
+        if status in STATUSES and status != device["status"]:
+
+            action = get_action(device, status)
+
+            if action:
+                return action, status
+
+    return None, device["status"]
+
+
+def transition(ECID, status, reason=None, run=None):
+    """Moves a device to a status, recording the transition.
+
+    Args:
+        ECID (str):  ECID of a device
+        status (str):  The new status, one of STATUSES
+        reason (str, optional):  Why, for the history, e.g. the action or error
+        run (Cursor, optional):  A cursor whose open transaction to use
+
+    Returns:
+        bool:  Whether the device was moved; False if it is not in the queue, e.g. when
+            its first `cfgutil get` failed
+
+    Raises:
+        ValueError:  If the status is unknown, or the device cannot move to it from its
+            current status
+    """
+
+    if run is None:
+
+        with Query() as run:
+            run.execute("BEGIN IMMEDIATE")
+            return transition(ECID, status, reason, run)
+
+    previous = run.execute("SELECT status FROM devices WHERE ECID = ?", (ECID,)).fetchone()
+
+    if not previous:
+
+        device_logger = utilities.log_setup(log_name=ECID)
+        device_logger.warning("\u26A0 Device is not in the queue, it was not moved to `{}` ({})".format(
+            status, reason))
+
+        return False
+
+    record(run, ECID, previous["status"], status, reason)
+
+    # Update status in the database
+    run.execute('UPDATE devices SET status = ? WHERE ECID = ?', (status, ECID))
+
+    return True
+
+
+def record(run, ECID, from_status, to_status, reason=None):
+    """Adds a transition to a device's history, for statuses written elsewhere.
+
+    Args:
+        run (Cursor):  A cursor
+        ECID (str):  ECID of a device
+        from_status (str):  The status the device was in
+        to_status (str):  The status the device moved to, or "removed" once it is
+            unplugged and removed from the queue
+        reason (str, optional):  Why, for the history
+
+    Raises:
+        ValueError:  If to_status is not one of STATUSES, or the move is not in ALLOWED
+    """
+
+    if to_status not in STATUSES:
+        raise ValueError("Unknown status:  {}".format(to_status))
+
+    if from_status != to_status and ( from_status, to_status ) not in ALLOWED:
+
+        device_logger = utilities.log_setup(log_name=ECID)
+        device_logger.error("\U0001F6D1 Refusing to move the device from `{}` to `{}` ({})".format(
+            from_status, to_status, reason))
+
+        raise ValueError("Transition not allowed:  {} -> {}".format(from_status, to_status))
+
+    run.execute(
+        """INSERT INTO state_transitions ( ECID, from_status, to_status, reason, occurred )
+        VALUES (?, ?, ?, ?, ?)""",
+        (ECID, from_status, to_status, reason, time.time()))
+
+
+def get_backoff(failures):
+    """Gets how long to wait before trying a device again.
+
+    Args:
+        failures (int):  The device's failed attempts so far
+
+    Returns:
+        float:  Seconds, doubled after each failed attempt, up to settings.RETRY_BACKOFF_MAX
+    """
+
+    return min(settings.RETRY_BACKOFF * 2 ** max(failures - 1, 0), settings.RETRY_BACKOFF_MAX)
+
+
+def fail(ECID, reason, run=None):
+    """Counts a failed attempt to provision a device, quarantining the device once it
+    has failed settings.RETRY_LIMIT times.
+
+    Args:
+        ECID (str):  ECID of a device
+        reason (str):  What failed, e.g. the name of the cfgutil error
+        run (Cursor, optional):  A cursor whose open transaction to use
+
+    Returns:
+        int:  The device's failed attempts, including this one
+    """
+
+    if run is None:
+
+        with Query() as run:
+            run.execute("BEGIN IMMEDIATE")
+            return fail(ECID, reason, run)
+
+    run.execute("UPDATE devices SET failures = failures + 1, last_failure = ? WHERE ECID = ?", 
+        (reason, ECID))
+    device = run.execute("SELECT failures FROM devices WHERE ECID = ?", (ECID,)).fetchone()
+    failures = device["failures"] if device else 1
+
+    if failures >= settings.RETRY_LIMIT:
+
+        # Update status in the database
+        transition(ECID, "quarantined", reason, run)
+
+        device_logger = utilities.log_setup(log_name=ECID)
+        device_logger.error(
+            "\U0001F6A7 [QUARANTINE] Device failed to provision {} times (last:  {}), it will not be "
+            "tried again until it is released.  Unplug it to free the port!".format(failures, reason))
+
+    return failures
+
+
+def retry(ECID, reason, status="error"):
+    """Counts a failed attempt to provision a device and, if it has not used its retry
+    budget, schedules it to be tried again once its backoff has passed.
+
+    The backoff is not waited out here:  the device is moved to the status, its workflow
+    stops, and it is attached again by the dispatcher once it is due (see `take_due`),
+    or provisioned on its next attach after that.
+
+    Args:
+        ECID (str):  ECID of a device
+        reason (str):  What failed, e.g. the name of the cfgutil error
+        status (str, optional):  The status the device is tried again from.  Defaults
+            to "error", which provisions (erases) it again
+
+    Returns:
+        bool:  True if the device will be tried again, False if it was quarantined
+    """
+
+    device_logger = utilities.log_setup(log_name=ECID)
+
+    with Query() as run:
+
+        run.execute("BEGIN IMMEDIATE")
+
+        # A device whose first `cfgutil get` failed was never added to the queue
+        if not run.execute("SELECT id FROM devices WHERE ECID = ?", (ECID,)).fetchone():
+            device_logger.warning(
+                "\u26A0 Device failed ({}) before it was added to the queue, it will be tried "
+                "again on its next attach".format(reason))
+            return True
+
+        failures = fail(ECID, reason, run)
+
+        if failures < settings.RETRY_LIMIT:
+
+            backoff = get_backoff(failures)
+
+            # Update status in the database
+            transition(ECID, status, reason, run)
+            run.execute("UPDATE devices SET retry_after = ? WHERE ECID = ?", 
+                (time.time() + backoff, ECID))
+
+        else:
+            run.execute("UPDATE devices SET retry_after = NULL WHERE ECID = ?", (ECID,))
+
+    if failures >= settings.RETRY_LIMIT:
+        timing.finish(ECID)
+        return False
+
+    device_logger.warning("\u21BB Attempt {} of {} failed ({}), trying again in {:g} seconds...".format(
+        failures, settings.RETRY_LIMIT, reason, backoff))
+
+    timing.enter(ECID, "retry_backoff")
+
+    return True
+
+
+def take_due(ECIDs):
+    """Gets the devices whose retry backoff has passed, clearing it so that each is only
+    tried again once.
+
+    Args:
+        ECIDs (list):  ECIDs of the devices to check
+
+    Returns:
+        list:  The due devices' records
+    """
+
+    with Query() as run:
+
+        run.execute("BEGIN IMMEDIATE")
+
+        return run.execute(
+            """UPDATE devices SET retry_after = NULL 
+            WHERE retry_after <= ? AND status != 'quarantined' AND ECID IN ( {} ) 
+            RETURNING *""".format(", ".join("?" * len(ECIDs))), 
+            (time.time(), *ECIDs)).fetchall()
+
+
+def release(ECID):
+    """Releases a quarantined device, resetting its retry budget, so that it is
+    provisioned again on its next attach.
+
+    Args:
+        ECID (str):  ECID of a device
+
+    Returns:
+        bool:  Whether the device was quarantined
+    """
+
+    with Query() as run:
+
+        run.execute("BEGIN IMMEDIATE")
+        device = run.execute("SELECT status FROM devices WHERE ECID = ?", (ECID,)).fetchone()
+
+        if not device or device["status"] != "quarantined":
+            return False
+
+        run.execute("UPDATE devices SET failures = 0, retry_after = NULL WHERE ECID = ?", (ECID,))
+
+        # Update status in the database
+        transition(ECID, "error", "released", run)
+
+    return True
+
+
+def get_quarantined():
+    """Gets the quarantined devices.
+
+    Returns:
+        list:  The devices' records
+    """
+
+    with Query() as run:
+        return run.execute("SELECT * FROM devices WHERE status = 'quarantined' ORDER BY id").fetchall()
@@ -0,0 +1,262 @@
+"""Measures AZTEC's per-device orchestration overhead, end to end.
+
+`main.py` is run against the cfgutil simulator for 8, 64 and 256 virtual devices;
+each device is attached, erased, detached, attached again, prepared and marked
+done.  The simulated commands take almost no time, so what is measured is the
+overhead of AZTEC itself (`attach.py`, `device.py`, `actions.py`, `db_utils.py`,
+...):  wall and CPU time, peak RSS, SQLite connections, statements and lock waits,
+subprocesses spawned and `log_setup` / `dictConfig` calls, per device.
+
+The results are saved as JSON to compare across commits; given a baseline, the
+check fails if any per-device measurement regressed by more than the threshold.
+
+Usage:  python3 -m benchmarks.end_to_end [--devices 8 64 256] [--output FILE]
+            [--baseline FILE] [--threshold 0.25]
+"""
+
+import argparse
+import json
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+
+package_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The simulation:  no failures and latencies scaled down to a few milliseconds
+SIMULATION = {
+    "time_scale": 0.001,
+    "seed": 1,
+    "failures": { "get": {}, "erase": {}, "restore": {}, "prepare": {} }
+}
+
+# Per-device measurements compared to the baseline, and the absolute change
+# below which a difference is treated as noise
+COMPARED = {
+    "cpu_seconds": 0.005,
+    "connections": 0.5,
+    "statements": 5,
+    "lock_waits": 0.5,
+    "subprocesses": 0.5,
+    "log_setup_calls": 5,
+    "dictConfig_calls": 0.5
+}
+
+
+def get_peak_rss(usage):
+    """Returns the peak RSS in bytes; Linux reports it in kilobytes, macOS in bytes."""
+
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+
+def run_main(result_path):
+    """Runs `main.py` in this process, counting the calls of interest, and saves the measurements.
+
+    The number of devices is set by the simulator's configuration.
+
+    Args:
+        result_path (str):  JSON file to save the measurements to
+    """
+
+    import logging.config
+
+    sys.path.insert(0, package_directory)
+
+    import main
+    from AZTEC import db_utils, utilities
+
+    counters = { "subprocesses": 0, "log_setup_calls": 0, "dictConfig_calls": 0 }
+
+    class CountingPopen(subprocess.Popen):
+
+        def __init__(self, *args, **kwargs):
+            counters["subprocesses"] += 1
+            super().__init__(*args, **kwargs)
+
+    def counted(counter, function):
+
+        def wrapper(*args, **kwargs):
+            counters[counter] += 1
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    subprocess.Popen = CountingPopen
+    utilities.log_setup = counted("log_setup_calls", utilities.log_setup)
+    logging.config.dictConfig = counted("dictConfig_calls", logging.config.dictConfig)
+    utilities.log_directory = os.path.join(os.environ["AZTEC_BENCHMARK_DIRECTORY"], "logs")
+
+    # AZTEC uses the devices.db in the working directory, which is the simulation's directory
+    sys.argv = [ "main.py", "--erase-warning", "0", "--offline" ]
+
+    started = time.monotonic()
+    main.main()
+    wall_time = time.monotonic() - started
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    with sqlite3.connect("devices.db") as connection:
+        completed = connection.execute("SELECT count(*) FROM completions").fetchone()[0]
+
+    with open(result_path, "w") as result_file:
+        json.dump(dict(counters, wall_seconds=wall_time, cpu_seconds=usage.ru_utime + usage.ru_stime,
+            peak_rss=get_peak_rss(usage), completed=completed, **db_utils.get_statistics()), result_file)
+
+
+def simulate(devices):
+    """Runs a simulation in a new process.
+
+    Args:
+        devices (int):  Number of virtual devices
+
+    Returns:
+        dict:  The totals and the per-device measurements
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        config_path = os.path.join(directory, "simulation.json")
+        result_path = os.path.join(directory, "result.json")
+
+        with open(config_path, "w") as config_file:
+            json.dump(dict(SIMULATION, devices=devices, unplug_timeout=60,
+                aztec_database=os.path.join(directory, "devices.db")), config_file)
+
+        environment = dict(os.environ,
+            PATH="{}:{}".format(os.path.join(package_directory, "simulator", "bin"), os.environ.get("PATH", "")),
+            PYTHONPATH=package_directory,
+            AZTEC_BENCHMARK_DIRECTORY=directory,
+            AZTEC_SIMULATOR_CONFIG=config_path,
+            AZTEC_SIMULATOR_STATE=os.path.join(directory, "simulator.db"),
+            AZTEC_CACHE_DIRECTORY=os.path.join(directory, "cache"),
+            AZTEC_DISPATCHER_SOCKET=os.path.join(directory, "dispatcher.sock"),
+            AZTEC_LOG_SOCKET=os.path.join(directory, "logs.sock"),
+            AZTEC_METRICS_PORT="0" )
+
+        with open(os.path.join(directory, "main.out"), "w") as output:
+            subprocess.run( [ sys.executable, "-m", "benchmarks.end_to_end", "--run", result_path ],
+                cwd=directory, env=environment, stdout=output, stderr=subprocess.STDOUT, check=True )
+
+        with open(result_path, "r") as result_file:
+            totals = json.load(result_file)
+
+    per_device = { key: totals[key] / devices for key in
+        ( "wall_seconds", "cpu_seconds", "connections", "statements", "lock_waits", "retries",
+        "subprocesses", "log_setup_calls", "dictConfig_calls" ) }
+
+    return { "devices": devices, "totals": totals, "per_device": per_device }
+
+
+def get_commit():
+    """Returns the current git commit, if there is one."""
+
+    try:
+        return subprocess.run( [ "git", "rev-parse", "--short", "HEAD" ], cwd=package_directory,
+            capture_output=True, check=True, text=True ).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Compares the per-device measurements to a baseline.
+
+    Args:
+        results (dict):  The results of this run
+        baseline (dict):  The results of an earlier run
+        threshold (float):  The allowed relative increase, e.g. 0.25 for 25%
+
+    Returns:
+        list:  Descriptions of the measurements that regressed
+    """
+
+    regressions = []
+    previous_runs = { run["devices"]: run for run in baseline["runs"] }
+
+    for run in results["runs"]:
+
+        previous = previous_runs.get(run["devices"])
+
+        if not previous:
+            continue
+
+        for key, noise in COMPARED.items():
+
+            current = run["per_device"][key]
+            before = previous["per_device"][key]
+
+            if current > before * (1 + threshold) and current - before > noise:
+                regressions.append("{} devices:  {} per device went from {:.4g} to {:.4g}".format(
+                    run["devices"], key, before, current))
+
+        if run["totals"]["peak_rss"] > previous["totals"]["peak_rss"] * (1 + threshold):
+            regressions.append("{} devices:  peak RSS went from {:.1f} MB to {:.1f} MB".format(
+                run["devices"], previous["totals"]["peak_rss"] / 2**20, run["totals"]["peak_rss"] / 2**20))
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Measure AZTEC's per-device orchestration overhead.")
+    parser.add_argument("--devices", "-n", default=[ 8, 64, 256 ], nargs="+", type=int,
+        help="Number of virtual devices for each simulation.")
+    parser.add_argument("--output", "-o", default="end_to_end.json",
+        help="JSON file to save the results to.")
+    parser.add_argument("--baseline", "-b",
+        help="JSON results of an earlier run to check for regressions against.")
+    parser.add_argument("--threshold", "-t", default=0.25, type=float,
+        help="Allowed relative increase of each per-device measurement over the baseline.")
+    parser.add_argument("--run", metavar="RESULT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_main(args.run)
+        return
+
+    results = { "commit": get_commit(), "created": time.time(), "runs": [] }
+
+    print("{:>8} {:>10} {:>10} {:>10} {:>9} {:>10} {:>9} {:>10} {:>10} {:>10}".format(
+        "Devices", "Wall s/dev", "CPU ms/dev", "Peak RSS", "Conn/dev", "Stmt/dev", "Locks/dev",
+        "Procs/dev", "Logs/dev", "dictConfig"))
+
+    for devices in args.devices:
+
+        run = simulate(devices)
+        results["runs"].append(run)
+        per_device = run["per_device"]
+
+        print("{:>8} {:>10.3f} {:>10.1f} {:>8.1f}MB {:>9.2f} {:>10.1f} {:>9.2f} {:>10.2f} {:>10.1f} {:>10}".format(
+            devices, per_device["wall_seconds"], per_device["cpu_seconds"] * 1000,
+            run["totals"]["peak_rss"] / 2**20, per_device["connections"], per_device["statements"],
+            per_device["lock_waits"], per_device["subprocesses"], per_device["log_setup_calls"],
+            run["totals"]["dictConfig_calls"]))
+
+        if run["totals"]["completed"] != devices:
+            print("  \u26A0 Only {} of {} devices were provisioned".format(run["totals"]["completed"], devices))
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+
+    print("\nResults saved to {}".format(args.output))
+
+    if args.baseline:
+
+        with open(args.baseline, "r") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+
+        for regression in regressions:
+            print("\U0001F6D1 {}".format(regression))
+
+        if regressions:
+            sys.exit(1)
+
+        print("No regressions over {:.0%} against {}".format(args.threshold, args.baseline))
+
+
+if __name__ == "__main__":
+    main()
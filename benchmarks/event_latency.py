@@ -0,0 +1,83 @@
+"""Measures the event-to-first-action latency of an attach event.
+
+Compares starting a new Python process per event (`python3 -m AZTEC.attach`) with
+handing the event to the resident dispatcher over its Unix socket.
+
+Usage:  python3 -m benchmarks.event_latency [--samples 20]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from AZTEC import utilities
+from AZTEC.dispatcher import Dispatcher, send_event
+
+
+def measure_hook_process(samples):
+    """Time from spawning a hook process until `attach.main` could run."""
+
+    latencies = []
+
+    for _ in range(samples):
+
+        start = time.time()
+        results = subprocess.run(
+            [ sys.executable, "-c", "import time, AZTEC.attach; print(time.time())" ],
+            cwd=utilities.package_directory, capture_output=True, check=True, text=True )
+        latencies.append(float(results.stdout) - start)
+
+    return latencies
+
+
+def measure_dispatcher(samples):
+    """Time from sending an event until its handler runs on a worker thread."""
+
+    latencies = []
+    handled = threading.Event()
+
+    def handler(environment):
+        latencies.append(time.monotonic() - float(environment["sent"]))
+        handled.set()
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "dispatcher.sock")
+    dispatcher = Dispatcher(socket_path=socket_path, handlers={ "attach": handler })
+    dispatcher.start()
+
+    try:
+
+        for _ in range(samples):
+
+            handled.clear()
+            send_event("attach", { "sent": time.monotonic() }, socket_path=socket_path)
+            handled.wait(5)
+
+    finally:
+        dispatcher.stop()
+
+    return latencies
+
+
+def report(name, latencies):
+
+    print("{:<28} median {:8.2f} ms   max {:8.2f} ms".format(
+        name, statistics.median(latencies) * 1000, max(latencies) * 1000))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Measure attach event-to-first-action latency.")
+    parser.add_argument("--samples", "-s", default=20, type=int, help="Events to send per mode.")
+    args = parser.parse_args()
+
+    report("Hook process per event:", measure_hook_process(args.samples))
+    report("Resident dispatcher:", measure_dispatcher(args.samples))
+
+
+if __name__ == "__main__":
+    main()
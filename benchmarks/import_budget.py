@@ -0,0 +1,97 @@
+"""Checks the import-time budget of the attach/detach hook entry points.
+
+Each hook is imported in a fresh interpreter with `python -X importtime` and the
+check fails if its cumulative import time goes over budget, or if a module that
+should only be loaded on demand is imported at startup.
+
+Usage:  python3 -m benchmarks.import_budget [--runs 5] [--budget MILLISECONDS]
+"""
+
+import argparse
+import subprocess
+import sys
+
+from AZTEC import utilities
+
+
+# Maximum cumulative import time, in milliseconds, for each hook
+HOOK_BUDGETS = {
+    "AZTEC.attach": 75,
+    "AZTEC.detach": 75
+}
+
+# Modules that must only be imported on the code paths that use them
+DEFERRED_MODULES = { "asyncio", "distutils", "logging.config", "pkg_resources", "plistlib", "requests", "setuptools" }
+
+
+def import_time(module):
+    """Imports a module in a new interpreter and parses the `-X importtime` output.
+
+    Args:
+        module (str):  The module to import, e.g. "AZTEC.attach"
+
+    Returns:
+        (tuple):  The module's cumulative import time in microseconds and
+            the set of modules imported after interpreter startup
+    """
+
+    results = subprocess.run( [ sys.executable, "-X", "importtime", "-c", "import {}".format(module) ], 
+        cwd=utilities.package_directory, capture_output=True, check=True, text=True )
+
+    cumulative = None
+    imported = set()
+
+    for line in results.stderr.splitlines():
+
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, time_cumulative, name = line.split("|")
+        name = name.strip()
+
+        # Everything before the hook module was imported by interpreter startup (site)
+        if name == "site":
+            imported.clear()
+            continue
+
+        imported.add(name)
+
+        if name == module:
+            cumulative = int(time_cumulative)
+
+    return cumulative, imported
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Check the import-time budget of the hooks.")
+    parser.add_argument("--runs", "-n", default=5, type=int, 
+        help="Number of imports to measure per hook; the fastest is compared to the budget.")
+    parser.add_argument("--budget", "-b", type=int, 
+        help="Override the budget (milliseconds) for every hook.")
+    args = parser.parse_args()
+
+    failed = False
+
+    for module, budget in HOOK_BUDGETS.items():
+
+        budget = args.budget or budget
+        measurements = [ import_time(module) for _ in range(args.runs) ]
+        fastest = min(cumulative for cumulative, imported in measurements) / 1000
+        deferred = DEFERRED_MODULES.intersection(measurements[0][1])
+
+        print("{:<14} {:7.1f} ms (budget {} ms)".format(module, fastest, budget))
+
+        if fastest > budget:
+            print("  \U0001F6D1 Over budget!")
+            failed = True
+
+        if deferred:
+            print("  \U0001F6D1 Imported at startup:  {}".format(", ".join(sorted(deferred))))
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Measures the per-call cost of `utilities.log_setup`.
+
+Every function in AZTEC calls `log_setup` to get its logger, so it is called many
+times for each device.  The first call for a logger and the calls that follow are
+timed separately, for the main logger and a number of device loggers, along with
+the cost of logging a message.  The logs are written to a temporary directory.
+
+Usage:  python3 -m benchmarks.log_setup [--devices 64] [--calls 100]
+"""
+
+import argparse
+import contextlib
+import io
+import statistics
+import tempfile
+import time
+
+from AZTEC import utilities
+
+
+def measure(function, calls):
+    """Times calls of a function.
+
+    Args:
+        function (callable):  The function to time
+        calls (int):  Number of times to call it
+
+    Returns:
+        list:  Duration of each call in seconds
+    """
+
+    durations = []
+
+    for _ in range(calls):
+
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+
+    return durations
+
+
+def summarize(name, durations):
+
+    print("{:<22} median {:9.1f} us   mean {:9.1f} us   max {:9.1f} us".format(
+        name, statistics.median(durations) * 1e6, statistics.mean(durations) * 1e6, max(durations) * 1e6))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Measure the per-call cost of log_setup.")
+    parser.add_argument("--devices", default=64, type=int,
+        help="Number of device loggers to set up.")
+    parser.add_argument("--calls", default=100, type=int,
+        help="Number of repeated calls per logger.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+
+        utilities.log_directory = directory
+        devices = [ "{:016X}".format(number) for number in range(args.devices) ]
+
+        first = measure(lambda: utilities.log_setup(devices.pop()), args.devices)
+        repeated = measure(lambda: utilities.log_setup("0000000000000000"), args.calls)
+        main_logger = measure(lambda: utilities.log_setup(), args.calls)
+        logged = measure(lambda: utilities.log_setup("0000000000000000").debug("Benchmark"), args.calls)
+
+        utilities.log_shutdown()
+
+    summarize("First call per device", first)
+    summarize("Repeated device call", repeated)
+    summarize("Repeated main call", main_logger)
+    summarize("Set up and log", logged)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,22 @@
 import argparse
 import os
 import threading
+import time
 
-from distutils.util import strtobool
+from AZTEC import cfgutil, cleaner, executor, firmware, ipsw, limiter, poller, settings, utilities, workflow
+from AZTEC.aggregator import LogAggregator
+from AZTEC.db_utils import get_statistics, init_db, migrate
+from AZTEC.dispatcher import Dispatcher
+from AZTEC.metrics import MetricsServer
 
-from AZTEC import cfgutil, utilities
-from AZTEC.db_utils import init_db
+
+def print_quarantined():
+    """Prints the devices that were quarantined, for the operator to look into"""
+
+    for device in workflow.get_quarantined():
+        print("\U0001F6A7 Quarantined:  {}  {}  (port {}) failed {} times, last:  {}".format(
+            device["ECID"], device["SerialNumber"], device["locationID"], 
+            device["failures"], device["last_failure"]))
 
 
 def main():
@@ -28,6 +39,20 @@ def main():
         help="If the specified database already exists, optionally purge the devices table.", 
         required=False,
         type=str.lower)
+    parser.add_argument("--erase-warning", "-w", 
+        default=settings.ERASE_WARNING,
+        help="Seconds given to remove a device before it is erased.", 
+        required=False,
+        type=float)
+    parser.add_argument("--offline", "-o", 
+        action="store_true",
+        help="Do not check Apple's servers for firmware updates; use the cached firmware catalog.", 
+        required=False)
+    parser.add_argument("--release", 
+        metavar="ECID",
+        nargs="+",
+        help="Release quarantined devices, so they are provisioned again on their next attach, and exit.", 
+        required=False)
 
     args, unknown = parser.parse_known_args()
 
@@ -39,38 +64,125 @@ def main():
     print("Total Disk Space:  {}".format(total))
     print("Available Disk Space:  {}\n".format(free))
 
+    if args.release:
+
+        migrate(args.database)
+
+        for ECID in args.release:
+
+            if workflow.release(ECID):
+                print("Released {}, it will be provisioned on its next attach".format(ECID))
+
+            else:
+                print("\u26A0 {} is not quarantined".format(ECID))
+
+        return
+
     # Check if the database file currently exists
     if os.path.isfile(args.database):
-        reset = True
-
         if args.reset is None:
             reset = utilities.query_user_yes_no(
             "The devices database already exists, would you like to purge the existing content?")
 
-        if not strtobool(args.reset.lower()):
-            reset = False
+        else:
+            reset = utilities.strtobool(args.reset)
 
-        if strtobool(args.reset.lower()) and reset:
+        if reset:
             print("Purging previous content...\n")
             init_db(args.database)
 
             # Back up previous log files
             utilities.log_backup()
 
+        else:
+            # Upgrade the existing database in place
+            migrate(args.database)
+
     else:
 
         init_db(args.database)
 
+    # Let the cfgutil hooks know how long to wait before erasing a device
+    os.environ["AZTEC_ERASE_WARNING"] = str(args.erase_warning)
+    settings.ERASE_WARNING = args.erase_warning
+
+    # Release any operation slots left behind by a previous run
+    limiter.reset()
+
+    if args.offline:
+        # Let the cfgutil hooks know to only use the cached firmware catalog
+        os.environ["AZTEC_OFFLINE"] = "true"
+        settings.OFFLINE = True
+
+    # The components that were started, stopped in reverse order when main.py exits
+    stops = []
+    started = None
+
     try:
 
+        print("Starting the log aggregator...")
+        aggregator = LogAggregator()
+        aggregator.start()
+        stops.append(aggregator.stop)
+
+        # Let the cfgutil hooks know where to send their log records
+        os.environ["AZTEC_LOG_SOCKET"] = settings.LOG_SOCKET
+
+        print("Loading the firmware catalog...")
+        catalog = firmware.refresh_catalog()
+
+        if catalog:
+            print("Firmware catalog contains {} device models.\n".format(len(catalog["index"])))
+
+        else:
+            print("\u26A0 The firmware catalog is not available, devices will not be updated.\n")
+
+        started = time.time()
+
         print("Setting up temporary file clean up job in the background...")
-        event = threading.Event()
         background_job = utilities.Periodic(
-            function = cfgutil.clean_configurator_temp_dir, 
+            function = cleaner.clean_configurator_temp_dir, 
             interval = 300, 
-            event = event
+            event = threading.Event()
         )
         background_job.start()
+        stops.append(background_job.cancel)
+
+        print("Setting up firmware pre-staging job in the background...")
+        prestage_job = utilities.Periodic(
+            function = ipsw.prestage, 
+            interval = 60, 
+            event = threading.Event()
+        )
+        prestage_job.start()
+        stops.append(prestage_job.cancel)
+
+        print("Starting the device property poller...")
+        poller.start()
+        stops.append(poller.stop)
+
+        print("Starting the cfgutil command executor...")
+        executor.start()
+        stops.append(executor.stop)
+
+        print("Starting the attach/detach dispatcher...")
+        dispatcher = Dispatcher()
+        dispatcher.start()
+        stops.append(dispatcher.stop)
+
+        # Let the cfgutil hooks know where to send their events
+        os.environ["AZTEC_DISPATCHER_SOCKET"] = settings.DISPATCHER_SOCKET
+
+        if settings.METRICS_PORT:
+
+            try:
+                metrics_server = MetricsServer()
+                metrics_server.start()
+                stops.append(metrics_server.stop)
+                print("Serving metrics at http://127.0.0.1:{}/metrics".format(settings.METRICS_PORT))
+
+            except OSError as error:
+                print("\u26A0 Unable to serve metrics on port {}:  {}".format(settings.METRICS_PORT, error))
 
         print("\nStarting the main process...\n")
         print("System ready to accept devices!\n")
@@ -81,13 +193,27 @@ def main():
             ) 
         )
 
-        background_job.cancel()
-
     except KeyboardInterrupt:
+        pass
+
+    finally:
+
+        print("Stopping the dispatcher and background jobs...")
+
+        for stop in reversed(stops):
+            stop()
 
-        print("Canceling background job...")
-        background_job.cancel()
+        print("Database statistics:  {}".format(get_statistics()))
+        print("Poller statistics:  {}".format(poller.get_statistics()))
+        print("cfgutil errors:  {}".format(cfgutil.get_statistics()))
+        print("Executor statistics:  {}".format(executor.get_statistics()))
+        print_quarantined()
 
+        if started:
+            print("Peak firmware extraction usage:  {}".format(
+                utilities.HumanBytes.format(cleaner.get_peak_usage(started))))
+            print("Temporary directories removed:  {}, reclaimed {}".format(
+                cleaner.get_statistics()["removed"], utilities.HumanBytes.format(cleaner.get_statistics()["reclaimed"])))
 
 if __name__ == "__main__":
     main()
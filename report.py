@@ -0,0 +1,88 @@
+#!/opt/ManagedFrameworks/Python.framework/Versions/Current/bin/python3
+
+import argparse
+import os
+import sys
+
+from AZTEC import rollups
+from AZTEC.db_utils import migrate
+
+
+def format_duration(seconds):
+    """Formats a number of seconds as hours, minutes and seconds.
+
+    Args:
+        seconds (float):  Number of seconds
+
+    Returns:
+        str:  e.g. "1:02:03"
+    """
+
+    hours, remainder = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(remainder, 60)
+
+    return "{}:{:02}:{:02}".format(hours, minutes, seconds)
+
+
+def print_breakdown(title, summaries):
+    """Prints a table of the cycle times for each value of a dimension.
+
+    Args:
+        title (str):  The table's title, e.g. "Model"
+        summaries (list):  The summaries from `rollups.summarize`
+    """
+
+    print("\n{:<16} {:>8} {:>10} {:>10} {:>10} {:>10}".format(title, "Devices", "Mean", "p50", "p95", "p99"))
+
+    for summary in summaries:
+        print("{:<16} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+            summary["value"], summary["count"], format_duration(summary["mean"]),
+            *[ format_duration(summary["percentiles"][percentile]) for percentile in (50, 95, 99) ]))
+
+
+def main():
+    """Reports AZTEC's provisioning throughput"""
+
+    parser = argparse.ArgumentParser(
+        description="Reports how many devices AZTEC has provisioned and how long they took.")
+    parser.add_argument(
+        "--database", "-d", 
+        default="devices.db", 
+        help="Specify the database file to report on.", 
+        required=False)
+    parser.add_argument("--rebuild", 
+        action="store_true",
+        help="Rebuild the rollups from every completed device.", 
+        required=False)
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        print("\U0001F6D1 The database does not exist:  {}".format(args.database))
+        sys.exit(1)
+
+    migrate(args.database)
+
+    if args.rebuild or not rollups.is_current(args.database):
+        print("Rebuilding the rollups...")
+        rollups.rebuild(args.database)
+
+    throughput = rollups.get_throughput(args.database)
+
+    print("\nDevices provisioned:  {}".format(throughput["devices"]))
+
+    if not throughput["devices"]:
+        return
+
+    print("Devices per hour:  {:.1f} (over {} active hours, busiest hour {})".format(
+        throughput["per_hour"], throughput["hours"], throughput["peak"]))
+    print("Devices in the last 24 hours:  {}".format(throughput["last_24_hours"]))
+
+    print_breakdown("Cycle time", rollups.summarize("all", args.database))
+    print_breakdown("Model", rollups.summarize("model", args.database))
+    print_breakdown("Firmware", rollups.summarize("firmware", args.database))
+    print_breakdown("Hour of day", rollups.summarize("hour", args.database))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""A stand-in for Apple's `cfgutil` that simulates devices, for load-testing AZTEC
+without hardware, on any platform.
+
+It accepts the same `--ecid` / `--format JSON` arguments and returns the same JSON
+shapes as the commands AZTEC uses (`get`, `erase`, `restore`, `prepare` and
+`exec`), with latencies and failures drawn from the simulator's configuration.
+Devices are shared between processes through the simulator's state database, and
+`exec` runs the driver that plugs the virtual devices in.
+
+Put `simulator/bin` first in PATH to use it in place of cfgutil.
+"""
+
+import json
+import sys
+import time
+
+from simulator import driver, state
+
+
+PROPERTIES = ( "UDID", "serialNumber", "deviceType", "buildVersion", "firmwareVersion", "locationID",
+    "deviceName", "activationState", "bootedState", "isSupervised", "batteryCurrentCapacity", "batteryIsCharging" )
+
+BOOLEAN_PROPERTIES = { "isSupervised", "batteryIsCharging" }
+
+
+def parse_arguments(arguments):
+    """Splits cfgutil's arguments into its options, the command and the command's arguments.
+
+    Args:
+        arguments (list):  e.g. ["--ecid", "0x1", "--format", "JSON", "get", "UDID"]
+
+    Returns:
+        tuple:  The ECIDs, the output format, the command and its arguments
+    """
+
+    ECIDs = []
+    output_format = None
+    arguments = list(arguments)
+
+    while arguments and arguments[0].startswith("-"):
+
+        option = arguments.pop(0)
+
+        if option in { "--ecid", "-e" }:
+            ECIDs.append(arguments.pop(0))
+
+        elif option in { "--format", "-f" }:
+            output_format = arguments.pop(0)
+
+    command = arguments.pop(0) if arguments else None
+
+    return ECIDs, output_format, command, arguments
+
+
+def get_error(code, ECIDs, message=None):
+    """Builds the JSON cfgutil prints when a command fails for a device.
+
+    Args:
+        code (int):  The error code
+        ECIDs (list):  The devices the error affected
+        message (str, optional):  The error message
+
+    Returns:
+        dict:  The error
+    """
+
+    return {
+        "Type": "Error",
+        "Code": code,
+        "Domain": "com.apple.configurator.error",
+        "Message": message or state.ERRORS.get(code, "An unknown error occurred."),
+        "AffectedDevices": ECIDs
+    }
+
+
+def get_properties(device, properties):
+    """Builds a device's `get` output.
+
+    Args:
+        device (sqlite3.Row):  The device's state
+        properties (list):  The properties asked for
+
+    Returns:
+        dict:  The properties' values
+    """
+
+    return { key: bool(device[key]) if key in BOOLEAN_PROPERTIES else device[key]
+        for key in properties if key in PROPERTIES }
+
+
+def run_get(connection, config, devices, properties):
+    """Simulates `cfgutil get`, for one or more devices."""
+
+    time.sleep(state.sample_latency(config, "get"))
+
+    output = { "Errors": {} }
+
+    for device in devices:
+
+        code = state.sample_failure(config, "get")
+
+        if code:
+            output["Errors"][device["ECID"]] = { "Code": code, "Message": state.ERRORS.get(code) }
+
+        else:
+            output[device["ECID"]] = get_properties(device, properties)
+
+    state.count(connection, "get", bool(output["Errors"]))
+
+    return 0, { "Command": "get", "Output": output, "Type": "CommandOutput",
+        "Devices": [ device["ECID"] for device in devices ] }
+
+
+def run_operation(connection, config, device, command):
+    """Simulates `cfgutil erase`, `restore` or `prepare` for a device.
+
+    A successful erase or restore reboots the device, which is detached straight
+    away and attached again once it has booted; a prepared device is unplugged
+    by the simulated operator once AZTEC is done with it.
+    """
+
+    ECID = device["ECID"]
+    latency = state.sample_latency(config, command)
+
+    # Report progress on stderr while the command runs
+    for step in range(10):
+        time.sleep(latency / 10)
+        print("{}: {}%".format(command.capitalize(), ( step + 1 ) * 10), file=sys.stderr, flush=True)
+    code = state.sample_failure(config, command)
+
+    state.count(connection, command, code is not None)
+
+    if code in { 33001, 401 }:
+        return 1, get_error(code, [ ECID ])
+
+    connection.execute("BEGIN IMMEDIATE")
+
+    if command in { "erase", "restore" }:
+
+        if command == "restore":
+            connection.execute("UPDATE devices SET firmwareVersion = ?, buildVersion = ? WHERE ECID = ?",
+                (config["restore_firmwareVersion"], config["restore_buildVersion"], ECID))
+
+        connection.execute(
+            """UPDATE devices SET attached = 0, activationState = 'Unactivated', isSupervised = 0,
+            bootedState = 'Booted', prepared = 0 WHERE ECID = ?""", (ECID,))
+        state.schedule(connection, ECID, "detach", 0)
+        state.schedule(connection, ECID, "attach", state.sample_latency(config, "boot"))
+
+    elif command == "prepare":
+
+        connection.execute(
+            "UPDATE devices SET activationState = 'Activated', isSupervised = 1, prepared = 1 WHERE ECID = ?",
+            (ECID,))
+
+        if code:
+            # The MDM configuration reboots the device, so it is checked again when it attaches
+            state.schedule(connection, ECID, "detach", 0)
+            state.schedule(connection, ECID, "attach", state.sample_latency(config, "boot"))
+
+        else:
+            state.schedule(connection, ECID, "unplug", state.sample_latency(config, "unplug"))
+
+    connection.execute("COMMIT")
+
+    output = { ECID: {}, "Errors": {} }
+
+    # The device may have been prepared even though cfgutil could not tell
+    if code:
+        output["Errors"][ECID] = { "Code": code, "Message": state.ERRORS.get(code) }
+
+    return 0, { "Command": command, "Output": output, "Type": "CommandOutput", "Devices": [ ECID ] }
+
+
+def run(arguments):
+    """Runs a simulated cfgutil command.
+
+    Args:
+        arguments (list):  The command line arguments, without the program name
+
+    Returns:
+        int:  The exit code
+    """
+
+    ECIDs, output_format, command, command_arguments = parse_arguments(arguments)
+
+    if command == "exec":
+        return driver.main(command_arguments)
+
+    connection = state.connect()
+    config = state.get_config(connection)
+
+    devices = [ device for device in connection.execute(
+        "SELECT * FROM devices WHERE attached = 1 AND ECID IN ({})".format(
+            ", ".join("?" * len(ECIDs))), ECIDs).fetchall() ]
+
+    if not devices:
+        print("cfgutil: error: no devices found", file=sys.stderr)
+        return 1
+
+    state.seed(connection, config, [ device["ECID"] for device in devices ], command)
+
+    if command == "get":
+        exitcode, output = run_get(connection, config, devices, command_arguments)
+
+    elif command in { "erase", "restore", "prepare" }:
+        exitcode, output = run_operation(connection, config, devices[0], command)
+
+    else:
+        print("cfgutil: error: the simulator does not support `{}`".format(command), file=sys.stderr)
+        return 1
+
+    print(json.dumps(output) if output_format == "JSON" else output)
+
+    return exitcode
+
+
+def main():
+    sys.exit(run(sys.argv[1:]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""Drives the simulated devices, in place of `cfgutil exec`.
+
+The virtual devices are plugged in one after another, and each attach, detach
+and unplug that the simulated cfgutil commands schedule is fired at the time it
+is due.  Events are handed to AZTEC the way its hooks do:  over the dispatcher's
+Unix socket when `main.py` is running, otherwise by running `AZTEC.attach` /
+`AZTEC.detach` in a new process; or, with `"hooks": "script"`, by running the
+`--on-attach` / `--on-detach` scripts like cfgutil does (they need macOS' `nc`).
+
+Usage:  python3 -m simulator.driver [--devices 8] [--config CONFIG]
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from AZTEC import settings
+from simulator import state
+
+
+package_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def create_devices(connection, config):
+    """Creates the virtual devices and schedules them to be plugged in.
+
+    Args:
+        connection (sqlite3.Connection):  The state database
+        config (dict):  The configuration
+    """
+
+    connection.execute("BEGIN IMMEDIATE")
+    connection.execute("DELETE FROM devices")
+    connection.execute("DELETE FROM events")
+    connection.execute("DELETE FROM commands")
+    connection.execute("DELETE FROM device_calls")
+    connection.execute("INSERT OR REPLACE INTO config ( id, value ) VALUES (1, ?)", (json.dumps(config),))
+
+    for number in range(config["devices"]):
+
+        ECID = "0x{:013X}".format(random.getrandbits(52))
+
+        connection.execute(
+            """INSERT INTO devices ( ECID, UDID, serialNumber, deviceType, buildVersion, firmwareVersion,
+            locationID, deviceName, activationState, bootedState, isSupervised, batteryCurrentCapacity,
+            batteryIsCharging ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'Activated', 'Booted', 1, ?, 1)""",
+            ( ECID, "{:040x}".format(random.getrandbits(160)), "SIM{:09d}".format(number),
+            random.choice(config["models"]), config["buildVersion"], config["firmwareVersion"],
+            "0x{:08X}".format(0x14100000 + number), "Simulated Device {}".format(number + 1),
+            random.randint(20, 100) ) )
+
+        state.schedule(connection, ECID, "attach", number * config["attach_interval"] * config["time_scale"])
+
+    connection.execute("COMMIT")
+
+
+def is_done(config, ECID):
+    """Checks if AZTEC has marked a device done (or quarantined it), as the operator
+    would see on the console.
+
+    Args:
+        config (dict):  The configuration
+        ECID (str):  ECID of the device
+
+    Returns:
+        bool:  Whether the device is done, or None if AZTEC's database does not exist
+    """
+
+    if not os.path.exists(config["aztec_database"]):
+        return None
+
+    try:
+        with sqlite3.connect(config["aztec_database"], timeout=5) as connection:
+            row = connection.execute("SELECT status FROM devices WHERE ECID = ?", (ECID,)).fetchone()
+
+    except sqlite3.Error:
+        return False
+
+    return bool(row) and row[0] in { "done", "quarantined" }
+
+
+def get_quarantined(config):
+    """Gets the devices AZTEC has quarantined, which the operator unplugs.
+
+    Args:
+        config (dict):  The configuration
+
+    Returns:
+        set:  ECIDs of the quarantined devices
+    """
+
+    if not os.path.exists(config["aztec_database"]):
+        return set()
+
+    try:
+        with sqlite3.connect(config["aztec_database"], timeout=5) as connection:
+            return { row[0] for row in 
+                connection.execute("SELECT ECID FROM devices WHERE status = 'quarantined'") }
+
+    except sqlite3.Error:
+        return set()
+
+
+class Driver():
+    """Fires the simulated devices' events at AZTEC."""
+
+    def __init__(self, config, on_attach=None, on_detach=None):
+
+        self.config = config
+        self.hooks = { "attach": on_attach, "detach": on_detach }
+        self.processes = []
+        self.threads = []
+        self.unplugging = {}
+        self.quarantined = set()
+        self.statistics = { "attach": 0, "detach": 0, "unplug": 0, "quarantined": 0, "hook_processes": 0 }
+
+
+    def fire(self, event, device):
+        """Hands an attach or detach event to AZTEC without waiting for it to be handled.
+
+        Args:
+            event (str):  "attach" or "detach"
+            device (sqlite3.Row):  The device's state
+        """
+
+        environment = dict(os.environ, **{ key: str(device[key]) for key in settings.DEVICE_ENVIRONMENT })
+        self.statistics[event] += 1
+
+        if self.config.get("hooks") == "script" and self.hooks[event]:
+            self.processes.append(subprocess.Popen( [ self.hooks[event] ], env=environment ))
+            self.statistics["hook_processes"] += 1
+            return
+
+        thread = threading.Thread(target=self.fire_python, args=(event, environment), daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+
+    def fire_python(self, event, environment):
+        """Does what the shell hooks do, in Python, so it runs without macOS' `nc`."""
+
+        from AZTEC.dispatcher import send_event
+
+        socket_path = environment.get("AZTEC_DISPATCHER_SOCKET", settings.DISPATCHER_SOCKET)
+
+        try:
+            if os.path.exists(socket_path) and send_event(event,
+                { key: environment[key] for key in settings.DEVICE_ENVIRONMENT }, socket_path=socket_path):
+                return
+
+        except OSError:
+            pass
+
+        self.statistics["hook_processes"] += 1
+        subprocess.run( [ sys.executable, "-m", "AZTEC.{}".format(event) ],
+            cwd=package_directory, env=environment )
+
+
+    def handle(self, connection, event):
+        """Applies a due event to a device and fires it.
+
+        Args:
+            connection (sqlite3.Connection):  The state database
+            event (sqlite3.Row):  The event
+        """
+
+        connection.execute("DELETE FROM events WHERE id = ?", (event["id"],))
+
+        if event["event"] == "attach":
+
+            connection.execute("UPDATE devices SET attached = 1 WHERE ECID = ?", (event["ECID"],))
+            device = connection.execute("SELECT * FROM devices WHERE ECID = ?", (event["ECID"],)).fetchone()
+
+            # A device that was rebooted after being prepared is unplugged once AZTEC is done with it
+            if device["prepared"]:
+                state.schedule(connection, event["ECID"], "unplug", state.sample_latency(self.config, "unplug"))
+
+            self.fire("attach", device)
+
+        elif event["event"] == "detach":
+            device = connection.execute("SELECT * FROM devices WHERE ECID = ?", (event["ECID"],)).fetchone()
+            self.fire("detach", device)
+
+        elif event["event"] == "unplug":
+
+            waiting = self.unplugging.setdefault(event["ECID"], time.monotonic())
+
+            if is_done(self.config, event["ECID"]) is False and \
+                time.monotonic() - waiting < self.config["unplug_timeout"]:
+                # Not done yet, look again shortly
+                state.schedule(connection, event["ECID"], "unplug", 0.25)
+                return
+
+            connection.execute("UPDATE devices SET attached = 0, finished = 1 WHERE ECID = ?", (event["ECID"],))
+            device = connection.execute("SELECT * FROM devices WHERE ECID = ?", (event["ECID"],)).fetchone()
+            self.statistics["unplug"] += 1
+            self.fire("detach", device)
+
+
+    def unplug_quarantined(self, connection):
+        """Schedules the devices that AZTEC has newly quarantined to be unplugged.
+
+        Args:
+            connection (sqlite3.Connection):  The state database
+        """
+
+        for ECID in get_quarantined(self.config) - self.quarantined:
+
+            self.quarantined.add(ECID)
+            self.statistics["quarantined"] += 1
+            state.schedule(connection, ECID, "unplug", state.sample_latency(self.config, "unplug"))
+
+
+    def run(self, timeout=None):
+        """Fires events until every device has been unplugged.
+
+        Args:
+            timeout (float, optional):  Maximum seconds to run for
+
+        Returns:
+            bool:  Whether every device was unplugged
+        """
+
+        connection = state.connect()
+        deadline = time.monotonic() + timeout if timeout else None
+        checked = time.monotonic()
+
+        while True:
+
+            events = connection.execute(
+                "SELECT * FROM events WHERE due <= ? ORDER BY due, id", (time.time(),)).fetchall()
+
+            for event in events:
+                self.handle(connection, event)
+
+            # The operator unplugs the devices AZTEC quarantines, checked about once a second
+            if time.monotonic() >= checked + 1:
+                self.unplug_quarantined(connection)
+                checked = time.monotonic()
+
+            # Reap the hook processes that have exited
+            self.processes = [ process for process in self.processes if process.poll() is None ]
+
+            remaining = connection.execute("SELECT count(*) FROM devices WHERE finished = 0").fetchone()[0]
+
+            if not remaining:
+                break
+
+            if deadline and time.monotonic() > deadline:
+                return False
+
+            time.sleep(0.02)
+
+        # Let the last events be handled
+        for thread in self.threads:
+            thread.join()
+
+        for process in self.processes:
+            process.wait()
+
+        return True
+
+
+def main(arguments=None):
+    """Runs the driver, either as `cfgutil exec` or on its own.
+
+    Args:
+        arguments (list, optional):  The command line arguments.  Defaults to sys.argv
+
+    Returns:
+        int:  The exit code
+    """
+
+    parser = argparse.ArgumentParser(description="Plug simulated devices into AZTEC.")
+    parser.add_argument("--on-attach", help="Script to run when a device is attached.")
+    parser.add_argument("--on-detach", help="Script to run when a device is detached.")
+    parser.add_argument("--devices", "-n", type=int, help="Number of virtual devices.")
+    parser.add_argument("--config", "-c", help="JSON file that overrides the default configuration.")
+    parser.add_argument("--timeout", "-t", type=float, help="Maximum seconds to run for.")
+    args = parser.parse_args(arguments)
+
+    config = state.load_config(args.config)
+
+    if args.devices:
+        config["devices"] = args.devices
+
+    config["aztec_database"] = os.path.abspath(config["aztec_database"])
+    random.seed(config.get("seed"))
+
+    create_devices(state.connect(), config)
+
+    driver = Driver(config, args.on_attach, args.on_detach)
+    started = time.monotonic()
+    finished = driver.run(args.timeout)
+
+    print("Simulated {} devices in {:.1f} seconds:  {}".format(
+        config["devices"], time.monotonic() - started, json.dumps(driver.statistics)), file=sys.stderr)
+
+    return 0 if finished else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
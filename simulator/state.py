@@ -0,0 +1,272 @@
+import json
+import os
+import random
+import sqlite3
+import time
+
+
+# SQLite database shared by the driver and every simulated `cfgutil` process
+STATE_FILE = os.getenv("AZTEC_SIMULATOR_STATE", "/tmp/AZTEC-simulator.db")
+
+# JSON file that overrides the default configuration, if set
+CONFIG_FILE = os.getenv("AZTEC_SIMULATOR_CONFIG")
+
+DEFAULT_CONFIG = {
+
+    # Number of virtual devices and the seconds between each of them being plugged in
+    "devices": 8,
+    "attach_interval": 0.5,
+
+    # Multiplies every latency, e.g. 0.01 to run a simulation 100 times faster than real time
+    "time_scale": 1.0,
+
+    # Seed for the random number generators, for repeatable runs; null for a random seed.
+    # Each simulated cfgutil command is seeded from it, its devices, the command and how
+    # many times the command was run for them, so its draws do not depend on the process
+    "seed": None,
+
+    # Latency of each command, and of the device events, in seconds:
+    #   { "type": "fixed", "value": 1 }
+    #   { "type": "uniform", "min": 1, "max": 2 }
+    #   { "type": "lognormal", "median": 1, "sigma": 0.25 }
+    "latency": {
+        "get": { "type": "lognormal", "median": 0.3, "sigma": 0.25 },
+        "erase": { "type": "lognormal", "median": 20, "sigma": 0.25 },
+        "restore": { "type": "lognormal", "median": 600, "sigma": 0.15 },
+        "prepare": { "type": "lognormal", "median": 60, "sigma": 0.25 },
+        "boot": { "type": "lognormal", "median": 40, "sigma": 0.2 },
+        "unplug": { "type": "uniform", "min": 2, "max": 10 }
+    },
+
+    # Chance of each command failing with each error code
+    "failures": {
+        "get": { "-402653030": 0.0, "603": 0.0 },
+        "erase": {},
+        "restore": {},
+        "prepare": { "33001": 0.02, "603": 0.01 }
+    },
+
+    # The operator unplugs a prepared device once AZTEC has marked it done in this database
+    # (or, if it does not exist, after the unplug latency), giving up after unplug_timeout seconds
+    "aztec_database": "devices.db",
+    "unplug_timeout": 600,
+
+    # Properties of the virtual devices
+    "models": [ "iPad7,5", "iPad7,11", "iPad6,11" ],
+    "firmwareVersion": "15.0",
+    "buildVersion": "19A346",
+    "restore_firmwareVersion": "15.2",
+    "restore_buildVersion": "19C56"
+}
+
+# The JSON cfgutil returns for each simulated error code
+ERRORS = {
+    33001: "The configuration is not available.",
+    401: "The Mac must be updated to work with this device.",
+    603: "The operation couldn't be completed.",
+    -402653052: "The operation couldn't be completed.",
+    -402653030: "The device could not be paired with this computer."
+}
+
+
+def connect(path=None):
+    """Opens the simulator's state database, creating it if needed.
+
+    Args:
+        path (str, optional):  The state database.  Defaults to STATE_FILE
+
+    Returns:
+        sqlite3.Connection:  A connection in autocommit mode
+    """
+
+    connection = sqlite3.connect(path or STATE_FILE, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.executescript(
+        """ CREATE TABLE IF NOT EXISTS devices (
+            ECID TEXT PRIMARY KEY,
+            UDID TEXT,
+            serialNumber TEXT,
+            deviceType TEXT,
+            buildVersion TEXT,
+            firmwareVersion TEXT,
+            locationID TEXT,
+            deviceName TEXT,
+            activationState TEXT,
+            bootedState TEXT,
+            isSupervised INTEGER,
+            batteryCurrentCapacity INTEGER,
+            batteryIsCharging INTEGER,
+            attached INTEGER NOT NULL DEFAULT 0,
+            prepared INTEGER NOT NULL DEFAULT 0,
+            finished INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ECID TEXT NOT NULL,
+            event TEXT NOT NULL,
+            due REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS commands (
+            command TEXT PRIMARY KEY,
+            calls INTEGER NOT NULL,
+            failures INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS device_calls (
+            devices TEXT NOT NULL,
+            command TEXT NOT NULL,
+            calls INTEGER NOT NULL,
+            PRIMARY KEY ( devices, command )
+        );
+        CREATE TABLE IF NOT EXISTS config (
+            id INTEGER PRIMARY KEY CHECK ( id = 1 ),
+            value TEXT NOT NULL
+        ); """ )
+
+    return connection
+
+
+def load_config(path=None):
+    """Loads the configuration, merging a JSON file over the defaults.
+
+    Args:
+        path (str, optional):  The JSON file.  Defaults to CONFIG_FILE
+
+    Returns:
+        dict:  The configuration
+    """
+
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    path = path or CONFIG_FILE
+
+    if path:
+
+        with open(path, "r") as config_file:
+            overrides = json.load(config_file)
+
+        for key, value in overrides.items():
+
+            if isinstance(value, dict) and isinstance(config.get(key), dict):
+                config[key].update(value)
+
+            else:
+                config[key] = value
+
+    return config
+
+
+def get_config(connection):
+    """Gets the configuration the driver saved for the current simulation.
+
+    Args:
+        connection (sqlite3.Connection):  The state database
+
+    Returns:
+        dict:  The configuration
+    """
+
+    row = connection.execute("SELECT value FROM config WHERE id = 1").fetchone()
+
+    return json.loads(row["value"]) if row else load_config()
+
+
+def seed(connection, config, ECIDs, command):
+    """Seeds this process' random number generator for a command, when the configuration
+    has a seed, so that the same call of a command draws the same latencies and failures
+    in every run.
+
+    Args:
+        connection (sqlite3.Connection):  The state database
+        config (dict):  The configuration
+        ECIDs (list):  The devices the command is run for
+        command (str):  The command, e.g. "prepare"
+    """
+
+    if config.get("seed") is None:
+        return
+
+    devices = ",".join(sorted(ECIDs))
+
+    calls = connection.execute(
+        """INSERT INTO device_calls ( devices, command, calls ) VALUES (?, ?, 1)
+        ON CONFLICT ( devices, command ) DO UPDATE SET calls = calls + 1 RETURNING calls""",
+        (devices, command)).fetchone()[0]
+
+    random.seed("{}:{}:{}:{}".format(config["seed"], devices, command, calls))
+
+
+def sample_latency(config, name):
+    """Draws a latency from its configured distribution.
+
+    Args:
+        config (dict):  The configuration
+        name (str):  The command or event, e.g. "erase" or "boot"
+
+    Returns:
+        float:  Seconds, already multiplied by the time scale
+    """
+
+    distribution = config["latency"].get(name, { "type": "fixed", "value": 0 })
+
+    if distribution["type"] == "uniform":
+        latency = random.uniform(distribution["min"], distribution["max"])
+
+    elif distribution["type"] == "lognormal":
+        latency = random.lognormvariate(0, distribution["sigma"]) * distribution["median"]
+
+    else:
+        latency = distribution["value"]
+
+    return latency * config["time_scale"]
+
+
+def sample_failure(config, command):
+    """Decides whether a command fails, and with which error code.
+
+    Args:
+        config (dict):  The configuration
+        command (str):  The command, e.g. "prepare"
+
+    Returns:
+        int:  The error code, or None if the command succeeds
+    """
+
+    roll = random.random()
+
+    for code, rate in config["failures"].get(command, {}).items():
+
+        if roll < rate:
+            return int(code)
+
+        roll -= rate
+
+    return None
+
+
+def schedule(connection, ECID, event, delay):
+    """Queues a device event for the driver.
+
+    Args:
+        connection (sqlite3.Connection):  The state database
+        ECID (str):  ECID of the device
+        event (str):  "attach", "detach" or "unplug"
+        delay (float):  Seconds from now
+    """
+
+    connection.execute("INSERT INTO events ( ECID, event, due ) VALUES (?, ?, ?)",
+        (ECID, event, time.time() + delay))
+
+
+def count(connection, command, failed):
+    """Counts a simulated command.
+
+    Args:
+        connection (sqlite3.Connection):  The state database
+        command (str):  The command, e.g. "get"
+        failed (bool):  Whether it failed
+    """
+
+    connection.execute(
+        """INSERT INTO commands ( command, calls, failures ) VALUES (?, 1, ?)
+        ON CONFLICT ( command ) DO UPDATE SET calls = calls + 1, failures = failures + excluded.failures""",
+        (command, int(failed)))